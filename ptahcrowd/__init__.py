@@ -3,10 +3,12 @@
 from ptahcrowd.provider import get_user_type
 from ptahcrowd.provider import CrowdUser
 from ptahcrowd.provider import CrowdGroup
+from ptahcrowd.provider import CrowdGroupMember
 from ptahcrowd.provider import CROWD_APP_ID
 
 from ptahcrowd.settings import CFG_ID_AUTH
 from ptahcrowd.settings import CFG_ID_CROWD
+from ptahcrowd.settings import CFG_ID_RATELIMIT
 from ptahcrowd.validation import initiate_email_validation
 
 from ptahcrowd.schemas import UserSchema
@@ -14,6 +16,10 @@ from ptahcrowd.schemas import checkUsernameValidator
 from ptahcrowd.schemas import checkEmailValidator
 
 POPULATE_CREATE_ADMIN = 'ptah-crowd-admin'
+POPULATE_GROUP_MEMBERS = 'ptah-crowd-group-members'
+POPULATE_LOWER_INDEXES = 'ptah-crowd-lower-indexes'
+POPULATE_SEARCH_INDEX = 'ptah-crowd-search-index'
+POPULATE_AUTH_STORAGE = 'ptah-crowd-auth-storage'
 
 
 # ptahcrowd include
@@ -0,0 +1,322 @@
+""" negative lookup filter for logins """
+import os
+import math
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from hashlib import sha1
+
+import sqlalchemy as sqla
+from pyramid.events import ApplicationCreated
+
+import ptah
+from ptahcrowd.janitor import janitor_job
+from ptahcrowd.settings import CFG_ID_CROWD
+
+log = logging.getLogger('ptahcrowd')
+
+
+class BloomFilter(object):
+    """ Bloom filter sized for ``capacity`` items and ``error_rate``
+    false positive rate, bit array never exceeds ``max_bytes``. """
+
+    def __init__(self, capacity, error_rate=0.01, max_bytes=16*1024*1024):
+        capacity = max(capacity, 1)
+        bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        if max_bytes and bits > max_bytes * 8:
+            log.warning('Login filter memory limit, false positive rate '
+                        'is higher than configured.')
+            bits = max_bytes * 8
+
+        self.size = max(bits, 64)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, h1 + i * h2
+        digest = sha1(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class LoginChange(ptah.get_base()):
+    """ Changed username or email, login filters of all processes
+    check changes recorded after filter build """
+
+    __tablename__ = 'ptahcrowd_login_changes'
+
+    id = sqla.Column(sqla.Integer, primary_key=True)
+    login = sqla.Column(sqla.Unicode(255))
+    changed = sqla.Column(sqla.DateTime(), index=True)
+
+
+class LoginFilter(object):
+    """ Bloom filter of lower cased usernames and emails.
+
+    Filter is built in background thread on application start and
+    rebuilt every ``ttl`` seconds, logins are looked up in database
+    until filter is built. Filter records highest user id and login
+    change id, every ``tick`` seconds background thread adds users
+    and login changes added since then by primary key range lookup,
+    so users added or renamed in other processes can login within
+    ``tick`` seconds. Login which is not in filter is rejected without
+    database query. Filter which is not refreshed for ``2 * ttl``
+    seconds is not used. Deleted users stay in filter until rebuild,
+    that only costs database lookup.
+    """
+
+    tick = 10
+
+    def __init__(self, enabled=False, error_rate=0.01,
+                 max_bytes=16*1024*1024, ttl=300, timer=time.time):
+        self.lock = threading.Lock()
+        self.timer = timer
+        self.thread = None
+        self.pid = None
+        self.stopped = threading.Event()
+        self.configure(enabled, error_rate, max_bytes, ttl)
+
+    def configure(self, enabled, error_rate, max_bytes, ttl):
+        with self.lock:
+            self.enabled = enabled
+            self.error_rate = error_rate
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            # (bloom filter, build time, last user id, last change id,
+            #  refresh time)
+            self.snapshot = None
+            self.pending = None
+
+    @property
+    def filter(self):
+        snapshot = self.snapshot
+        return snapshot[0] if snapshot is not None else None
+
+    def needs_rebuild(self):
+        snapshot = self.snapshot
+        return snapshot is None or \
+            (self.ttl > 0 and snapshot[1] + self.ttl < self.timer())
+
+    def build(self, conn=None):
+        """ build filter by streaming users table """
+        from ptahcrowd.provider import CrowdUser
+
+        with self.lock:
+            if self.pending is not None:
+                return False
+            self.pending = []
+
+        users = CrowdUser.__table__
+        changes = LoginChange.__table__
+        try:
+            if conn is None:
+                conn = ptah.get_base().metadata.bind.connect()
+                close = True
+            else:
+                close = False
+
+            try:
+                # rows added during build are above recorded ids
+                built = self.timer()
+                user_id = conn.execute(
+                    sqla.select([sqla.func.max(users.c.id)])).scalar() or 0
+                change_id = conn.execute(
+                    sqla.select([sqla.func.max(changes.c.id)])).scalar() or 0
+                count = conn.execute(
+                    sqla.select([sqla.func.count()]).select_from(users))\
+                    .scalar()
+
+                bloom = BloomFilter(
+                    # two keys per user, room to grow until rebuild
+                    int(count * 2 * 1.25) + 1000,
+                    self.error_rate, self.max_bytes)
+
+                rows = conn.execution_options(stream_results=True).execute(
+                    sqla.select([users.c.username, users.c.email]))
+                for username, email in rows:
+                    if username:
+                        bloom.add(username.lower())
+                    if email:
+                        bloom.add(email.lower())
+            finally:
+                if close:
+                    conn.close()
+        except:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            for key in self.pending:
+                bloom.add(key)
+            self.pending = None
+            self.snapshot = (bloom, built, user_id, change_id, built)
+        return True
+
+    def refresh(self, conn=None):
+        """ add users and login changes added after last build or
+        refresh, return number of added rows """
+        from ptahcrowd.provider import CrowdUser
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            return 0
+
+        bloom, built, user_id, change_id, refreshed = snapshot
+        users = CrowdUser.__table__
+        changes = LoginChange.__table__
+
+        if conn is None:
+            conn = ptah.get_base().metadata.bind.connect()
+            close = True
+        else:
+            close = False
+
+        try:
+            refreshed = self.timer()
+            keys = []
+            for id, username, email in conn.execute(
+                    sqla.select([users.c.id, users.c.username, users.c.email])
+                    .where(users.c.id > user_id).order_by(users.c.id)):
+                keys.extend((username, email))
+                user_id = id
+
+            for id, login in conn.execute(
+                    sqla.select([changes.c.id, changes.c.login])
+                    .where(changes.c.id > change_id).order_by(changes.c.id)):
+                keys.append(login)
+                change_id = id
+        finally:
+            if close:
+                conn.close()
+
+        self.add(*keys)
+        with self.lock:
+            # filter could be rebuilt meanwhile
+            if self.snapshot is snapshot:
+                self.snapshot = (
+                    bloom, built, user_id, change_id, refreshed)
+        return len(keys)
+
+    def add(self, *keys):
+        """ add keys of users added or renamed in current process """
+        with self.lock:
+            bloom = self.filter
+            for key in keys:
+                if key:
+                    key = key.lower()
+                    if bloom is not None:
+                        bloom.add(key)
+                    if self.pending is not None:
+                        self.pending.append(key)
+
+    def changed(self, conn, *keys):
+        """ add keys and record them for filters of other processes """
+        self.add(*keys)
+
+        keys = [key.lower() for key in keys if key]
+        if self.enabled and keys:
+            now = datetime.utcnow()
+            conn.execute(LoginChange.__table__.insert(),
+                         [{'login': key, 'changed': now} for key in keys])
+
+    def might_exist(self, login):
+        """ False if login is not known, login has to be lower cased """
+        if not self.enabled:
+            return True
+
+        snapshot = self.snapshot
+        if snapshot is None or \
+                (self.ttl > 0 and snapshot[4] + 2*self.ttl < self.timer()):
+            return True
+
+        return login in snapshot[0]
+
+    def start(self):
+        with self.lock:
+            if not self.enabled:
+                return False
+            if self.thread is not None and self.pid == os.getpid() \
+                    and self.thread.is_alive():
+                return False
+
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(
+                target=self.run, name='ptahcrowd-login-filter')
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopped.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.needs_rebuild():
+                    self.build()
+                else:
+                    self.refresh()
+            except Exception:
+                log.exception('Login filter build failed')
+            self.stopped.wait(self.tick)
+
+
+login_filter = LoginFilter()
+
+
+def purge_login_changes_batch(conn, batch_size, now=None):
+    """ remove at most ``batch_size`` login changes older than
+    any usable login filter """
+    table = LoginChange.__table__
+    if now is None:
+        now = datetime.utcnow()
+
+    before = now - timedelta(seconds=4*login_filter.ttl)
+    ids = [id for id, in conn.execute(
+        sqla.select([table.c.id]).where(table.c.changed < before)
+        .order_by(table.c.changed).limit(batch_size))]
+    if ids:
+        conn.execute(table.delete().where(table.c.id.in_(ids)))
+    return len(ids)
+
+
+@janitor_job('login-changes-purge')
+def purge_login_changes(engine, batch_size):
+    # without rebuild filter may use any change
+    if not login_filter.ttl:
+        return 0
+
+    with engine.begin() as conn:
+        return purge_login_changes_batch(conn, batch_size)
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    cfg = ptah.get_settings(CFG_ID_CROWD, ev.registry)
+    login_filter.configure(
+        cfg['login-filter'], 1.0 / max(cfg['login-filter-fp-rate'], 2),
+        cfg['login-filter-memory'] * 1024, cfg['login-filter-ttl'])
+
+
+@ptah.subscriber(ApplicationCreated)
+def start_login_filter(ev):
+    login_filter.start()
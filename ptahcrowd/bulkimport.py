@@ -0,0 +1,287 @@
+""" bulk users import """
+import io
+import re
+import csv
+import json
+import logging
+from datetime import datetime
+from concurrent import futures
+import sqlalchemy as sqla
+
+import ptah
+from ptahcrowd.bloom import login_filter
+from ptahcrowd.cache import row_counter
+from ptahcrowd.hashing import get_password_manager
+from ptahcrowd.provider import CrowdUser
+from ptahcrowd.schemas import lower
+
+log = logging.getLogger('ptahcrowd')
+
+IMPORT_FIELDS = ('username', 'email', 'fullname',
+                 'password', 'validated', 'suspended')
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+
+
+def text_stream(fp):
+    if isinstance(fp.read(0), bytes):
+        fp = io.TextIOWrapper(fp, 'utf-8-sig', newline='')
+    return fp
+
+
+def read_csv(fp):
+    """ yield (line, row) from csv with header """
+    reader = csv.DictReader(text_stream(fp))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_jsonl(fp):
+    """ yield (line, row) from json lines """
+    for line, data in enumerate(text_stream(fp), 1):
+        data = data.strip()
+        if not data:
+            continue
+        try:
+            row = json.loads(data)
+        except ValueError:
+            row = None
+        yield line, row
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+class ImportReport(object):
+    """ Import result
+
+    ``total``: number of processed rows.
+
+    ``created``: number of created users, in dry run mode
+    number of valid rows.
+
+    ``errors``: list of (line, message), first ``max_errors`` errors.
+    """
+
+    max_errors = 1000
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.total = 0
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, message))
+
+
+class UserImporter(object):
+    """ Streaming users importer.
+
+    Rows are validated in chunks of ``chunk_size``: one query per chunk
+    checks username and email uniqueness, passwords are hashed in
+    process pool and users are inserted with single bulk statement.
+    Invalid rows are reported, valid rows are imported.
+    """
+
+    def __init__(self, chunk_size=1000, dry_run=False, workers=None):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.workers = workers
+
+    def __call__(self, rows):
+        """ import iterable of (line, row dict), return report """
+        report = ImportReport(self.dry_run)
+        self.usernames = set()
+        self.emails = set()
+
+        pool = None
+        if not self.dry_run:
+            try:
+                pool = futures.ProcessPoolExecutor(self.workers)
+            except (ImportError, NotImplementedError, OSError):
+                log.warning('Process pool is not available, '
+                            'hashing passwords in current process.')
+
+        try:
+            chunk = []
+            for line, row in rows:
+                report.total += 1
+                chunk.append((line, row))
+                if len(chunk) >= self.chunk_size:
+                    self.import_chunk(chunk, report, pool)
+                    chunk = []
+
+            if chunk:
+                self.import_chunk(chunk, report, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if report.created and not self.dry_run:
+            row_counter.invalidate(CrowdUser)
+
+        return report
+
+    def validate(self, row):
+        """ return (data, error message) """
+        if not isinstance(row, dict):
+            return None, 'Wrong row format.'
+
+        data = dict((name, row.get(name)) for name in IMPORT_FIELDS)
+        for name in ('username', 'email', 'fullname', 'password'):
+            value = data[name]
+            if value is not None and not isinstance(value, str):
+                value = str(value)
+            data[name] = value.strip() if value else None
+
+        data['username'] = lower(data['username'])
+        data['email'] = lower(data['email'])
+        data['validated'] = to_bool(data['validated'])
+        data['suspended'] = to_bool(data['suspended'])
+
+        if not data['username']:
+            return None, 'Username is required.'
+        if not data['email'] or not EMAIL_RE.match(data['email']):
+            return None, 'Invalid email address.'
+        if data['username'] in self.usernames:
+            return None, 'Duplicate username "%s".' % data['username']
+        if data['email'] in self.emails:
+            return None, 'Duplicate email "%s".' % data['email']
+
+        if data['password']:
+            error = ptah.pwd_tool.validate(data['password'])
+            if error is not None:
+                return None, str(error)
+
+        return data, None
+
+    def import_chunk(self, chunk, report, pool=None):
+        valid = []
+        for line, row in chunk:
+            data, error = self.validate(row)
+            if error is not None:
+                report.error(line, error)
+                continue
+
+            self.usernames.add(data['username'])
+            self.emails.add(data['email'])
+            valid.append((line, data))
+
+        if not valid:
+            return
+
+        # one query for existing usernames and emails
+        session = ptah.get_session()
+        usernames = [data['username'] for line, data in valid]
+        emails = [data['email'] for line, data in valid]
+        existing = session.query(CrowdUser.username, CrowdUser.email).filter(
+            sqla.sql.or_(sqla.func.lower(CrowdUser.username).in_(usernames),
+                         sqla.func.lower(CrowdUser.email).in_(emails))).all()
+        taken = set()
+        for username, email in existing:
+            taken.add(lower(username))
+            taken.add(lower(email))
+
+        rows = []
+        for line, data in valid:
+            if data['username'] in taken:
+                report.error(line, 'Username "%s" is already in use.' %
+                             data['username'])
+            elif data['email'] in taken:
+                report.error(line, 'Email "%s" is already in use.' %
+                             data['email'])
+            else:
+                rows.append((line, data))
+
+        if self.dry_run:
+            report.created += len(rows)
+            return
+
+        self.hash_passwords([data for line, data in rows], pool)
+        self.insert(rows, report)
+
+    def hash_passwords(self, rows, pool=None):
+        manager = get_password_manager()
+        rows = [data for data in rows if data['password']]
+        passwords = [data['password'] for data in rows]
+        if pool is not None:
+            encoded = pool.map(manager.encode, passwords,
+                               chunksize=max(len(passwords) // 16, 1))
+        else:
+            encoded = map(manager.encode, passwords)
+
+        for data, password in zip(rows, encoded):
+            if isinstance(password, bytes):
+                password = password.decode('ascii')
+            data['password'] = password
+
+    def insert(self, rows, report):
+        if not rows:
+            return
+
+        session = ptah.get_session()
+        table = CrowdUser.__table__
+        joined = datetime.utcnow()
+        for line, data in rows:
+            data['joined'] = joined
+            data['properties'] = {}
+
+        try:
+            with session.begin_nested():
+                session.execute(table.insert(), [data for line, data in rows])
+            created = rows
+        except sqla.exc.IntegrityError:
+            # concurrent changes, insert rows one by one
+            created = []
+            for line, data in rows:
+                try:
+                    with session.begin_nested():
+                        session.execute(table.insert(), data)
+                    created.append((line, data))
+                except sqla.exc.IntegrityError:
+                    report.error(line, 'Username or email is already in use.')
+
+        report.created += len(created)
+        self.index([data['username'] for line, data in created])
+
+    def index(self, usernames):
+        """ update search index and login filter, bulk insert
+        does not fire mapper events """
+        from ptahcrowd.search import get_search_backend, NgramBackend
+
+        if not usernames:
+            return
+
+        session = ptah.get_session()
+        users = session.query(
+            CrowdUser.id, CrowdUser.username,
+            CrowdUser.email, CrowdUser.fullname).filter(
+                sqla.func.lower(CrowdUser.username).in_(usernames)).all()
+
+        conn = session.connection()
+        backend = get_search_backend(conn)
+        for user in users:
+            login_filter.add(user.username, user.email)
+            if isinstance(backend, NgramBackend):
+                backend.index(conn, user)
+
+
+def import_users(fp, format='csv', dry_run=False, chunk_size=1000,
+                 workers=None):
+    """ import users from csv or json lines file, csv file has to have
+    header row, fields: username, email, fullname, password, validated,
+    suspended. Return :py:class:`ImportReport` """
+    rows = READERS[format](fp)
+    return UserImporter(chunk_size, dry_run, workers)(rows)
@@ -0,0 +1,210 @@
+""" process wide caches """
+import time
+import threading
+from collections import OrderedDict
+import sqlalchemy as sqla
+
+import ptah
+from ptahcrowd.settings import CFG_ID_CROWD
+
+
+class LRUCache(object):
+    """ Bounded thread safe LRU cache with entries time to live.
+
+    ``size``: maximum number of entries.
+
+    ``ttl``: entry time to live in seconds, ``0`` disables cache.
+    """
+
+    def __init__(self, size=1000, ttl=60, timer=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.timer = timer
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def configure(self, size, ttl):
+        with self.lock:
+            self.size = size
+            self.ttl = ttl
+            self.data.clear()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return default
+
+            if expires < self.timer():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+
+        with self.lock:
+            self.data[key] = (self.timer() + self.ttl, value)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def update(self, key, func):
+        """ replace value of existing entry with ``func(value)``,
+        entry keeps its expiration time """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                expires, value = entry
+                self.data[key] = (expires, func(value))
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class RolesCache(object):
+    """ Crowd principal roles cache, keyed by uid.
+
+    Entry is context independent ``(roles, groups)`` of principal,
+    group local roles depend on context and its parents, they are
+    resolved with request scoped memo.
+
+    Each entry is stored with principal version, version is changed
+    on invalidation, so results computed before invalidation
+    are never stored.
+    """
+
+    def __init__(self, size=10000, ttl=60):
+        self.data = LRUCache(size, ttl)
+        self.lock = threading.Lock()
+        self.version = 0
+        self.versions = {}
+
+    def configure(self, size, ttl):
+        self.data.configure(size, ttl)
+        self.invalidate()
+
+    def get_version(self, uid):
+        return (self.version, self.versions.get(uid, 0))
+
+    def get(self, uid):
+        entry = self.data.get(uid)
+        if entry is not None and entry[0] == self.get_version(uid):
+            return entry[1]
+
+    def set(self, uid, version, data):
+        if version == self.get_version(uid):
+            self.data.set(uid, (version, data))
+
+    def invalidate(self, uid=None):
+        """ invalidate principal roles, or all roles if uid is None """
+        with self.lock:
+            if uid is None or len(self.versions) >= self.data.size:
+                self.version += 1
+                self.versions = {}
+                self.data.clear()
+            else:
+                self.versions[uid] = self.versions.get(uid, 0) + 1
+
+
+roles_cache = RolesCache()
+
+
+class RowCounter(object):
+    """ Cached table row counts.
+
+    Tables with more than ``approximate`` rows (by database statistics)
+    are not counted exactly.
+    """
+
+    def __init__(self, ttl=30, approximate=100000):
+        self.data = LRUCache(64, ttl)
+        self.approximate = approximate
+
+    def configure(self, ttl, approximate):
+        self.data.configure(64, ttl)
+        self.approximate = approximate
+
+    def estimate(self, session, table):
+        """ return estimated number of rows or None """
+        conn = session.connection()
+        if conn.dialect.name == 'postgresql':
+            value = conn.execute(sqla.text(
+                'SELECT reltuples FROM pg_class WHERE relname=:name'),
+                {'name': table.name}).scalar()
+            if value is not None and value >= 0:
+                return int(value)
+
+    def count(self, model):
+        """ return (count, exact) """
+        table = model.__table__
+        result = self.data.get(table.name)
+        if result is None:
+            session = ptah.get_session()
+            estimate = self.estimate(session, table)
+            if self.approximate and estimate is not None and \
+                    estimate >= self.approximate:
+                result = (estimate, False)
+            else:
+                result = (session.query(sqla.func.count())\
+                              .select_from(table).scalar(), True)
+            self.data.set(table.name, result)
+
+        return result
+
+    def bump(self, model, delta):
+        """ adjust cached count """
+        self.data.update(
+            model.__table__.name,
+            lambda value: (max(value[0] + delta, 0), value[1]))
+
+    def invalidate(self, model=None):
+        if model is None:
+            self.data.clear()
+        else:
+            self.data.delete(model.__table__.name)
+
+
+row_counter = RowCounter()
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    cfg = ptah.get_settings(CFG_ID_CROWD, ev.registry)
+    roles_cache.configure(cfg['roles-cache-size'], cfg['roles-cache-ttl'])
+    row_counter.configure(cfg['count-cache-ttl'], cfg['count-approximate'])
+
+
+@ptah.subscriber(ptah.events.PrincipalEvent)
+def principal_changed(ev):
+    roles_cache.invalidate(getattr(ev.principal, '__uri__', None))
+
+
+@ptah.subscriber(ptah.events.PrincipalAddedEvent)
+@ptah.subscriber(ptah.events.PrincipalRegisteredEvent)
+def principal_added(ev):
+    from ptahcrowd.provider import CrowdUser
+
+    if isinstance(ev.principal, CrowdUser):
+        row_counter.bump(CrowdUser, 1)
+
+
+@ptah.subscriber(ptah.events.UriInvalidateEvent)
+def uri_invalidated(ev):
+    if ptah.extract_uri_schema(ev.uri) == 'ptah-crowd-group':
+        roles_cache.invalidate()
+    else:
+        roles_cache.invalidate(ev.uri)
@@ -0,0 +1,62 @@
+""" ptahcrowd-calibrate command, recommends pbkdf2 iterations """
+import sys
+import time
+import argparse
+
+from ptahcrowd.hashing import PBKDF2PasswordManager
+
+
+def measure(iterations, rounds=3, timer=time.perf_counter):
+    """ best password check time in seconds """
+    manager = PBKDF2PasswordManager(iterations)
+    encoded = manager.encode('calibration-password')
+
+    best = None
+    for i in range(rounds):
+        start = timer()
+        manager.check(encoded, 'calibration-password')
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def calibrate(target, start=10000, rounds=3, measure=measure):
+    """ return (iterations, seconds) for target check time in seconds """
+    iterations = start
+    elapsed = measure(iterations, rounds)
+
+    # scale until measurement is long enough to be reliable
+    while elapsed < target / 4.0:
+        iterations *= 2
+        elapsed = measure(iterations, rounds)
+
+    iterations = max(int(iterations * target / elapsed) // 1000 * 1000, 1000)
+    return iterations, measure(iterations, rounds)
+
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = argparse.ArgumentParser(
+        prog='ptahcrowd-calibrate',
+        description='Recommend pbkdf2 iterations for target login time.')
+    parser.add_argument(
+        '--target', type=float, default=250.0,
+        help='target password check time in milliseconds (default: 250)')
+    parser.add_argument(
+        '--rounds', type=int, default=3,
+        help='measurements per step (default: 3)')
+
+    args = parser.parse_args(argv[1:])
+
+    iterations, elapsed = calibrate(args.target / 1000.0, rounds=args.rounds)
+
+    out.write('Password check: %.1f ms with %d iterations\n' % (
+        elapsed * 1000, iterations))
+    out.write('Logins per core: %.1f per second\n' % (1.0 / elapsed))
+    out.write('\nRecommended settings:\n\n')
+    out.write('  ptah_crowd.pwd-manager = pbkdf2\n')
+    out.write('  ptah_crowd.pwd-iterations = %d\n' % iterations)
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
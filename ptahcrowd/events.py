@@ -0,0 +1,20 @@
+""" crowd events """
+import ptah
+
+
+@ptah.event('Crowd users changed event')
+class UsersChangedEvent(object):
+    """ Bulk action has changed crowd users, event is sent
+    for each batch of changed users.
+
+    ``action``: bulk action name, e.g. `suspend` or `remove`.
+
+    ``ids``: changed user ids.
+
+    ``values``: changed columns, empty for removed users.
+    """
+
+    def __init__(self, action, ids, values=None):
+        self.action = action
+        self.ids = ids
+        self.values = values or {}
@@ -0,0 +1,131 @@
+""" streaming users export """
+import io
+import csv
+import json
+from pyramid.view import view_config
+from pyramid.response import Response
+
+import ptah
+from ptahcrowd.module import CrowdModule
+from ptahcrowd.provider import CrowdUser
+from ptahcrowd.providers import Storage
+from ptahcrowd.search import users_clause
+
+EXPORT_FIELDS = ('id', 'username', 'email', 'fullname',
+                 'validated', 'suspended', 'joined', 'providers')
+
+
+def get_flag(params, name):
+    """ `1`/`0` request parameter as True/False, None if not set """
+    value = params.get(name)
+    if value in ('1', 'true'):
+        return True
+    if value in ('0', 'false'):
+        return False
+
+
+def iter_users(clause, batch_size=1000):
+    """ yield lists of user dicts, external providers are loaded
+    per batch. Rows are streamed with server side cursor
+    in separate session. """
+    session = ptah.get_session_maker()()
+    try:
+        q = session.query(
+            CrowdUser.id, CrowdUser.username, CrowdUser.email,
+            CrowdUser.fullname, CrowdUser.validated,
+            CrowdUser.suspended, CrowdUser.joined)\
+            .filter(clause).order_by(CrowdUser.id)\
+            .execution_options(stream_results=True).yield_per(batch_size)
+
+        prefix = CrowdUser.__type__.name
+        batch = []
+        for row in q:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield _load_batch(session, prefix, batch)
+                batch = []
+
+        if batch:
+            yield _load_batch(session, prefix, batch)
+    finally:
+        session.close()
+
+
+def _load_batch(session, prefix, rows):
+    users = []
+    uris = {}
+    for row in rows:
+        user = {'id': row.id,
+                'username': row.username,
+                'email': row.email,
+                'fullname': row.fullname,
+                'validated': bool(row.validated),
+                'suspended': bool(row.suspended),
+                'joined': row.joined.isoformat() if row.joined else None,
+                'providers': []}
+        uris['%s:%s' % (prefix, row.id)] = user
+        users.append(user)
+
+    for uri, domain in session.query(Storage.uri, Storage.domain)\
+            .filter(Storage.uri.in_(list(uris.keys()))):
+        uris[uri]['providers'].append(domain)
+
+    return users
+
+
+def csv_export(batches):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    yield buf.getvalue().encode('utf-8')
+
+    for users in batches:
+        buf.seek(0)
+        buf.truncate()
+        for user in users:
+            writer.writerow(
+                [' '.join(user[name]) if name == 'providers' else
+                 ('' if user[name] is None else user[name])
+                 for name in EXPORT_FIELDS])
+        yield buf.getvalue().encode('utf-8')
+
+
+def jsonl_export(batches):
+    for users in batches:
+        yield ''.join(
+            '%s\n' % json.dumps(user, sort_keys=True)
+            for user in users).encode('utf-8')
+
+
+EXPORTERS = {
+    'csv': (csv_export, 'text/csv'),
+    'jsonl': (jsonl_export, 'application/x-ndjson'),
+}
+
+
+def export_users(request, format):
+    """ export users matching current search term and
+    `validated`/`suspended` request parameters """
+    exporter, content_type = EXPORTERS[format]
+
+    clause = users_clause(
+        request.session.get('ptah-search-term', ''),
+        get_flag(request.params, 'validated'),
+        get_flag(request.params, 'suspended'))
+
+    response = Response(
+        content_type=content_type, charset='utf-8',
+        app_iter=exporter(iter_users(clause)))
+    response.content_disposition = \
+        'attachment; filename="users.%s"' % format
+    return response
+
+
+@view_config(name='export.csv', context=CrowdModule)
+def export_csv(context, request):
+    return export_users(request, 'csv')
+
+
+@view_config(name='export.jsonl', context=CrowdModule)
+def export_jsonl(context, request):
+    return export_users(request, 'jsonl')
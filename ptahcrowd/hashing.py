@@ -0,0 +1,269 @@
+""" password hashing executor """
+import os
+import hmac
+import logging
+import hashlib
+import threading
+from base64 import b64encode, b64decode
+from concurrent import futures
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+import ptah
+from ptah.password import ID_PASSWORD_CHANGER
+from ptahcrowd.settings import CFG_ID_CROWD
+
+log = logging.getLogger('ptahcrowd')
+
+
+class HashingBusy(HTTPServiceUnavailable):
+    """ Hashing queue is full or hashing took too long """
+
+
+class HashingExecutor(object):
+    """ Bounded executor for password hashing.
+
+    ``kind``: `process`, `thread` or empty string for inline hashing.
+
+    ``workers``: number of workers.
+
+    ``queue``: number of waiting hash operations.
+
+    ``timeout``: seconds to wait for queue slot and for result.
+    """
+
+    def __init__(self, kind='', workers=2, queue=16, timeout=10):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.configure(kind, workers, queue, timeout)
+
+    def configure(self, kind, workers, queue, timeout):
+        self.shutdown()
+
+        self.kind = kind
+        self.workers = max(workers, 1)
+        self.queue = max(queue, 0)
+        self.timeout = timeout or None
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def get_executor(self):
+        # pools are not inherited by forked worker processes
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.executor = None
+                if self.kind == 'process':
+                    try:
+                        self.executor = futures.ProcessPoolExecutor(
+                            self.workers)
+                    except (ImportError, NotImplementedError, OSError):
+                        log.warning('Process pool is not available, '
+                                    'using threads for password hashing.')
+                if self.executor is None:
+                    self.executor = futures.ThreadPoolExecutor(self.workers)
+
+            return self.executor
+
+    def __call__(self, func, *args):
+        if not self.kind:
+            return func(*args)
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise HashingBusy('Password hashing queue is full.')
+
+        try:
+            future = self.get_executor().submit(func, *args)
+        except:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise HashingBusy('Password hashing timeout.')
+
+
+executor = HashingExecutor()
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    cfg = ptah.get_settings(CFG_ID_CROWD, ev.registry)
+    executor.configure(cfg['hash-executor'], cfg['hash-workers'],
+                       cfg['hash-queue'], cfg['hash-timeout'])
+
+
+class PBKDF2PasswordManager(object):
+    """ PBKDF2-SHA256 password manager with configurable cost,
+    encoded as ``{pbkdf2}iterations$salt$hash`` """
+
+    prefix = '{pbkdf2}'
+
+    def __init__(self, iterations=100000):
+        self.iterations = iterations
+
+    def _hash(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac(
+            'sha256', password.encode('utf-8'), salt, iterations)
+
+    def encode(self, password, salt=None):
+        if salt is None:
+            salt = os.urandom(16)
+        return '%s%d$%s$%s' % (
+            self.prefix, self.iterations, b64encode(salt).decode('ascii'),
+            b64encode(self._hash(password, salt, self.iterations))\
+                .decode('ascii'))
+
+    def parse(self, encoded):
+        """ return (iterations, salt, hash) """
+        iterations, salt, hash = encoded[len(self.prefix):].split('$')
+        return int(iterations), b64decode(salt), b64decode(hash)
+
+    def check(self, encoded, password):
+        try:
+            iterations, salt, hash = self.parse(encoded)
+        except (TypeError, ValueError):
+            return False
+        return hmac.compare_digest(
+            self._hash(password, salt, iterations), hash)
+
+
+pbkdf2 = PBKDF2PasswordManager()
+ptah.pwd_tool.pm[pbkdf2.prefix] = pbkdf2
+
+
+def get_password_manager(registry=None):
+    """ password manager for new hashes, `pwd-manager` setting
+    or ptah password manager """
+    cfg = ptah.get_settings(CFG_ID_CROWD, registry)
+    if cfg['pwd-manager'] == 'pbkdf2':
+        return PBKDF2PasswordManager(cfg['pwd-iterations'])
+    return ptah.pwd_tool.manager
+
+
+def needs_rehash(encoded, registry=None):
+    """ check if password is encoded with outdated manager or cost """
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode('ascii')
+
+    manager = get_password_manager(registry)
+    if isinstance(manager, PBKDF2PasswordManager):
+        if not encoded or not encoded.startswith(manager.prefix):
+            return True
+        try:
+            return manager.parse(encoded)[0] != manager.iterations
+        except (TypeError, ValueError):
+            return True
+
+    for prefix, pm in ptah.pwd_tool.pm.items():
+        if pm is manager:
+            return not encoded or not encoded.startswith(prefix)
+    return False
+
+
+def encode_password(password):
+    """ encode password with current password manager """
+    # manager depends on settings, it is resolved in current process
+    return executor(get_password_manager().encode, password)
+
+
+def change_password(principal, password):
+    """ encode password with :py:func:`encode_password` and set it with
+    registered :py:class:`ptah.password_changer`, return True if
+    password has been changed """
+    changers = ptah.get_cfg_storage(ID_PASSWORD_CHANGER)
+    changer = changers.get(ptah.extract_uri_schema(principal.__uri__))
+    if changer is None:
+        return False
+
+    changer(principal, encode_password(password))
+    return True
+
+
+def check_password(encoded, password):
+    """ compare encoded password with plain password,
+    see :py:meth:`ptah.password.PasswordTool.check` """
+    if not encoded:
+        return False
+
+    pwd_tool = ptah.pwd_tool
+    try:
+        pm, pwd = encoded.split('}', 1)
+    except (AttributeError, ValueError):
+        manager = pwd_tool.manager
+    else:
+        manager = pwd_tool.pm.get('%s}' % pm)
+        if manager is None:
+            return False
+
+    return executor(manager.check, encoded, password)
+
+
+class PasswordUpgrader(object):
+    """ Rehash outdated passwords after successful login.
+
+    Upgrades run in background thread, concurrent logins of same user
+    are coalesced into one upgrade, password is replaced only
+    if it is not changed since login.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.worker = None
+        self.pid = None
+
+    def get_worker(self):
+        with self.lock:
+            if self.worker is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.worker = futures.ThreadPoolExecutor(1)
+            return self.worker
+
+    def __call__(self, user, password, mode='background'):
+        if mode == 'inline':
+            user.password = encode_password(password)
+            return True
+
+        with self.lock:
+            if user.id in self.pending:
+                return False
+            self.pending.add(user.id)
+
+        try:
+            self.get_worker().submit(
+                self.upgrade, user.id, user.password, password,
+                get_password_manager(), ptah.get_base().metadata.bind)
+        except:
+            self.done(user.id)
+            raise
+        return True
+
+    def done(self, id):
+        with self.lock:
+            self.pending.discard(id)
+
+    def upgrade(self, id, old, password, manager, engine):
+        from ptahcrowd.provider import CrowdUser
+
+        table = CrowdUser.__table__
+        try:
+            encoded = executor(manager.encode, password)
+            with engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.id == id) & (table.c.password == old)).values(
+                        password=encoded))
+        except Exception:
+            log.exception('Password upgrade failed for user %s', id)
+        finally:
+            self.done(id)
+
+
+upgrade_password = PasswordUpgrader()
@@ -0,0 +1,145 @@
+""" background maintenance jobs """
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from pyramid.events import ApplicationCreated
+
+import ptah
+from ptahcrowd.settings import CFG_ID_CROWD
+
+log = logging.getLogger('ptahcrowd')
+
+
+class Job(object):
+    """ Maintenance job.
+
+    ``func``: callable ``func(engine, batch_size)``, processes at most
+    ``batch_size`` rows in own transaction and returns number
+    of processed rows.
+
+    ``interval``: seconds between runs.
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = 0
+
+
+class Janitor(object):
+    """ Runs maintenance jobs in background daemon thread.
+
+    Job runs batches while batches are full, at most ``max_batches``
+    per run, with ``pause`` seconds between batches, so each
+    transaction is short and does not hold locks for long.
+    """
+
+    tick = 10
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.enabled = False
+        self.batch_size = 500
+        self.max_batches = 100
+        self.pause = 0.1
+        self.thread = None
+        self.pid = None
+        self.stopped = threading.Event()
+
+    def add_job(self, name, func, interval=3600):
+        self.jobs[name] = Job(name, func, interval)
+
+    def configure(self, cfg):
+        self.enabled = cfg['janitor']
+        self.batch_size = cfg['janitor-batch']
+        for job in self.jobs.values():
+            job.interval = cfg['janitor-interval']
+
+    def run_job(self, job, engine):
+        """ run job batches, return number of processed rows """
+        total = 0
+        for idx in range(self.max_batches):
+            try:
+                count = job.func(engine, self.batch_size)
+            except Exception:
+                log.exception('Maintenance job "%s" failed', job.name)
+                break
+
+            total += count
+            if count < self.batch_size:
+                break
+            if self.pause:
+                self.stopped.wait(self.pause)
+
+        if total:
+            log.info('Maintenance job "%s" processed %s rows',
+                     job.name, total)
+        return total
+
+    def run_pending(self, engine=None):
+        """ run due jobs, return dict of job name and processed rows """
+        if engine is None:
+            engine = ptah.get_base().metadata.bind
+
+        results = {}
+        for job in list(self.jobs.values()):
+            now = self.timer()
+            if job.next_run > now:
+                continue
+            job.next_run = now + job.interval
+            results[job.name] = self.run_job(job, engine)
+        return results
+
+    def start(self):
+        with self.lock:
+            if not self.enabled or not self.jobs:
+                return False
+            if self.thread is not None and self.pid == os.getpid() \
+                    and self.thread.is_alive():
+                return False
+
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(
+                target=self.run, name='ptahcrowd-janitor')
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopped.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.run_pending()
+            self.stopped.wait(self.tick)
+
+
+janitor = Janitor()
+
+
+def janitor_job(name, interval=3600):
+    """ register maintenance job """
+    def wrapper(func):
+        janitor.add_job(name, func, interval)
+        return func
+    return wrapper
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    janitor.configure(ptah.get_settings(CFG_ID_CROWD, ev.registry))
+
+
+@ptah.subscriber(ApplicationCreated)
+def start_janitor(ev):
+    janitor.start()
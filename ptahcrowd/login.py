@@ -6,6 +6,7 @@ from pyramid.httpexceptions import HTTPFound
 
 import ptahcrowd
 from ptahcrowd import const
+from ptahcrowd.ratelimit import check_rate_limit
 from ptahcrowd.settings import _, CFG_ID_CROWD
 
 
@@ -54,6 +55,11 @@ class LoginForm(ptah.form.Form, ptah.View):
     def login_handler(self):
         request = self.request
 
+        limited = check_rate_limit(
+            request, 'login', user=request.POST.get('login'))
+        if limited is not None:
+            return limited
+
         data, errors = self.extract()
         if errors:
             self.add_error_message(errors)
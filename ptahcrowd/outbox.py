@@ -0,0 +1,384 @@
+""" durable outbound mail queue """
+import os
+import time
+import logging
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email import message_from_string
+from email.utils import getaddresses
+
+import transaction
+import sqlalchemy as sqla
+from pyramid.events import ApplicationCreated
+
+import ptah
+from ptahcrowd.janitor import janitor_job
+from ptahcrowd.settings import CFG_ID_CROWD
+
+log = logging.getLogger('ptahcrowd')
+
+
+class OutboxMessage(ptah.get_base()):
+    """ Queued outbound mail message
+
+    ``next_attempt``: time of next delivery attempt, `None` for messages
+    which could not be delivered in `mail-retries` attempts. Such dead
+    messages are removed by janitor after `mail-dead-ttl` seconds.
+    """
+
+    __tablename__ = 'ptahcrowd_outbox'
+
+    id = sqla.Column(sqla.Integer, primary_key=True)
+    sender = sqla.Column(sqla.Unicode(255))
+    recipients = sqla.Column(sqla.UnicodeText)
+    message = sqla.Column(sqla.UnicodeText)
+    created = sqla.Column(sqla.DateTime())
+    attempts = sqla.Column(sqla.Integer, default=0)
+    next_attempt = sqla.Column(sqla.DateTime(), index=True)
+    error = sqla.Column(sqla.UnicodeText, default='')
+
+
+class SMTPPool(object):
+    """ Pool of reusable SMTP connections.
+
+    At most ``size`` connections are open, idle connections are
+    reused for ``max_idle`` seconds.
+    """
+
+    def __init__(self, host='localhost', port=25, username='', password='',
+                 tls=False, size=2, timeout=10, max_idle=60,
+                 timer=time.time):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.tls = tls
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+
+    def connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.tls:
+                conn.starttls()
+            if self.username:
+                conn.login(self.username, self.password)
+        except:
+            self.close(conn)
+            raise
+        return conn
+
+    def acquire(self):
+        """ return idle connection or new connection """
+        with self.lock:
+            while self.idle:
+                conn, used = self.idle.pop()
+                if self.timer() - used < self.max_idle:
+                    return conn, True
+                self.close(conn)
+        return self.connect(), False
+
+    def release(self, conn):
+        with self.lock:
+            self.idle.append((conn, self.timer()))
+
+    def close(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, used in idle:
+            self.close(conn)
+
+    def send(self, sender, recipients, message):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise smtplib.SMTPException('SMTP pool is exhausted')
+        try:
+            conn, reused = self.acquire()
+            try:
+                try:
+                    conn.sendmail(sender, recipients, message)
+                except smtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # server closed idle connection
+                    conn.close()
+                    conn = self.connect()
+                    conn.sendmail(sender, recipients, message)
+            except:
+                self.close(conn)
+                raise
+            self.release(conn)
+        finally:
+            self.slots.release()
+
+
+class MailerTransport(object):
+    """ delivers messages with ptah `Mailer` """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def send(self, sender, recipients, message):
+        mailer = self.cfg.get('Mailer')
+        if mailer is not None:
+            msg = message_from_string(message)
+            mailer.send(sender, msg['to'], msg)
+
+    def close_all(self):
+        pass
+
+
+class Outbox(object):
+    """ Durable outbound mail queue with ptah mailer interface.
+
+    Messages are stored in ``ptahcrowd_outbox`` table within current
+    transaction and delivered by background worker. Failed deliveries
+    are retried with exponential backoff. If queue contains more than
+    ``limit`` messages, messages are sent synchronously.
+    """
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.enabled = False
+        self.limit = 10000
+        self.retries = 8
+        self.delay = 30
+        self.dead_ttl = 604800
+        self.max_delay = 3600
+        self.batch_size = 50
+        self.poll = 5
+        self.lease = 300
+        self.transport = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def configure(self, cfg, ptah_cfg):
+        if self.transport is not None:
+            self.transport.close_all()
+
+        self.enabled = cfg['mail-queue']
+        self.limit = cfg['mail-queue-limit']
+        self.retries = cfg['mail-retries']
+        self.delay = cfg['mail-retry-delay']
+        self.dead_ttl = cfg['mail-dead-ttl']
+
+        if cfg['mail-smtp-host']:
+            self.transport = SMTPPool(
+                cfg['mail-smtp-host'], cfg['mail-smtp-port'],
+                cfg['mail-smtp-username'], cfg['mail-smtp-password'],
+                cfg['mail-smtp-tls'], cfg['mail-smtp-pool'],
+                cfg['mail-smtp-timeout'])
+        else:
+            self.transport = MailerTransport(ptah_cfg)
+
+    def now(self):
+        return datetime.utcfromtimestamp(self.timer())
+
+    def is_full(self, session):
+        """ check if queue contains ``limit`` or more messages
+        waiting for delivery, dead messages are not counted """
+        if not self.limit:
+            return False
+        table = OutboxMessage.__table__
+        pending = sqla.select([table.c.id])\
+            .where(table.c.next_attempt.isnot(None))\
+            .limit(self.limit).alias()
+        return session.execute(
+            sqla.select([sqla.func.count()]).select_from(pending))\
+            .scalar() >= self.limit
+
+    def send(self, from_, to_, message):
+        """ queue message, ptah mailer interface """
+        session = ptah.get_session()
+        if self.is_full(session):
+            log.warning('Mail queue is full, sending message synchronously')
+            self.transport.send(
+                from_, [addr for name, addr in getaddresses([to_])],
+                message.as_string())
+            return
+
+        now = self.now()
+        session.add(OutboxMessage(
+            sender=from_, recipients=to_, message=message.as_string(),
+            created=now, attempts=0, next_attempt=now))
+
+        transaction.get().addAfterCommitHook(self.committed)
+
+    def committed(self, status):
+        if status:
+            self.wakeup.set()
+
+    def backoff(self, attempts):
+        """ seconds before next attempt """
+        return min(self.delay * 2 ** (attempts - 1), self.max_delay)
+
+    def claim(self, conn, now):
+        """ lease due messages to current worker, concurrent workers
+        skip messages claimed by others """
+        table = OutboxMessage.__table__
+        rows = conn.execute(
+            sqla.select([table.c.id, table.c.next_attempt])
+            .where(table.c.next_attempt <= now)
+            .order_by(table.c.next_attempt).limit(self.batch_size)).fetchall()
+
+        claimed = []
+        lease = now + timedelta(seconds=self.lease)
+        for id, next_attempt in rows:
+            res = conn.execute(
+                table.update().where(
+                    (table.c.id == id) &
+                    (table.c.next_attempt == next_attempt))
+                .values(next_attempt=lease))
+            if res.rowcount:
+                claimed.append(id)
+        return claimed
+
+    def deliver(self, engine=None):
+        """ send due messages, return number of sent messages """
+        if engine is None:
+            engine = ptah.get_base().metadata.bind
+
+        table = OutboxMessage.__table__
+        now = self.now()
+        with engine.begin() as conn:
+            ids = self.claim(conn, now)
+            if not ids:
+                return 0
+            messages = conn.execute(
+                sqla.select([table.c.id, table.c.sender, table.c.recipients,
+                             table.c.message, table.c.attempts])
+                .where(table.c.id.in_(ids)).order_by(table.c.id)).fetchall()
+
+        sent = 0
+        for msg in messages:
+            try:
+                self.transport.send(
+                    msg.sender,
+                    [addr for name, addr in getaddresses([msg.recipients])],
+                    msg.message)
+            except Exception as e:
+                self.failed(engine, msg, e)
+            else:
+                with engine.begin() as conn:
+                    conn.execute(table.delete().where(table.c.id == msg.id))
+                sent += 1
+
+        return sent
+
+    def failed(self, engine, msg, error):
+        attempts = msg.attempts + 1
+        if attempts >= self.retries:
+            log.error('Giving up mail delivery to %s after %s attempts: %s',
+                      msg.recipients, attempts, error)
+            next_attempt = None
+        else:
+            log.warning('Mail delivery to %s failed: %s', msg.recipients, error)
+            next_attempt = self.now() + timedelta(
+                seconds=self.backoff(attempts))
+
+        table = OutboxMessage.__table__
+        with engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id == msg.id).values(
+                attempts=attempts, next_attempt=next_attempt,
+                error=str(error)))
+
+    def start(self):
+        with self.lock:
+            if not self.enabled:
+                return False
+            if self.thread is not None and self.pid == os.getpid() \
+                    and self.thread.is_alive():
+                return False
+
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(
+                target=self.run, name='ptahcrowd-outbox')
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.thread = None
+        if self.transport is not None:
+            self.transport.close_all()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            try:
+                sent = self.deliver()
+            except Exception:
+                log.exception('Mail queue delivery failed')
+                sent = 0
+
+            if sent < self.batch_size:
+                self.wakeup.wait(self.poll)
+
+
+outbox = Outbox()
+
+
+def purge_dead_batch(conn, batch_size, now=None):
+    """ remove at most ``batch_size`` dead messages created
+    more than `mail-dead-ttl` seconds ago """
+    table = OutboxMessage.__table__
+    if now is None:
+        now = datetime.utcnow()
+
+    before = now - timedelta(seconds=outbox.dead_ttl)
+    ids = [id for id, in conn.execute(
+        sqla.select([table.c.id])
+        .where(sqla.and_(table.c.next_attempt.is_(None),
+                         table.c.created < before))
+        .order_by(table.c.id).limit(batch_size))]
+    if ids:
+        conn.execute(table.delete().where(table.c.id.in_(ids)))
+    return len(ids)
+
+
+@janitor_job('mail-outbox-purge')
+def purge_dead_messages(engine, batch_size):
+    # dead messages are kept forever
+    if not outbox.dead_ttl:
+        return 0
+
+    with engine.begin() as conn:
+        return purge_dead_batch(conn, batch_size)
+
+
+def get_mailer():
+    """ return mail queue if `mail-queue` is enabled, otherwise None,
+    so :py:meth:`ptah.mail.MailTemplate.send` uses ptah mailer """
+    if outbox.enabled:
+        return outbox
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    outbox.configure(ptah.get_settings(CFG_ID_CROWD, ev.registry),
+                     ptah.get_settings(ptah.CFG_ID_PTAH, ev.registry))
+
+
+@ptah.subscriber(ApplicationCreated)
+def start_outbox(ev):
+    outbox.start()
@@ -0,0 +1,106 @@
+""" keyset pagination """
+import json
+import base64
+import binascii
+from datetime import datetime
+
+import sqlalchemy as sqla
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_token(sort, values):
+    data = [sort, [v.strftime(DATETIME_FORMAT)
+                   if isinstance(v, datetime) else v for v in values]]
+    return base64.urlsafe_b64encode(
+        json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    """ return (sort, values), raise ValueError for broken token """
+    try:
+        sort, values = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (TypeError, binascii.Error, UnicodeError):
+        raise ValueError(token)
+
+    if not isinstance(values, list):
+        raise ValueError(token)
+    return sort, values
+
+
+class KeysetPagination(object):
+    """ cursor based pagination over indexed sort columns
+
+    ``sorts``: mapping of sort name to tuple of columns,
+    last column has to be unique.
+    """
+
+    def __init__(self, page_size, sorts, default):
+        self.page_size = page_size
+        self.sorts = sorts
+        self.default = default
+
+    def _values(self, item, columns):
+        return [getattr(item, col.key) for col in columns]
+
+    def _parse(self, columns, values):
+        if len(values) != len(columns):
+            raise ValueError(values)
+
+        result = []
+        for col, val in zip(columns, values):
+            if val is not None and isinstance(col.type, sqla.DateTime):
+                val = datetime.strptime(val, DATETIME_FORMAT)
+            result.append(val)
+        return result
+
+    def _after(self, columns, values, reverse=False):
+        # (a, b) > (x, y)  ==  a > x or (a == x and b > y)
+        clauses = []
+        for idx, col in enumerate(columns):
+            cmp = col < values[idx] if reverse else col > values[idx]
+            clauses.append(sqla.and_(*(
+                [c == v for c, v in zip(columns[:idx], values[:idx])]+[cmp])))
+        return sqla.or_(*clauses)
+
+    def __call__(self, query, sort=None, after=None, before=None):
+        """ return (items, sort, prev token, next token) """
+        if sort not in self.sorts:
+            sort = self.default
+
+        token = after or before
+        values = None
+        if token:
+            try:
+                sort, values = decode_token(token)
+                columns = self.sorts[sort]
+                values = self._parse(columns, values)
+            except (ValueError, KeyError):
+                sort, token, values = self.default, None, None
+
+        columns = self.sorts[sort]
+        backward = bool(values is not None and before and not after)
+
+        if values is not None:
+            query = query.filter(self._after(columns, values, backward))
+
+        if backward:
+            query = query.order_by(*[col.desc() for col in columns])
+        else:
+            query = query.order_by(*[col.asc() for col in columns])
+
+        items = query.limit(self.page_size + 1).all()
+        more = len(items) > self.page_size
+        items = items[:self.page_size]
+        if backward:
+            items.reverse()
+
+        prev = next = None
+        if items:
+            if (more if backward else values is not None):
+                prev = encode_token(sort, self._values(items[0], columns))
+            if (values is not None if backward else more):
+                next = encode_token(sort, self._values(items[-1], columns))
+
+        return items, sort, prev, next
@@ -1,7 +1,11 @@
 import logging
+import sqlalchemy as sqla
 import ptah
 import ptahcrowd
 from ptah.settings import SettingRecord
+from ptahcrowd.hashing import encode_password
+
+GROUP_MEMBERS_MIGRATED = 'ptahcrowd.group-members-migrated'
 
 
 @ptah.populate(ptahcrowd.POPULATE_CREATE_ADMIN,
@@ -22,8 +26,7 @@ def create_admin_user(registry):
         if user is not None:
             return
 
-    user = session.query(ptahcrowd.CrowdUser).\
-           filter(ptahcrowd.CrowdUser.username==crowd_cfg['admin-login']).first()
+    user = ptahcrowd.CrowdUser.get_byusername(crowd_cfg['admin-login'])
 
     if user is None:
         tinfo = ptahcrowd.get_user_type(registry)
@@ -37,7 +40,7 @@ def create_admin_user(registry):
             fullname=crowd_cfg['admin-name'],
             username=crowd_cfg['admin-login'],
             email=crowd_cfg['admin-email'])
-        user.password = ptah.pwd_tool.encode(crowd_cfg['admin-password'])
+        user.password = encode_password(crowd_cfg['admin-password'])
         user.validated = True
         user.suspended = False
 
@@ -48,3 +51,101 @@ def create_admin_user(registry):
 
         session.add(
             SettingRecord(name='ptahcrowd.admin-uri', value=user.__uri__))
+
+
+@ptah.populate(ptahcrowd.POPULATE_GROUP_MEMBERS,
+               title='Migrate crowd group membership',
+               requires=(ptah.POPULATE_DB_SCHEMA,))
+def migrate_group_members(registry, batch_size=500):
+    """ move `properties['groups']` of crowd users to
+    group membership table, users are processed in batches.
+    Completed migration is recorded, later runs do not scan users """
+    CrowdUser = ptahcrowd.CrowdUser
+    CrowdGroupMember = ptahcrowd.CrowdGroupMember
+
+    session = ptah.get_session()
+    log = logging.getLogger('ptahcrowd')
+
+    if session.query(SettingRecord).filter(
+            SettingRecord.name == GROUP_MEMBERS_MIGRATED).first() is not None:
+        return
+
+    last_id = 0
+    migrated = 0
+    while True:
+        users = session.query(CrowdUser).filter(
+            CrowdUser.id > last_id,
+            sqla.sql.cast(CrowdUser.properties, sqla.UnicodeText)\
+                .like('%"groups"%'))\
+            .order_by(CrowdUser.id).limit(batch_size).all()
+        if not users:
+            break
+
+        entries = list(users)
+        existing = set(
+            (uid, grp) for uid, grp in session.query(
+                CrowdGroupMember.user_id, CrowdGroupMember.group).filter(
+                    CrowdGroupMember.user_id.in_([u.id for u in users])))
+
+        for user in users:
+            if 'groups' not in user.properties:
+                continue
+
+            for grp in set(user.properties['groups']):
+                if (user.id, grp) in existing:
+                    continue
+                entry = CrowdGroupMember(user_id=user.id, group=grp)
+                session.add(entry)
+                entries.append(entry)
+
+            del user.properties['groups']
+            migrated += 1
+
+        last_id = users[-1].id
+
+        # keep session small
+        session.flush()
+        for entry in entries:
+            session.expunge(entry)
+
+    if migrated:
+        log.info("Migrated group membership of %s crowd users", migrated)
+
+    session.add(SettingRecord(name=GROUP_MEMBERS_MIGRATED, value='true'))
+
+
+@ptah.populate(ptahcrowd.POPULATE_LOWER_INDEXES,
+               title='Create crowd users, group and auth storage indexes',
+               requires=(ptah.POPULATE_DB_SCHEMA,))
+def create_login_indexes(registry):
+    """ create lower(), `joined` and auth storage indexes for tables
+    created before indexes were introduced """
+    from ptahcrowd.provider import create_lower_indexes
+    from ptahcrowd.provider import create_group_indexes
+    from ptahcrowd.provider import create_joined_index
+    from ptahcrowd.providers import create_storage_indexes
+    conn = ptah.get_session().connection()
+    create_lower_indexes(None, conn)
+    create_group_indexes(None, conn)
+    create_joined_index(conn)
+    create_storage_indexes(conn)
+
+
+@ptah.populate(ptahcrowd.POPULATE_AUTH_STORAGE,
+               title='Add crowd auth storage columns',
+               requires=(ptah.POPULATE_DB_SCHEMA,))
+def add_storage_columns(registry):
+    """ add `fetched` column to auth storage table created
+    before profile cache was introduced """
+    from ptahcrowd.providers import create_storage_columns
+    create_storage_columns(ptah.get_session().connection())
+
+
+@ptah.populate(ptahcrowd.POPULATE_SEARCH_INDEX,
+               title='Rebuild crowd users search index',
+               active=False,
+               requires=(ptah.POPULATE_DB_SCHEMA,))
+def rebuild_search_index(registry):
+    from ptahcrowd.search import install_backends, rebuild_index
+    install_backends(None, ptah.get_session().connection())
+    rebuild_index(registry)
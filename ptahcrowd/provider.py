@@ -1,6 +1,11 @@
+import logging
 import sqlalchemy as sqla
+from sqlalchemy.orm import attributes
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from datetime import datetime
 from pyramid.compat import text_type
+from pyramid.threadlocal import get_current_request, get_current_registry
 
 import ptah
 from ptah.password import passwordValidator
@@ -9,8 +14,15 @@ from ptahcrowd.schemas import lower
 from ptahcrowd.schemas import checkUsernameValidator
 from ptahcrowd.schemas import checkEmailValidator
 from ptahcrowd import const
+from ptahcrowd.bloom import login_filter
+from ptahcrowd.cache import roles_cache
+from ptahcrowd.events import UsersChangedEvent
+from ptahcrowd.hashing import check_password, needs_rehash
+from ptahcrowd.hashing import upgrade_password
 from ptahcrowd.settings import _
 
+log = logging.getLogger('ptahcrowd')
+
 CROWD_APP_ID = 'ptah-crowd'
 
 
@@ -51,7 +63,7 @@ class CrowdUser(ptah.get_base()):
         'preparer': lower,
         'validator': ptah.form.All(ptah.form.Email(), checkEmailValidator),
     })
-    joined = sqla.Column(sqla.DateTime(), info={'skip': True})
+    joined = sqla.Column(sqla.DateTime(), index=True, info={'skip': True})
     password = sqla.Column(sqla.Unicode(255), info={
         'title': const.PASSWORD_TITLE,
         'description': const.PASSWORD_DESCR,
@@ -97,6 +109,91 @@ class CrowdUser(ptah.get_base()):
     def get_byid(cls, id):
         return cls._sql_get_id.first(id=id)
 
+    _sql_get_username = ptah.QueryFreezer(
+        lambda: ptah.get_session().query(CrowdUser)\
+            .filter(sqla.func.lower(CrowdUser.username)==
+                    sqla.sql.bindparam('username')))
+
+    _sql_get_email = ptah.QueryFreezer(
+        lambda: ptah.get_session().query(CrowdUser)\
+            .filter(sqla.func.lower(CrowdUser.email)==
+                    sqla.sql.bindparam('email')))
+
+    @classmethod
+    def get_byusername(cls, username):
+        """ case insensitive lookup by username """
+        return cls._sql_get_username.first(username=lower(username))
+
+    @classmethod
+    def get_byemail(cls, email):
+        """ case insensitive lookup by email """
+        return cls._sql_get_email.first(email=lower(email))
+
+
+LOWER_INDEXES = (
+    ('ix_ptahcrowd_users_username_lower', 'username'),
+    ('ix_ptahcrowd_users_email_lower', 'email'),
+)
+
+
+def get_lower_duplicates(bind, column, limit=20):
+    """ return values of ``column`` used by several users
+    with different case """
+    value = sqla.func.lower(CrowdUser.__table__.c[column])
+    return [row[0] for row in bind.execute(
+        sqla.select([value]).where(value != '')
+        .group_by(value).having(sqla.func.count() > 1)
+        .order_by(value).limit(limit))]
+
+
+def create_lower_indexes(target, bind, **kw):
+    """ create unique functional lower() indexes for username and email,
+    non unique index is created if table contains case variant
+    duplicates, on other dialects lookups work without index """
+    if bind.dialect.name not in ('postgresql', 'sqlite'):
+        return
+
+    for name, column in LOWER_INDEXES:
+        unique_name = '%s_unique' % name
+
+        duplicates = get_lower_duplicates(bind, column)
+        if duplicates:
+            log.warning(
+                'Can not create unique %s index, values are used by '
+                'several users: %s', column, ', '.join(duplicates))
+            bind.execute(sqla.DDL(
+                'CREATE INDEX IF NOT EXISTS %s ON %s (lower(%s))' % (
+                    name, CrowdUser.__tablename__, column)))
+            continue
+
+        bind.execute(sqla.DDL(
+            'CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (lower(%s))' % (
+                unique_name, CrowdUser.__tablename__, column)))
+        bind.execute(sqla.DDL('DROP INDEX IF EXISTS %s' % name))
+
+sqla.event.listen(CrowdUser.__table__, 'after_create', create_lower_indexes)
+
+
+def create_joined_index(bind):
+    """ create `joined` index for tables created before index was
+    introduced, keyset pagination sorted by `joined` uses it """
+    if bind.dialect.name in ('postgresql', 'sqlite'):
+        bind.execute(sqla.DDL(
+            'CREATE INDEX IF NOT EXISTS ix_%s_joined ON %s (joined)' % (
+                CrowdUser.__tablename__, CrowdUser.__tablename__)))
+
+
+@sqla.event.listens_for(CrowdUser, 'after_insert', propagate=True)
+def add_login_filter(mapper, conn, target):
+    login_filter.add(target.username, target.email)
+
+
+@sqla.event.listens_for(CrowdUser, 'after_update', propagate=True)
+def update_login_filter(mapper, conn, target):
+    login_filter.changed(conn, *[
+        getattr(target, name) for name in ('username', 'email')
+        if attributes.get_history(target, name).has_changes()])
+
 
 @ptah.tinfo('ptah-crowd-group', 'Crowd group')
 
@@ -131,14 +228,386 @@ class CrowdGroup(ptah.get_base()):
         return self.title
 
 
-_sql_group_search = ptah.QueryFreezer(
-    lambda: ptah.get_session().query(CrowdGroup) \
-    .filter(CrowdGroup.title.contains(sqla.sql.bindparam('term')))\
-    .order_by(sqla.sql.asc('title')))
+GROUP_TITLE_INDEX = 'ix_ptahcrowd_groups_title_lower'
+
+
+def create_group_indexes(target, bind, **kw):
+    """ create functional lower() index for group title prefix lookups,
+    on postgresql with text_pattern_ops so LIKE 'prefix%' can use it """
+    if bind.dialect.name == 'postgresql':
+        column = 'lower(title) text_pattern_ops'
+    elif bind.dialect.name == 'sqlite':
+        column = 'lower(title)'
+    else:
+        return
+
+    bind.execute(sqla.DDL(
+        'CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            GROUP_TITLE_INDEX, CrowdGroup.__tablename__, column)))
+
+sqla.event.listen(CrowdGroup.__table__, 'after_create', create_group_indexes)
+
+
+class CrowdGroupMember(ptah.get_base()):
+    """Crowd group membership
+
+    ``user_id``: Crowd user id.
+
+    ``group``: Crowd group uri.
+
+    """
+
+    __tablename__ = 'ptahcrowd_group_members'
+
+    user_id = sqla.Column(
+        sqla.Integer,
+        sqla.ForeignKey('ptahcrowd_users.id', ondelete='CASCADE'),
+        primary_key=True)
+    group = sqla.Column(sqla.String(255), primary_key=True, index=True)
+
+    _sql_get_groups = ptah.QueryFreezer(
+        lambda: ptah.get_session().query(CrowdGroupMember)\
+            .filter(CrowdGroupMember.user_id==sqla.sql.bindparam('user_id')))
+
+    @classmethod
+    def get_groups(cls, user_id):
+        """ return group uris of user """
+        return [m.group for m in cls._sql_get_groups.iter(user_id=user_id)]
+
+    @classmethod
+    def get_members(cls, group):
+        """ return query of user ids of group members """
+        return ptah.get_session().query(cls.user_id).filter(cls.group==group)
+
+    @classmethod
+    def set_groups(cls, user_id, groups):
+        """ replace groups of user """
+        session = ptah.get_session()
+        session.query(cls).filter(cls.user_id==user_id)\
+            .delete(synchronize_session=False)
+        for grp in set(groups):
+            session.add(cls(user_id=user_id, group=grp))
+        session.flush()
+
+    @classmethod
+    def remove_users(cls, user_ids):
+        """ remove users from all groups """
+        if not user_ids:
+            return
+        ptah.get_session().query(cls).filter(cls.user_id.in_(user_ids))\
+            .delete(synchronize_session=False)
+
+    @classmethod
+    def remove_groups(cls, groups):
+        """ remove groups from all users """
+        if not groups:
+            return
+        ptah.get_session().query(cls).filter(cls.group.in_(groups))\
+            .delete(synchronize_session=False)
+
+
+class concat_agg(FunctionElement):
+    """ comma separated aggregate of string values """
+    type = sqla.String()
+    name = 'concat_agg'
+    inherit_cache = True
+
+
+@compiles(concat_agg)
+def compile_concat_agg(element, compiler, **kw):
+    return 'group_concat(%s)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(concat_agg, 'postgresql')
+def compile_concat_agg_pg(element, compiler, **kw):
+    return "string_agg(%s, ',')" % compiler.process(element.clauses, **kw)
+
+
+class UserRow(object):
+    """ Lightweight read only user for listings, contains displayed
+    columns only, without password and properties.
+
+    ``providers``: sorted domains of external auth providers.
+    """
+
+    columns = ('id', 'fullname', 'username', 'email',
+               'validated', 'suspended', 'joined')
+
+    __slots__ = columns + ('providers',)
+
+    def __init__(self, row):
+        for name, value in zip(self.columns, row):
+            setattr(self, name, value)
+
+        domains = row[len(self.columns)]
+        self.providers = tuple(sorted(set(domains.split(',')))) \
+            if domains else ()
+
+    @property
+    def name(self):
+        return self.fullname or self.username
+
+    @property
+    def __uri__(self):
+        return '%s:%s' % (CrowdUser.__type__.name, self.id)
+
+    @classmethod
+    def query(cls):
+        """ query of displayed user columns and aggregated external
+        providers, use :py:meth:`from_rows` """
+        from ptahcrowd.providers import Storage
+
+        uri = sqla.literal('%s:' % CrowdUser.__type__.name) + \
+            sqla.cast(CrowdUser.id, sqla.String)
+        providers = sqla.select([concat_agg(Storage.domain)])\
+            .where(Storage.uri == uri).correlate(CrowdUser.__table__)\
+            .as_scalar().label('providers')
+
+        return ptah.get_session().query(
+            *[getattr(CrowdUser, name) for name in cls.columns] +
+            [providers])
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls(row) for row in rows]
+
+
+class GroupRow(object):
+    """ Lightweight read only group for listings, ``description``
+    is truncated to ``description_length`` characters """
+
+    __slots__ = ('id', 'title', 'description')
+
+    description_length = 200
+
+    def __init__(self, row):
+        self.id, self.title, self.description = row
+
+    @property
+    def __uri__(self):
+        return '%s:%s' % (CrowdGroup.__type__.name, self.id)
+
+    @classmethod
+    def query(cls):
+        """ query of displayed group columns, use :py:meth:`from_rows` """
+        return ptah.get_session().query(
+            CrowdGroup.id, CrowdGroup.title,
+            sqla.func.substr(CrowdGroup.description,
+                             1, cls.description_length))
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls(row) for row in rows]
+
+
+def iter_pages(fetch, limit, offset=0, page_size=20):
+    """ lazily yield at most ``limit`` items of ``fetch(limit, offset)``
+    pages, so taking first items queries only first page """
+    end = offset + limit
+    while offset < end:
+        size = min(page_size, end - offset)
+        items = fetch(size, offset)
+        for item in items:
+            yield item
+
+        if len(items) < size:
+            break
+        offset += size
+
+
+def search_groups(term, limit, offset=0):
+    """ groups with title containing term, ordered by title """
+    return ptah.get_session().query(CrowdGroup)\
+        .filter(CrowdGroup.title.contains(term))\
+        .order_by(CrowdGroup.title, CrowdGroup.id)\
+        .offset(offset).limit(limit).all()
+
 
 @ptah.principal_searcher('crowd-group')
-def group_searcher(term):
-    return _sql_group_search.all(term = '%%%s%%'%term)
+def group_searcher(term, limit=None, offset=0):
+    """ lazy groups search, at most ``limit`` groups,
+    `search-limit` setting by default """
+    if limit is None:
+        limit = ptah.get_settings(CFG_ID_CROWD)['search-limit']
+
+    return iter_pages(
+        lambda limit, offset: search_groups(term, limit, offset),
+        limit, offset)
+
+
+class RolesMemo(object):
+    """ Request scoped memo for crowd roles resolution.
+
+    ``principals``: uid -> (roles, groups), ``None`` for unknown uid.
+
+    ``local_roles``: (group, context) -> group local roles.
+    """
+
+    def __init__(self):
+        self.principals = {}
+        self.local_roles = {}
+
+    def get_principal(self, uid):
+        try:
+            return self.principals[uid]
+        except KeyError:
+            pass
+
+        # cross-request cache
+        data = roles_cache.get(uid)
+        if data is None:
+            version = roles_cache.get_version(uid)
+
+            principal = ptah.resolve(uid)
+            props = getattr(principal, 'properties', None)
+            if props is not None:
+                groups = CrowdGroupMember.get_groups(principal.id)
+                # not migrated membership
+                groups.extend(props.get('groups', ()))
+                data = (tuple(props.get('roles', ())), tuple(groups))
+                roles_cache.set(uid, version, data)
+
+        self.principals[uid] = data
+        return data
+
+    def get_local_roles(self, grp, context):
+        # context is stored with result, so its id can not be reused
+        key = (grp, id(context))
+        try:
+            ctx, roles = self.local_roles[key]
+            if ctx is context:
+                return roles
+        except KeyError:
+            pass
+
+        roles = tuple(ptah.get_local_roles(grp, context=context))
+        self.local_roles[key] = (context, roles)
+        return roles
+
+
+ROLES_MEMO_ATTR = '__ptahcrowd_roles_memo__'
+
+
+def get_roles_memo(request=None):
+    """ return roles memo for request, new memo if there is no request """
+    if request is None:
+        request = get_current_request()
+        if request is None:
+            return RolesMemo()
+
+    memo = getattr(request, ROLES_MEMO_ATTR, None)
+    if memo is None:
+        memo = RolesMemo()
+        setattr(request, ROLES_MEMO_ATTR, memo)
+    return memo
+
+
+def reset_roles_memo(request=None):
+    """ drop roles memo, should be called after roles or groups change """
+    if request is None:
+        request = get_current_request()
+
+    if request is not None and getattr(request, ROLES_MEMO_ATTR, None):
+        setattr(request, ROLES_MEMO_ATTR, None)
+
+
+def invalidate_roles(uid=None, request=None):
+    """ invalidate cached roles of principal, of all principals
+    if uid is None """
+    roles_cache.invalidate(uid)
+    reset_roles_memo(request)
+
+
+def notify_users_changed(action, ids, values=None, batch_size=1000):
+    """ send :py:class:`ptahcrowd.events.UsersChangedEvent`
+    for each batch of user ids """
+    registry = get_current_registry()
+    for idx in range(0, len(ids), batch_size):
+        registry.notify(
+            UsersChangedEvent(action, ids[idx:idx+batch_size], values))
+
+
+def update_users(clause, values, action='update'):
+    """ set column values of users matching sql clause with single
+    UPDATE statement. Return number of changed users """
+    session = ptah.get_session()
+    session.flush()
+
+    # only users with different values are changed
+    clause = sqla.sql.and_(clause, sqla.sql.or_(*[
+        sqla.sql.or_(getattr(CrowdUser, name) != value,
+                     getattr(CrowdUser, name) == None)
+        for name, value in values.items()]))
+
+    ids = [id for id, in session.query(CrowdUser.id).filter(clause)]
+    if not ids:
+        return 0
+
+    session.query(CrowdUser).filter(clause)\
+        .update(values, synchronize_session=False)
+
+    changed = set(ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, CrowdUser) and obj.id in changed:
+            session.expire(obj)
+
+    notify_users_changed(action, ids, values)
+    return len(ids)
+
+
+def delete_users(clause, batch_size=500):
+    """ remove users matching sql clause with set-based statements,
+    group memberships and external auth entries are removed in same
+    transaction. Return number of removed users """
+    from ptahcrowd.providers import Storage
+    from ptahcrowd.search import CrowdUserNgram
+
+    session = ptah.get_session()
+    session.flush()
+
+    # clause may depend on related rows (search index), so matching
+    # users are selected once and removed by primary key
+    ids = [id for id, in session.query(CrowdUser.id).filter(clause)]
+    if not ids:
+        return 0
+
+    for idx in range(0, len(ids), batch_size):
+        batch = ids[idx:idx+batch_size]
+        uris = ['%s:%s' % (CrowdUser.__type__.name, id) for id in batch]
+
+        session.query(CrowdGroupMember)\
+            .filter(CrowdGroupMember.user_id.in_(batch))\
+            .delete(synchronize_session=False)
+        session.query(CrowdUserNgram)\
+            .filter(CrowdUserNgram.user_id.in_(batch))\
+            .delete(synchronize_session=False)
+        session.query(Storage).filter(Storage.uri.in_(uris))\
+            .delete(synchronize_session=False)
+        session.query(CrowdUser).filter(CrowdUser.id.in_(batch))\
+            .delete(synchronize_session=False)
+
+    removed = set(ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, CrowdUser) and obj.id in removed:
+            session.expunge(obj)
+
+    notify_users_changed('remove', ids)
+    return len(ids)
+
+
+def is_crowd_uri(uid, registry=None):
+    """ check if uid belongs to crowd user type """
+    schema = ptah.extract_uri_schema(uid)
+    if schema is None:
+        return False
+
+    if schema == CrowdUser.__type__.name:
+        return True
+
+    tp = ptah.get_settings(CFG_ID_CROWD, registry)['type']
+    if tp.startswith('type:'):
+        tp = tp[5:]
+    return schema == tp
 
 
 @ptah.roles_provider('crowd')
@@ -148,12 +617,18 @@ def crowd_user_roles(context, uid, registry):
     return user default roles and user group roles"""
     roles = set()
 
-    props = getattr(ptah.resolve(uid), 'properties', None)
-    if props is not None:
-        roles.update(props.get('roles',()))
+    if not is_crowd_uri(uid, registry):
+        return roles
+
+    memo = get_roles_memo()
 
-        for grp in props.get('groups',()):
-            roles.update(ptah.get_local_roles(grp, context))
+    data = memo.get_principal(uid)
+    if data is not None:
+        user_roles, groups = data
+        roles.update(user_roles)
+
+        for grp in groups:
+            roles.update(memo.get_local_roles(grp, context))
 
     return roles
 
@@ -175,20 +650,18 @@ def get_allowed_content_types(context, registry=None):
 @ptah.auth_provider('ptah-crowd-auth')
 class CrowdAuthProvider(object):
 
-    _sql_get_username = ptah.QueryFreezer(
-        lambda: ptah.get_session().query(CrowdUser)\
-            .filter(CrowdUser.username==sqla.sql.bindparam('username')))
-
-    _sql_get_email = ptah.QueryFreezer(
+    _sql_get_login = ptah.QueryFreezer(
         lambda: ptah.get_session().query(CrowdUser)\
-            .filter(CrowdUser.email==sqla.sql.bindparam('email')))
-
-    _sql_search = ptah.QueryFreezer(
-        lambda: ptah.get_session().query(CrowdUser) \
             .filter(sqla.sql.or_(
-                CrowdUser.username.contains(sqla.sql.bindparam('term')),
-                CrowdUser.email.contains(sqla.sql.bindparam('term'))))\
-            .order_by(sqla.sql.asc('fullname')))
+                sqla.func.lower(CrowdUser.username)==
+                sqla.sql.bindparam('login'),
+                sqla.func.lower(CrowdUser.email)==
+                sqla.sql.bindparam('login')))\
+            .order_by(sqla.sql.case(
+                [(sqla.func.lower(CrowdUser.username)==
+                  sqla.sql.bindparam('login'), 0)], else_=1),
+                CrowdUser.id)\
+            .limit(1))
 
     def authenticate(self, creds):
         login, password = creds['login'], creds['password']
@@ -196,19 +669,32 @@ class CrowdAuthProvider(object):
         user = self.get_principal_bylogin(login=login)
 
         if user is not None:
-            if ptah.pwd_tool.check(user.password, password):
+            if check_password(user.password, password):
+                mode = ptah.get_settings(CFG_ID_CROWD)['pwd-upgrade']
+                if mode and needs_rehash(user.password):
+                    upgrade_password(user, password, mode)
                 return user
 
     def get_principal_bylogin(self, login):
-        user = self._sql_get_username.first(username=login)
-        if not user:
-            user = self._sql_get_email.first(email=login)
-        return user
+        # single query, username match has precedence over email match
+        login = lower(login)
+        if login and not login_filter.might_exist(login):
+            return None
+
+        return self._sql_get_login.first(login=login)
 
     @classmethod
-    def search(cls, term):
-        for user in cls._sql_search.all(term = '%%%s%%'%term):
-            yield user
+    def search(cls, term, limit=None, offset=0):
+        """ lazy ranked users search, at most ``limit`` users,
+        `search-limit` setting by default """
+        from ptahcrowd.search import search_users
+
+        if limit is None:
+            limit = ptah.get_settings(CFG_ID_CROWD)['search-limit']
+
+        return iter_pages(
+            lambda limit, offset: search_users(term, limit, offset),
+            limit, offset)
 
     def add(self, user):
         """ Add user to crowd application. """
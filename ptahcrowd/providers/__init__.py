@@ -1,6 +1,7 @@
 import json
 import logging
 import sqlalchemy as sqla
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime, timedelta
 from pyramid import security
 from pyramid.view import view_config
@@ -12,6 +13,10 @@ from pyramid.httpexceptions import HTTPFound
 import ptah
 import ptahcrowd
 from ptahcrowd.schemas import lower
+from ptahcrowd.janitor import janitor_job
+from ptahcrowd.outbox import get_mailer
+from ptahcrowd.providers.httpclient import http_sessions
+from ptahcrowd.ratelimit import check_rate_limit
 
 log = logging.getLogger('ptahcrowd')
 
@@ -28,6 +33,12 @@ def settings_initialized(ev):
     if not providers:
         return
 
+    http_sessions.configure(
+        (cfg['http-connect-timeout'], cfg['http-read-timeout']),
+        cfg['http-pool-size'], cfg['http-retries'])
+    for provider in providers:
+        http_sessions.get(provider)
+
     config = Configurator(registry, autocommit=True)
 
     for provider in providers:
@@ -46,8 +57,7 @@ def auth_complete_view(context, request):
         if entry.verified:
             session = ptah.get_session()
 
-            user = session.query(ptahcrowd.CrowdUser)\
-                   .filter(ptahcrowd.CrowdUser.email == entry.email).first()
+            user = ptahcrowd.CrowdUser.get_byemail(entry.email)
             if user is not None:
                 entry.uri = user.__uri__
             else:
@@ -115,6 +125,12 @@ class VerifyEmail(ptah.form.Form):
         )
 
     def update(self):
+        if self.request.method == 'POST':
+            limited = check_rate_limit(
+                self.request, 'verify', email=self.request.POST.get('email'))
+            if limited is not None:
+                return limited
+
         self.session = session = ptah.get_session()
 
         entry = session.query(Storage).filter(
@@ -139,8 +155,7 @@ class VerifyEmail(ptah.form.Form):
         new_user = False
         email = data['email']
 
-        user = self.session.query(ptahcrowd.CrowdUser).filter(
-            ptahcrowd.CrowdUser.email == email).first()
+        user = ptahcrowd.CrowdUser.get_byemail(email)
         if user is None:
             new_user = True
 
@@ -169,7 +184,7 @@ class VerifyEmail(ptah.form.Form):
 
         t = ptah.token.service.generate(TOKEN_TYPE, json.dumps(data))
         template = VerifyTemplate(request, principal=entry, token=t)
-        template.send()
+        template.send(mailer=get_mailer())
 
         # login
         if new_user:
@@ -256,46 +271,217 @@ class Storage(ptah.get_base()):
     verified = sqla.Column(sqla.Boolean(), default=False)
 
     profile = sqla.Column(ptah.JsonDictType())
-    expires = sqla.Column(sqla.DateTime())
+    expires = sqla.Column(sqla.DateTime(), index=True)
+    fetched = sqla.Column(sqla.DateTime())
+
+    # seconds, default entry lifetime, `storage-ttl` setting
+    ttl = 2592000
+
+    # seconds, profile freshness window, `profile-ttl` setting
+    profile_ttl = 86400
 
     @classmethod
     def get_by_token(cls, access_token):
         return ptah.get_session().query(cls).filter(
             sqla.and_(cls.access_token == access_token)).first()
 
+    @classmethod
+    def get_cached(cls, access_token, uid):
+        """ return entry of provider ``uid`` with profile fetched within
+        `profile-ttl` seconds, entry is updated with new ``access_token``
+        in place, so returning user does not need profile request """
+        if not cls.profile_ttl or not uid:
+            return None
+
+        now = datetime.utcnow()
+        entry = ptah.get_session().query(cls).filter(
+            cls.uid == uid,
+            cls.fetched >= now - timedelta(seconds=cls.profile_ttl)).first()
+        if entry is not None and entry.access_token != access_token:
+            entry.access_token = access_token
+            entry.expires = now + timedelta(seconds=cls.ttl)
+        return entry
+
     @classmethod
     def create(cls, access_token, domain,
                uid='', name='', email='',
                verified=False, profile=None, expires=None):
 
+        now = datetime.utcnow()
+        if expires is None:
+            expires = now + timedelta(seconds=cls.ttl)
+
         params = {'access_token': access_token,
                   'domain': domain,
                   'uid': uid,
                   'name': name,
                   'email': email.lower(),
                   'verified': verified,
-                  'profile': profile}
+                  'profile': profile,
+                  'expires': expires,
+                  'fetched': now}
 
+        # reuse old authorization, `uri` of existing entry is kept
         session = ptah.get_session()
+        result = upsert_storage(session.connection(), params, returning=True)
 
-        # reuse old authorization
-        q = session.query(cls).filter(cls.uid == uid)
-        old = q.first()
-        if old is not None:
-            params['uri'] = old.uri
-            q.delete()
+        query = session.query(cls).populate_existing()
+        if result is not None:
+            entry, = query.instances(result)
+            return entry
 
-        entry = cls(**params)
-        session.add(entry)
-        return entry
+        return query.filter(cls.access_token == access_token).one()
 
     @classmethod
-    def delete(cls, key):
-        ptah.get_session().query(cls).filter(cls.key == key).delete()
+    def delete(cls, access_token):
+        ptah.get_session().query(cls)\
+            .filter(cls.access_token == access_token)\
+            .delete(synchronize_session=False)
         return True
 
     @classmethod
-    def purge_expired(cls):
-        ptah.get_session().query(cls)\
-            .filter(cls.expires < datetime.utcnow()).delete()
-        return True
+    def purge_expired(cls, batch_size=500):
+        """ remove or clear expired entries in batches, return number
+        of expired entries """
+        conn = ptah.get_session().connection()
+        total = 0
+        while True:
+            count = purge_expired_batch(conn, batch_size)
+            total += count
+            if count < batch_size:
+                return total
+
+
+def supports_returning(dialect):
+    """ check if dialect can compile INSERT .. RETURNING """
+    return getattr(dialect, 'insert_returning',
+                   getattr(dialect, 'full_returning', False))
+
+
+def upsert_storage(conn, params, returning=False):
+    """ insert entry or update entry with same `uid` in single
+    statement, `uri` of existing entry is not changed. With
+    ``returning`` result of the statement with stored row is returned
+    if database supports RETURNING (PostgreSQL, SQLite 3.35+),
+    otherwise None """
+    table = Storage.__table__
+    values = dict((key, value) for key, value in params.items()
+                  if key not in ('uid', 'uri'))
+
+    insert = None
+    if conn.dialect.name == 'postgresql':
+        insert = postgresql.insert
+    elif conn.dialect.name == 'sqlite' and \
+            (conn.dialect.server_version_info or ()) >= (3, 24):
+        insert = getattr(sqlite, 'insert', None)
+
+    if insert is not None:
+        stmt = insert(table).values(**params)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.uid],
+            set_=dict((key, stmt.excluded[key]) for key in values))
+        if returning and supports_returning(conn.dialect):
+            return conn.execute(stmt.returning(*table.c))
+        conn.execute(stmt)
+        return
+
+    update = table.update().where(table.c.uid == params['uid'])\
+        .values(**values)
+    if conn.execute(update).rowcount:
+        return
+
+    try:
+        with conn.begin_nested():
+            conn.execute(table.insert().values(**params))
+    except sqla.exc.IntegrityError:
+        # concurrent insert of same uid
+        conn.execute(update)
+
+
+def purge_expired_batch(conn, batch_size, now=None):
+    """ expire at most ``batch_size`` oldest expired entries, keys are
+    selected by `expires` index range. Entries not linked to user
+    are removed by primary key, entries linked to user keep `uid` and
+    `uri`, only token and profile data is cleared """
+    table = Storage.__table__
+    if now is None:
+        now = datetime.utcnow()
+
+    rows = conn.execute(
+        sqla.select([table.c.access_token, table.c.uri])
+        .where(table.c.expires < now)
+        .order_by(table.c.expires).limit(batch_size)).fetchall()
+
+    unlinked = [token for token, uri in rows if uri is None]
+    if unlinked:
+        conn.execute(table.delete().where(table.c.access_token.in_(unlinked)))
+
+    linked = [token for token, uri in rows if uri is not None]
+    if linked:
+        # expired token can not be found with `get_by_token`,
+        # next login of linked account fetches profile again
+        conn.execute(
+            table.update().where(table.c.access_token.in_(linked))
+            .values(access_token=sqla.literal('expired:') + table.c.uid,
+                    profile=None, fetched=None, expires=None))
+    return len(rows)
+
+
+def set_expires_batch(conn, batch_size, now=None):
+    """ set expiry of at most ``batch_size`` entries stored
+    without expiry, cleared linked entries do not expire """
+    table = Storage.__table__
+    if now is None:
+        now = datetime.utcnow()
+
+    tokens = [token for token, in conn.execute(
+        sqla.select([table.c.access_token])
+        .where(sqla.and_(
+            table.c.expires.is_(None),
+            sqla.or_(table.c.uri.is_(None),
+                     table.c.profile.isnot(None))))
+        .limit(batch_size))]
+    if tokens:
+        conn.execute(
+            table.update().where(table.c.access_token.in_(tokens))
+            .values(expires=now + timedelta(seconds=Storage.ttl)))
+    return len(tokens)
+
+
+def create_storage_columns(conn):
+    """ add `fetched` column to tables created before
+    profile cache was introduced """
+    table = Storage.__table__
+    columns = set(col['name'] for col in
+                  sqla.inspect(conn).get_columns(table.name))
+    if 'fetched' not in columns:
+        conn.execute(sqla.DDL('ALTER TABLE %s ADD COLUMN fetched %s' % (
+            table.name, table.c.fetched.type.compile(dialect=conn.dialect))))
+
+
+def create_storage_indexes(conn):
+    """ create `expires` index for tables created before
+    index was introduced """
+    if conn.dialect.name in ('postgresql', 'sqlite'):
+        conn.execute(sqla.DDL(
+            'CREATE INDEX IF NOT EXISTS ix_%s_expires ON %s (expires)' % (
+                Storage.__tablename__, Storage.__tablename__)))
+
+
+@janitor_job('auth-storage-expires')
+def set_storage_expires(engine, batch_size):
+    with engine.begin() as conn:
+        return set_expires_batch(conn, batch_size)
+
+
+@janitor_job('auth-storage-purge')
+def purge_storage(engine, batch_size):
+    with engine.begin() as conn:
+        return purge_expired_batch(conn, batch_size)
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def storage_settings_initialized(ev):
+    cfg = ptah.get_settings(ptahcrowd.CFG_ID_AUTH, ev.registry)
+    Storage.ttl = cfg['storage-ttl']
+    Storage.profile_ttl = cfg['profile-ttl']
@@ -1,7 +1,6 @@
 """Facebook Authentication Views"""
 import json
 import uuid
-import requests
 
 from pyramid.compat import url_encode, urlparse
 from pyramid.httpexceptions import HTTPFound
@@ -12,6 +11,7 @@ from ptahcrowd.providers import Storage, AuthenticationComplete
 from ptahcrowd.providers.exceptions import AuthenticationDenied
 from ptahcrowd.providers.exceptions import CSRFError
 from ptahcrowd.providers.exceptions import ThirdPartyFailure
+from ptahcrowd.providers.httpclient import get_http_session
 
 
 class FacebookAuthenticationComplete(AuthenticationComplete):
@@ -67,6 +67,8 @@ def facebook_process(request):
     client_id = cfg['facebook_id']
     client_secret = cfg['facebook_secret']
 
+    http = get_http_session('facebook')
+
     # Now retrieve the access token with the code
     access_url = '{0}?{1}'.format(
         'https://graph.facebook.com/oauth/access_token',
@@ -74,7 +76,7 @@ def facebook_process(request):
                     'client_secret': client_secret,
                     'redirect_uri': request.route_url('facebook_process'),
                     'code': code}))
-    r = requests.get(access_url)
+    r = http.get(access_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
@@ -87,7 +89,7 @@ def facebook_process(request):
     # Retrieve profile data
     graph_url = '{0}?{1}'.format('https://graph.facebook.com/me',
                                  url_encode({'access_token': access_token}))
-    r = requests.get(graph_url)
+    r = http.get(graph_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
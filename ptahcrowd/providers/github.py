@@ -1,6 +1,5 @@
 """Github Authentication"""
 import json
-import requests
 
 from pyramid.compat import url_encode, urlparse
 from pyramid.httpexceptions import HTTPFound
@@ -11,6 +10,7 @@ from ptahcrowd.providers import Storage
 from ptahcrowd.providers import AuthenticationComplete
 from ptahcrowd.providers.exceptions import AuthenticationDenied
 from ptahcrowd.providers.exceptions import ThirdPartyFailure
+from ptahcrowd.providers.httpclient import get_http_session
 
 
 class GithubAuthenticationComplete(AuthenticationComplete):
@@ -53,6 +53,8 @@ def github_process(request):
     client_id = cfg['github_id']
     client_secret = cfg['github_secret']
 
+    http = get_http_session('github')
+
     # Now retrieve the access token with the code
     access_url ='{0}?{1}'.format(
         'https://github.com/login/oauth/access_token',
@@ -61,7 +63,7 @@ def github_process(request):
                     'redirect_uri': request.route_url('github_process'),
                     'code': code}))
 
-    r = requests.get(access_url)
+    r = http.get(access_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
@@ -78,7 +80,7 @@ def github_process(request):
     graph_url = '{0}?{1}'.format(
         'https://github.com/api/v2/json/user/show',
         url_encode({'access_token': access_token}))
-    r = requests.get(graph_url)
+    r = http.get(graph_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
@@ -4,7 +4,7 @@ Docs: http://code.google.com/apis/accounts/docs/OAuth2Login.html
 OAuth App: https://code.google.com/apis/console   'Api Access'
 """
 import json
-import requests
+import base64
 
 from pyramid.compat import url_encode
 from pyramid.httpexceptions import HTTPFound
@@ -15,6 +15,7 @@ from ptahcrowd.providers import Storage
 from ptahcrowd.providers import AuthenticationComplete
 from ptahcrowd.providers.exceptions import AuthenticationDenied
 from ptahcrowd.providers.exceptions import ThirdPartyFailure
+from ptahcrowd.providers.httpclient import get_http_session
 
 
 class GoogleAuthenticationComplete(AuthenticationComplete):
@@ -44,6 +45,19 @@ def google_login(request):
     return HTTPFound(location=go_url)
 
 
+def id_token_uid(data):
+    """ uid from `id_token` of token response, token is received
+    directly from google, so signature is not verified """
+    try:
+        payload = data['id_token'].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))
+        return '{0}:{1}'.format('google', claims.get('sub') or claims['id'])
+    except Exception:
+        return None
+
+
 def google_process(request):
     """Process the google redirect"""
     code = request.GET.get('code')
@@ -56,22 +70,27 @@ def google_process(request):
     client_id = cfg['google_id']
     client_secret = cfg['google_secret']
 
+    http = get_http_session('google')
+
     # Now retrieve the access token with the code
-    r = requests.post('https://accounts.google.com/o/oauth2/token',
-                      {'client_id': client_id,
-                       'client_secret': client_secret,
-                       'redirect_uri': request.route_url('google_process'),
-                       'grant_type': 'authorization_code',
-                       'code': code})
+    r = http.post('https://accounts.google.com/o/oauth2/token',
+                  {'client_id': client_id,
+                   'client_secret': client_secret,
+                   'redirect_uri': request.route_url('google_process'),
+                   'grant_type': 'authorization_code',
+                   'code': code})
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
     try:
-        access_token = json.loads(r.content)['access_token']
+        data = json.loads(r.content)
+        access_token = data['access_token']
     except:
         return AuthenticationDenied("Can't get access_token.")
 
     entry = Storage.get_by_token(access_token)
+    if entry is None:
+        entry = Storage.get_cached(access_token, id_token_uid(data))
     if entry is not None:
         return GoogleAuthenticationComplete(entry)
 
@@ -79,7 +98,7 @@ def google_process(request):
     graph_url = '{0}?{1}'.format(
         'https://www.googleapis.com/oauth2/v1/userinfo',
         url_encode({'access_token': access_token}))
-    r = requests.get(graph_url)
+    r = http.get(graph_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
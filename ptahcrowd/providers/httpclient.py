@@ -0,0 +1,82 @@
+""" pooled keep-alive http sessions for auth providers """
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+class PooledSession(requests.Session):
+    """ requests session with default timeout """
+
+    timeout = None
+
+    def request(self, method, url, **kw):
+        kw.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kw)
+
+
+class HTTPSessions(object):
+    """ Per provider pooled http sessions, connections to token and
+    profile endpoints are kept alive and reused between logins.
+
+    ``timeout``: (connect, read) timeout in seconds.
+
+    ``pool_size``: number of kept alive connections per host, every
+    provider session keeps pools of ``hosts`` hosts, providers use
+    separate token and profile hosts.
+
+    ``retries``: number of retries of failed connections and of
+    idempotent requests with 502, 503 or 504 response status.
+    """
+
+    hosts = 10
+
+    def __init__(self, timeout=(5, 10), pool_size=10, retries=2):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+
+    def configure(self, timeout, pool_size, retries):
+        self.close()
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+
+    def make_session(self):
+        session = PooledSession()
+        session.timeout = self.timeout
+
+        adapter = HTTPAdapter(
+            pool_connections=self.hosts, pool_maxsize=self.pool_size,
+            max_retries=Retry(
+                total=self.retries, backoff_factor=0.2,
+                status_forcelist=(502, 503, 504), raise_on_status=False))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, name):
+        """ return http session of provider ``name`` """
+        session = self.sessions.get(name)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(name)
+                if session is None:
+                    session = self.sessions[name] = self.make_session()
+        return session
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+http_sessions = HTTPSessions()
+
+
+def get_http_session(name):
+    """ pooled http session of auth provider ``name`` """
+    return http_sessions.get(name)
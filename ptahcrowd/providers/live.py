@@ -4,7 +4,6 @@ doc: http://msdn.microsoft.com/en-us/library/hh243647.aspx
 app: https://manage.dev.live.com/Applications/Index
 """
 import json
-import requests
 
 from pyramid.compat import url_encode
 from pyramid.httpexceptions import HTTPFound
@@ -15,6 +14,7 @@ from ptahcrowd.providers import Storage
 from ptahcrowd.providers import AuthenticationComplete
 from ptahcrowd.providers.exceptions import AuthenticationDenied
 from ptahcrowd.providers.exceptions import ThirdPartyFailure
+from ptahcrowd.providers.httpclient import get_http_session
 
 
 class LiveAuthenticationComplete(AuthenticationComplete):
@@ -61,6 +61,8 @@ def live_process(request):
     client_id = cfg['live_id']
     client_secret = cfg['live_secret']
 
+    http = get_http_session('live')
+
     # Now retrieve the access token with the code
     access_url = '{0}?{1}'.format(
         'https://oauth.live.com/token',
@@ -70,7 +72,7 @@ def live_process(request):
                     'grant_type': 'authorization_code',
                     'code': code}))
 
-    r = requests.get(access_url)
+    r = http.get(access_url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
@@ -78,6 +80,9 @@ def live_process(request):
     access_token = data['access_token']
 
     entry = Storage.get_by_token(access_token)
+    if entry is None and data.get('user_id'):
+        entry = Storage.get_cached(
+            access_token, 'live:{0}'.format(data['user_id']))
     if entry is not None:
         return LiveAuthenticationComplete(entry)
 
@@ -85,7 +90,7 @@ def live_process(request):
     url = '{0}?{1}'.format(
         'https://apis.live.net/v5.0/me',
         url_encode({'access_token': access_token}))
-    r = requests.get(url)
+    r = http.get(url)
     if r.status_code != 200:
         raise ThirdPartyFailure("Status %s: %s" % (r.status_code, r.content))
 
@@ -0,0 +1,227 @@
+""" token bucket rate limiting """
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from pyramid.httpexceptions import HTTPClientError
+
+import ptah
+from ptahcrowd.schemas import lower
+from ptahcrowd.settings import CFG_ID_RATELIMIT
+
+log = logging.getLogger('ptahcrowd')
+
+BACKENDS = {}
+
+
+def ratelimit_backend(cls):
+    """ register rate limit backend class """
+    BACKENDS[cls.name] = cls
+    return cls
+
+
+class HTTPTooManyRequests(HTTPClientError):
+    code = 429
+    title = 'Too Many Requests'
+    explanation = 'Too many requests, please try again later.'
+
+
+def parse_limit(value):
+    """ parse ``capacity/seconds`` limit, return None for empty value """
+    if not value:
+        return None
+    try:
+        capacity, period = value.split('/', 1)
+        capacity, period = int(capacity), float(period)
+    except ValueError:
+        log.warning('Wrong rate limit "%s", should be capacity/seconds', value)
+        return None
+
+    if capacity <= 0 or period <= 0:
+        return None
+    return capacity, period
+
+
+class RateLimitBackend(object):
+    """ Base rate limit backend, stores (tokens, timestamp) per key.
+
+    ``name``: backend name, used in `backend` setting.
+    """
+
+    name = ''
+
+    def __init__(self, path=''):
+        self.path = path
+
+    def refill(self, state, capacity, period, now):
+        """ return (new state, seconds to wait or 0) """
+        rate = capacity / period
+        if state is None:
+            tokens = float(capacity)
+        else:
+            tokens, ts = state
+            tokens = min(float(capacity), tokens + max(now - ts, 0) * rate)
+
+        if tokens >= 1:
+            return (tokens - 1, now), 0
+        return (tokens, now), (1 - tokens) / rate
+
+    def take(self, key, capacity, period, now):
+        """ take token from key bucket, return seconds to wait or 0,
+        backend without buckets storage does not limit requests """
+        return 0
+
+
+@ratelimit_backend
+class MemoryBackend(RateLimitBackend):
+    """ in-process buckets, bounded number of keys """
+
+    name = 'memory'
+    size = 100000
+
+    def __init__(self, path=''):
+        super(MemoryBackend, self).__init__(path)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def take(self, key, capacity, period, now):
+        with self.lock:
+            state, wait = self.refill(
+                self.data.get(key), capacity, period, now)
+            self.data[key] = state
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+            return wait
+
+
+@ratelimit_backend
+class FileBackend(RateLimitBackend):
+    """ sqlite file buckets, shared by processes on same host """
+
+    name = 'file'
+
+    def __init__(self, path=''):
+        super(FileBackend, self).__init__(
+            path or os.path.join(tempfile.gettempdir(), 'ptahcrowd-ratelimit.db'))
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                'key TEXT PRIMARY KEY, tokens REAL, ts REAL)')
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, capacity, period, now):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            state = conn.execute(
+                'SELECT tokens, ts FROM buckets WHERE key=?', (key,)).fetchone()
+            state, wait = self.refill(state, capacity, period, now)
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                         (key, state[0], state[1]))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return wait
+
+
+class RateLimiter(object):
+    """ Rate limiter, limits are configured in `ptahcrowd-ratelimit`
+    settings as ``<action>-<key>`` fields.
+
+    ``ip_keyed``: limits with buckets per client ip and key value,
+    so other clients can't exhaust bucket and lock account out.
+
+    ``trusted_proxies``: addresses of reverse proxies, client ip of
+    their requests is taken from `X-Forwarded-For` header.
+    """
+
+    ip_keyed = frozenset(('login-user',))
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.enabled = False
+        self.limits = {}
+        self.trusted_proxies = frozenset()
+        self.backend = MemoryBackend()
+
+    def configure(self, cfg):
+        self.enabled = cfg['enabled']
+        self.backend = BACKENDS[cfg['backend']](cfg['path'])
+        self.trusted_proxies = frozenset(cfg['trusted-proxies'])
+        self.limits = {}
+        for name, value in cfg.items():
+            if name not in ('enabled', 'backend', 'path', 'trusted-proxies'):
+                limit = parse_limit(value)
+                if limit is not None:
+                    self.limits[name] = limit
+
+    def client_ip(self, request):
+        """ client address, `X-Forwarded-For` addresses are used
+        only from right to left while they are added by trusted proxies """
+        addr = request.remote_addr or ''
+        if addr not in self.trusted_proxies:
+            return addr
+
+        forwarded = [value.strip() for value in
+                     request.headers.get('X-Forwarded-For', '').split(',')]
+        for value in reversed(forwarded):
+            if not value:
+                break
+            addr = value
+            if addr not in self.trusted_proxies:
+                break
+        return addr
+
+    def check(self, request, action, **keys):
+        """ return 429 response if request exceeds `action` limits """
+        if not self.enabled:
+            return
+
+        keys['ip'] = self.client_ip(request)
+
+        now = self.timer()
+        for name in ['ip'] + sorted(k for k in keys if k != 'ip'):
+            limit_name = '%s-%s' % (action, name)
+            limit = self.limits.get(limit_name)
+            value = lower(keys[name])
+            if limit is None or value is None:
+                continue
+
+            if name != 'ip' and limit_name in self.ip_keyed:
+                value = '%s:%s' % (keys['ip'], value)
+
+            wait = self.backend.take(
+                '%s:%s:%s' % (action, name, value), limit[0], limit[1], now)
+            if wait:
+                log.info('Rate limit "%s-%s" exceeded for %s',
+                         action, name, keys['ip'])
+                response = HTTPTooManyRequests()
+                response.headers['Retry-After'] = str(int(wait) + 1)
+                return response
+
+
+limiter = RateLimiter()
+
+
+def check_rate_limit(request, action, **keys):
+    """ return 429 response if request exceeds `action` rate limits,
+    ``keys`` are additional bucket keys, e.g. `user` or `email` """
+    return limiter.check(request, action, **keys)
+
+
+@ptah.subscriber(ptah.events.SettingsInitialized)
+def settings_initialized(ev):
+    limiter.configure(ptah.get_settings(CFG_ID_RATELIMIT, ev.registry))
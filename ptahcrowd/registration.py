@@ -7,7 +7,9 @@ import ptah
 from ptah.password import PasswordSchema
 from ptah.events import PrincipalRegisteredEvent
 
+from ptahcrowd.hashing import encode_password
 from ptahcrowd.provider import get_user_type
+from ptahcrowd.ratelimit import check_rate_limit
 from ptahcrowd.settings import _, CFG_ID_CROWD
 from ptahcrowd.schemas import RegistrationSchema
 from ptahcrowd.validation import initiate_email_validation
@@ -43,12 +45,17 @@ class Registration(ptah.form.Form):
             username=data['username'], email=data['email'])
 
         # set password
-        user.password = ptah.pwd_tool.encode(data['password'])
+        user.password = encode_password(data['password'])
 
         return tinfo.add(user)
 
     @ptah.form.button(_("Register"), actype=ptah.form.AC_PRIMARY)
     def register_handler(self):
+        limited = check_rate_limit(
+            self.request, 'join', email=self.request.POST.get('email'))
+        if limited is not None:
+            return limited
+
         data, errors = self.extract()
         if errors:
             self.add_error_message(errors)
@@ -11,6 +11,9 @@ from ptah.events import ResetPasswordInitiatedEvent
 from ptah.events import PrincipalPasswordChangedEvent
 
 from ptahcrowd import const
+from ptahcrowd.hashing import change_password
+from ptahcrowd.outbox import get_mailer
+from ptahcrowd.ratelimit import check_rate_limit
 from ptahcrowd.schemas import ResetPasswordSchema
 from ptahcrowd.settings import _
 
@@ -40,6 +43,11 @@ class ResetPassword(ptah.form.Form):
                       name='reset', actype=ptah.form.AC_PRIMARY)
     def reset(self):
         request = self.request
+        limited = check_rate_limit(
+            request, 'reset', user=request.POST.get('login'))
+        if limited is not None:
+            return limited
+
         data, errors = self.extract()
 
         login = data.get('login')
@@ -52,7 +60,7 @@ class ResetPassword(ptah.form.Form):
 
                 template = ResetPasswordTemplate(
                     request, principal=principal, passcode=passcode)
-                template.send()
+                template.send(mailer=get_mailer())
 
                 self.request.registry.notify(
                     ResetPasswordInitiatedEvent(principal))
@@ -112,10 +120,9 @@ class ResetPasswordForm(ptah.form.Form):
             self.add_error_message(errors)
         else:
             principal = self.principal
-            passcode = self.passcode
-            if principal and not passcode:
-                passcode = ptah.pwd_tool.generate_passcode(principal)
-            ptah.pwd_tool.change_password(passcode, data['password'])
+            if self.passcode:
+                ptah.pwd_tool.remove_passcode(self.passcode)
+            change_password(principal, data['password'])
 
             self.request.registry.notify(
                 PrincipalPasswordChangedEvent(principal))
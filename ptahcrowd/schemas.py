@@ -18,12 +18,10 @@ def lower(s):
 def checkUsernameValidator(field, username):
     """Ptah field validator, checks if username is already in use."""
 
-    if getattr(field, 'value', None) == username:
+    if lower(getattr(field, 'value', None)) == lower(username):
         return
 
-    session = ptah.get_session()
-    user = session.query(ptahcrowd.CrowdUser).filter(
-        ptahcrowd.CrowdUser.username == username).first()
+    user = ptahcrowd.CrowdUser.get_byusername(username)
 
     if user is not None:
         raise ptah.form.Invalid(_("This login is already in use."), field)
@@ -31,12 +29,10 @@ def checkUsernameValidator(field, username):
 def checkEmailValidator(field, email):
     """Ptah field validator, checks if email is already in use."""
 
-    if getattr(field, 'value', None) == email:
+    if lower(getattr(field, 'value', None)) == lower(email):
         return
 
-    session = ptah.get_session()
-    user = session.query(ptahcrowd.CrowdUser).filter(
-        ptahcrowd.CrowdUser.email == email).first()
+    user = ptahcrowd.CrowdUser.get_byemail(email)
 
     if user is not None:
         raise ptah.form.Invalid(_("This email is already in use."), field)
@@ -0,0 +1,467 @@
+""" indexed user search """
+import logging
+import sqlalchemy as sqla
+from sqlalchemy.orm import attributes
+
+import ptah
+from ptahcrowd.settings import CFG_ID_CROWD
+from ptahcrowd.provider import CrowdUser, CrowdGroup, UserRow
+
+log = logging.getLogger('ptahcrowd')
+
+SEARCH_FIELDS = ('username', 'email', 'fullname')
+
+BACKENDS = {}
+
+
+def search_backend(cls):
+    """ register search backend class """
+    BACKENDS[cls.name] = cls()
+    return cls
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_clause(term):
+    """ case insensitive substring match on search fields """
+    pattern = '%%%s%%' % escape_like(term.lower())
+    return sqla.sql.or_(
+        *[sqla.func.lower(getattr(CrowdUser, name)).like(
+            pattern, escape='\\') for name in SEARCH_FIELDS])
+
+
+class SearchBackend(object):
+    """ Base search backend
+
+    ``name``: backend name, used in `search-backend` setting.
+    """
+
+    name = ''
+
+    def installed(self, conn):
+        """ check if backend database objects exist """
+        return True
+
+    def install(self, conn):
+        """ create backend database objects """
+
+    def rebuild(self, conn):
+        """ index existing users """
+
+    def search(self, session, term, limit, offset=0):
+        """ return list of user ids ordered by rank, substring
+        match in primary key order by default """
+        return self.like_search(session, term, limit, offset)
+
+    def clause(self, term):
+        """ sql clause for all users matching term, without ranking """
+        return like_clause(term)
+
+    def like_search(self, session, term, limit, offset=0):
+        # short terms, primary key order so scan stops at limit
+        q = session.query(CrowdUser.id).filter(like_clause(term))\
+            .order_by(CrowdUser.id)
+        return [id for id, in q.offset(offset).limit(limit)]
+
+
+@search_backend
+class SqliteFTSBackend(SearchBackend):
+    """ SQLite FTS5 external content table with trigram tokenizer """
+
+    name = 'sqlite-fts'
+    table = 'ptahcrowd_users_fts'
+
+    def installed(self, conn):
+        if conn.dialect.name != 'sqlite':
+            return False
+
+        return conn.execute(sqla.text(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name=:name"), {'name': self.table}).first() is not None
+
+    def install(self, conn):
+        if conn.dialect.name != 'sqlite':
+            return
+
+        params = {'t': self.table, 'u': CrowdUser.__tablename__,
+                  'c': ', '.join(SEARCH_FIELDS),
+                  'new': ', '.join('new.%s' % f for f in SEARCH_FIELDS),
+                  'old': ', '.join('old.%s' % f for f in SEARCH_FIELDS)}
+        try:
+            conn.execute(sqla.DDL(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %(t)s USING fts5("
+                "%(c)s, content='%(u)s', content_rowid='id', "
+                "tokenize='trigram')" % params))
+        except sqla.exc.DBAPIError:
+            log.info('SQLite FTS5 trigram tokenizer is not available.')
+            return
+
+        # update trigger of older versions fires on update of any column
+        trigger = conn.execute(sqla.text(
+            "SELECT sql FROM sqlite_master WHERE type='trigger' "
+            "AND name=:name"), {'name': '%s_au' % self.table}).scalar()
+        if trigger is not None and 'UPDATE OF' not in trigger.upper():
+            conn.execute(sqla.DDL('DROP TRIGGER %s_au' % self.table))
+
+        for stmt in (
+            "CREATE TRIGGER IF NOT EXISTS %(t)s_ai AFTER INSERT ON %(u)s "
+            "BEGIN INSERT INTO %(t)s(rowid, %(c)s) "
+            "VALUES (new.id, %(new)s); END",
+
+            "CREATE TRIGGER IF NOT EXISTS %(t)s_ad AFTER DELETE ON %(u)s "
+            "BEGIN INSERT INTO %(t)s(%(t)s, rowid, %(c)s) "
+            "VALUES ('delete', old.id, %(old)s); END",
+
+            "CREATE TRIGGER IF NOT EXISTS %(t)s_au "
+            "AFTER UPDATE OF %(c)s ON %(u)s "
+            "BEGIN INSERT INTO %(t)s(%(t)s, rowid, %(c)s) "
+            "VALUES ('delete', old.id, %(old)s); "
+            "INSERT INTO %(t)s(rowid, %(c)s) VALUES (new.id, %(new)s); END"):
+            conn.execute(sqla.DDL(stmt % params))
+
+    def rebuild(self, conn):
+        conn.execute(sqla.text(
+            "INSERT INTO %(t)s(%(t)s) VALUES('rebuild')" % {'t': self.table}))
+
+    def clause(self, term):
+        if len(term) < 3:
+            return like_clause(term)
+
+        return sqla.text(
+            '%s.id IN (SELECT rowid FROM %s WHERE %s MATCH :fts_term)' % (
+                CrowdUser.__tablename__, self.table, self.table))\
+            .bindparams(fts_term='"%s"' % term.replace('"', '""'))
+
+    def search(self, session, term, limit, offset=0):
+        # trigram tokenizer can't match terms shorter than 3 chars
+        if len(term) < 3:
+            return self.like_search(session, term, limit, offset)
+
+        rows = session.execute(sqla.text(
+            "SELECT rowid FROM %s WHERE %s MATCH :term "
+            "ORDER BY rank, rowid LIMIT :limit OFFSET :offset" % (
+                self.table, self.table)),
+            {'term': '"%s"' % term.replace('"', '""'),
+             'limit': limit, 'offset': offset})
+        return [row[0] for row in rows]
+
+
+@search_backend
+class PostgresTrigramBackend(SearchBackend):
+    """ PostgreSQL pg_trgm GIN index """
+
+    name = 'pg-trgm'
+    index = 'ix_ptahcrowd_users_search_trgm'
+    expr = ("lower(coalesce(username, '') || ' ' || "
+            "coalesce(email, '') || ' ' || coalesce(fullname, ''))")
+
+    def installed(self, conn):
+        if conn.dialect.name != 'postgresql':
+            return False
+
+        return conn.execute(sqla.text(
+            "SELECT indexname FROM pg_indexes WHERE indexname=:name"),
+            {'name': self.index}).first() is not None
+
+    def install(self, conn):
+        if conn.dialect.name != 'postgresql':
+            return
+
+        try:
+            with conn.begin_nested():
+                conn.execute(sqla.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        except sqla.exc.DBAPIError:
+            log.info('PostgreSQL pg_trgm extension is not available.')
+            return
+
+        conn.execute(sqla.DDL(
+            'CREATE INDEX IF NOT EXISTS %s ON %s USING gin ((%s) gin_trgm_ops)'%(
+                self.index, CrowdUser.__tablename__, self.expr)))
+
+    def clause(self, term):
+        return sqla.text('%s LIKE :trgm_pattern' % self.expr).bindparams(
+            trgm_pattern='%%%s%%' % escape_like(term.lower()))
+
+    def search(self, session, term, limit, offset=0):
+        rows = session.execute(sqla.text(
+            "SELECT id FROM %s WHERE %s LIKE :pattern "
+            "ORDER BY similarity(%s, :term) DESC, id "
+            "LIMIT :limit OFFSET :offset" % (
+                CrowdUser.__tablename__, self.expr, self.expr)),
+            {'pattern': '%%%s%%' % escape_like(term.lower()),
+             'term': term.lower(), 'limit': limit, 'offset': offset})
+        return [row[0] for row in rows]
+
+
+class CrowdUserNgram(ptah.get_base()):
+    """ user search trigrams, maintained by ngram search backend """
+
+    __tablename__ = 'ptahcrowd_user_ngrams'
+
+    user_id = sqla.Column(
+        sqla.Integer,
+        sqla.ForeignKey('ptahcrowd_users.id', ondelete='CASCADE'),
+        primary_key=True)
+    field = sqla.Column(sqla.String(16), primary_key=True)
+    gram = sqla.Column(sqla.Unicode(3), primary_key=True, index=True)
+
+
+NGRAM_PAD = '\x1f\x1f'
+
+
+def ngrams(text):
+    """ trigrams of lower cased text, text is padded so any substring
+    shorter than 3 chars is a prefix of some trigram """
+    if not text:
+        return set()
+
+    text = '%s%s' % (text.lower(), NGRAM_PAD)
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+@search_backend
+class NgramBackend(SearchBackend):
+    """ portable trigram index table """
+
+    name = 'ngram'
+
+    def index(self, conn, user):
+        table = CrowdUserNgram.__table__
+        conn.execute(table.delete().where(table.c.user_id == user.id))
+
+        rows = [{'user_id': user.id, 'field': name, 'gram': gram}
+                for name in SEARCH_FIELDS
+                for gram in ngrams(getattr(user, name, None))]
+        if rows:
+            conn.execute(table.insert(), rows)
+
+    def unindex(self, conn, user_id):
+        table = CrowdUserNgram.__table__
+        conn.execute(table.delete().where(table.c.user_id == user_id))
+
+    def rebuild(self, conn, batch_size=500):
+        conn.execute(CrowdUserNgram.__table__.delete())
+
+        table = CrowdUser.__table__
+        columns = [table.c.id] + [table.c[name] for name in SEARCH_FIELDS]
+
+        last_id = 0
+        while True:
+            users = conn.execute(
+                sqla.select(columns).where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not users:
+                break
+
+            for user in users:
+                self.index(conn, user)
+            last_id = users[-1].id
+
+    def clause(self, term):
+        term = term.lower()
+        if len(term) < 3:
+            return like_clause(term)
+
+        grams = set(term[i:i+3] for i in range(len(term) - 2))
+        ids = sqla.select([CrowdUserNgram.user_id])\
+            .where(CrowdUserNgram.gram.in_(grams))\
+            .group_by(CrowdUserNgram.user_id)\
+            .having(sqla.func.count(
+                sqla.distinct(CrowdUserNgram.gram)) >= len(grams))
+        return sqla.sql.and_(CrowdUser.id.in_(ids), like_clause(term))
+
+    def search(self, session, term, limit, offset=0):
+        term = term.lower()
+        if len(term) < 3:
+            grams = session.query(CrowdUserNgram.user_id).filter(
+                CrowdUserNgram.gram.like(
+                    '%s%%' % escape_like(term), escape='\\'))
+            match = grams.distinct().subquery()
+            score = sqla.sql.literal(1)
+        else:
+            grams = set(term[i:i+3] for i in range(len(term) - 2))
+            match = session.query(
+                CrowdUserNgram.user_id,
+                sqla.func.count().label('score'))\
+                .filter(CrowdUserNgram.gram.in_(grams))\
+                .group_by(CrowdUserNgram.user_id)\
+                .having(sqla.func.count(
+                    sqla.distinct(CrowdUserNgram.gram)) >= len(grams))\
+                .subquery()
+            score = match.c.score
+
+        # candidates are verified against real values
+        q = session.query(CrowdUser.id)\
+            .join(match, match.c.user_id == CrowdUser.id)\
+            .filter(like_clause(term))\
+            .order_by(score.desc(), CrowdUser.id)
+
+        return [id for id, in q.offset(offset).limit(limit)]
+
+
+def install_backends(target, bind, **kw):
+    """ create database objects of search backends, newly installed
+    backends index existing users """
+    for backend in BACKENDS.values():
+        installed = backend.installed(bind)
+        backend.install(bind)
+        if not installed and backend.installed(bind):
+            log.info('Building "%s" users search index', backend.name)
+            backend.rebuild(bind)
+
+    # ngram table has been created for existing users table
+    if target is CrowdUserNgram.__table__:
+        BACKENDS['ngram'].rebuild(bind)
+
+sqla.event.listen(CrowdUserNgram.__table__, 'after_create', install_backends)
+
+
+def get_search_backend(conn=None, registry=None):
+    """ return configured search backend, `auto` selects installed
+    database specific backend or `ngram` """
+    name = ptah.get_settings(CFG_ID_CROWD, registry)['search-backend']
+    if name != 'auto':
+        return BACKENDS[name]
+
+    if conn is None:
+        conn = ptah.get_session().connection()
+
+    engine = conn.engine
+    backend = getattr(engine, '__ptahcrowd_search__', None)
+    if backend is None:
+        backend = BACKENDS['ngram']
+        for name in ('sqlite-fts', 'pg-trgm'):
+            if BACKENDS[name].installed(conn):
+                backend = BACKENDS[name]
+                break
+        engine.__ptahcrowd_search__ = backend
+
+    return backend
+
+
+def search_user_ids(term, limit=None, offset=0):
+    """ ranked user ids matching term """
+    if not term:
+        return []
+
+    if limit is None:
+        limit = ptah.get_settings(CFG_ID_CROWD)['search-limit']
+
+    session = ptah.get_session()
+    return get_search_backend().search(session, term, limit, offset)
+
+
+def users_clause(term=None, validated=None, suspended=None):
+    """ sql clause for all users matching search term and flags,
+    used by bulk operations """
+    clauses = []
+    if term:
+        clauses.append(get_search_backend().clause(term))
+    if validated is not None:
+        clauses.append(CrowdUser.validated == validated)
+    if suspended is not None:
+        clauses.append(CrowdUser.suspended == suspended)
+
+    if not clauses:
+        return sqla.sql.true()
+    return sqla.sql.and_(*clauses)
+
+
+def search_users(term, limit=None, offset=0):
+    """ ranked users matching term """
+    ids = search_user_ids(term, limit, offset)
+    if not ids:
+        return []
+
+    users = dict((user.id, user) for user in ptah.get_session()\
+                     .query(CrowdUser).filter(CrowdUser.id.in_(ids)))
+    return [users[id] for id in ids if id in users]
+
+
+def search_user_rows(term, limit=None, offset=0):
+    """ ranked users matching term as :py:class:`UserRow` """
+    ids = search_user_ids(term, limit, offset)
+    if not ids:
+        return []
+
+    users = dict((user.id, user) for user in UserRow.from_rows(
+        UserRow.query().filter(CrowdUser.id.in_(ids))))
+    return [users[id] for id in ids if id in users]
+
+
+def complete_groups(prefix, limit=20):
+    """ (uri, title) of groups with title starting with ``prefix``,
+    case insensitive, ordered by title. Lookup uses lower(title)
+    index, so cost does not depend on number of groups. """
+    session = ptah.get_session()
+    lower_title = sqla.func.lower(CrowdGroup.title)
+
+    q = session.query(CrowdGroup.id, CrowdGroup.title)
+    prefix = prefix.strip().lower()
+    if prefix:
+        if session.connection().dialect.name == 'sqlite':
+            # sqlite does not use expression index for LIKE
+            q = q.filter(lower_title >= prefix, lower_title < '%s%s' % (
+                prefix[:-1], chr(ord(prefix[-1]) + 1)))
+        else:
+            q = q.filter(
+                lower_title.like('%s%%' % escape_like(prefix), escape='\\'))
+
+    name = CrowdGroup.__type__.name
+    return [('%s:%s' % (name, id), title) for id, title in
+            q.order_by(lower_title, CrowdGroup.id).limit(limit)]
+
+
+def get_groups(uris):
+    """ (uri, title) of existing groups from ``uris``, ordered by title """
+    prefix = '%s:' % CrowdGroup.__type__.name
+    ids = set()
+    for uri in uris:
+        if uri.startswith(prefix) and uri[len(prefix):].isdigit():
+            ids.add(int(uri[len(prefix):]))
+
+    if not ids:
+        return []
+
+    q = ptah.get_session().query(CrowdGroup.id, CrowdGroup.title)\
+        .filter(CrowdGroup.id.in_(sorted(ids)))\
+        .order_by(CrowdGroup.title, CrowdGroup.id)
+    return [('%s%s' % (prefix, id), title) for id, title in q]
+
+
+def rebuild_index(registry=None):
+    backend = get_search_backend(registry=registry)
+    log.info('Rebuilding "%s" users search index', backend.name)
+    backend.rebuild(ptah.get_session().connection())
+
+
+def _ngram_backend(conn):
+    backend = get_search_backend(conn)
+    if isinstance(backend, NgramBackend):
+        return backend
+
+
+@sqla.event.listens_for(CrowdUser, 'after_insert', propagate=True)
+def user_inserted(mapper, conn, target):
+    backend = _ngram_backend(conn)
+    if backend is not None:
+        backend.index(conn, target)
+
+
+@sqla.event.listens_for(CrowdUser, 'after_update', propagate=True)
+def user_updated(mapper, conn, target):
+    backend = _ngram_backend(conn)
+    if backend is not None:
+        for name in SEARCH_FIELDS:
+            if attributes.get_history(target, name).has_changes():
+                backend.index(conn, target)
+                break
+
+
+@sqla.event.listens_for(CrowdUser, 'after_delete', propagate=True)
+def user_deleted(mapper, conn, target):
+    backend = _ngram_backend(conn)
+    if backend is not None:
+        backend.unindex(conn, target.id)
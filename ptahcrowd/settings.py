@@ -5,6 +5,7 @@ _ = translationstring.TranslationStringFactory('ptahcrowd')
 
 CFG_ID_AUTH = 'auth'
 CFG_ID_CROWD = 'ptahcrowd'
+CFG_ID_RATELIMIT = 'ptahcrowd-ratelimit'
 
 providers = ptah.form.Vocabulary(
     ptah.form.Term('bitbucket', 'bitbucket', 'Bitbucket'),
@@ -99,10 +100,304 @@ ptah.register_settings(
         description = 'Default admin role.',
         default = ''),
 
+    ptah.form.IntegerField(
+        'roles-cache-size',
+        title = 'Roles cache size',
+        description = ('Maximum number of principals with cached '
+                       'roles and groups.'),
+        default = 10000),
+
+    ptah.form.IntegerField(
+        'roles-cache-ttl',
+        title = 'Roles cache ttl',
+        description = ('Effective roles cache time to live in seconds, '
+                       '0 disables cache.'),
+        default = 60),
+
+    ptah.form.IntegerField(
+        'count-cache-ttl',
+        title = 'Count cache ttl',
+        description = 'Users and groups count cache time to live in seconds.',
+        default = 30),
+
+    ptah.form.IntegerField(
+        'count-approximate',
+        title = 'Approximate count',
+        description = ('Use database statistics instead of exact count '
+                       'for tables larger than this number of rows, '
+                       '0 disables approximate counts.'),
+        default = 100000),
+
+    ptah.form.TextField(
+        'hash-executor',
+        title = 'Password hashing executor',
+        description = ('Hash passwords in bounded pool: process, thread '
+                       'or empty for hashing in request thread.'),
+        default = ''),
+
+    ptah.form.IntegerField(
+        'hash-workers',
+        title = 'Password hashing workers',
+        description = 'Number of password hashing workers.',
+        default = 2),
+
+    ptah.form.IntegerField(
+        'hash-queue',
+        title = 'Password hashing queue',
+        description = 'Maximum number of waiting password hash operations.',
+        default = 16),
+
+    ptah.form.IntegerField(
+        'hash-timeout',
+        title = 'Password hashing timeout',
+        description = 'Seconds to wait for password hashing.',
+        default = 10),
+
+    ptah.form.TextField(
+        'pwd-manager',
+        title = 'Password manager',
+        description = ('Password manager for new passwords: pbkdf2 '
+                       'or empty for ptah password manager.'),
+        default = ''),
+
+    ptah.form.IntegerField(
+        'pwd-iterations',
+        title = 'Password iterations',
+        description = ('Number of pbkdf2 iterations, use '
+                       'ptahcrowd-calibrate to choose value.'),
+        default = 100000),
+
+    ptah.form.TextField(
+        'pwd-upgrade',
+        title = 'Password upgrade',
+        description = ('Rehash outdated passwords on login: background, '
+                       'inline or empty to disable.'),
+        default = 'background'),
+
+    ptah.form.BoolField(
+        'login-filter',
+        title = 'Login filter',
+        description = ('Reject unknown logins with in-memory bloom filter '
+                       'of usernames and emails.'),
+        default = False),
+
+    ptah.form.IntegerField(
+        'login-filter-fp-rate',
+        title = 'Login filter false positive rate',
+        description = ('One in N unknown logins passes filter '
+                       'and is looked up in database.'),
+        default = 100),
+
+    ptah.form.IntegerField(
+        'login-filter-memory',
+        title = 'Login filter memory',
+        description = 'Maximum login filter size in kilobytes.',
+        default = 16384),
+
+    ptah.form.IntegerField(
+        'login-filter-ttl',
+        title = 'Login filter ttl',
+        description = ('Rebuild login filter every N seconds, '
+                       '0 disables rebuild.'),
+        default = 300),
+
+    ptah.form.TextField(
+        'search-backend',
+        title = 'Search backend',
+        description = ('Users search backend: auto, sqlite-fts, '
+                       'pg-trgm or ngram.'),
+        default = 'auto'),
+
+    ptah.form.IntegerField(
+        'search-limit',
+        title = 'Search limit',
+        description = 'Maximum number of users search results.',
+        default = 100),
+
+    ptah.form.BoolField(
+        'janitor',
+        title = 'Janitor',
+        description = ('Run maintenance jobs in background thread, '
+                       'e.g. expired auth storage purge.'),
+        default = True),
+
+    ptah.form.IntegerField(
+        'janitor-interval',
+        title = 'Janitor interval',
+        description = 'Seconds between maintenance job runs.',
+        default = 3600),
+
+    ptah.form.IntegerField(
+        'janitor-batch',
+        title = 'Janitor batch size',
+        description = 'Number of rows processed in one transaction.',
+        default = 500),
+
+    ptah.form.BoolField(
+        'mail-queue',
+        title = 'Mail queue',
+        description = ('Queue validation, password reset and verification '
+                       'emails and send them in background thread.'),
+        default = False),
+
+    ptah.form.IntegerField(
+        'mail-queue-limit',
+        title = 'Mail queue limit',
+        description = ('Maximum number of queued messages, messages '
+                       'are sent synchronously when queue is full.'),
+        default = 10000),
+
+    ptah.form.IntegerField(
+        'mail-retries',
+        title = 'Mail delivery attempts',
+        description = 'Number of delivery attempts of queued message.',
+        default = 8),
+
+    ptah.form.IntegerField(
+        'mail-retry-delay',
+        title = 'Mail retry delay',
+        description = ('Seconds before second delivery attempt, '
+                       'delay doubles with each attempt.'),
+        default = 30),
+
+    ptah.form.IntegerField(
+        'mail-dead-ttl',
+        title = 'Undelivered mail ttl',
+        description = ('Seconds to keep messages which could not be '
+                       'delivered, 0 keeps them forever.'),
+        default = 604800),
+
+    ptah.form.TextField(
+        'mail-smtp-host',
+        title = 'SMTP host',
+        description = ('SMTP server of mail queue, ptah mailer is used '
+                       'if host is not set.'),
+        default = ''),
+
+    ptah.form.IntegerField(
+        'mail-smtp-port',
+        title = 'SMTP port',
+        description = 'SMTP server port.',
+        default = 25),
+
+    ptah.form.TextField(
+        'mail-smtp-username',
+        title = 'SMTP username',
+        description = 'SMTP server username.',
+        default = ''),
+
+    ptah.form.TextField(
+        'mail-smtp-password',
+        title = 'SMTP password',
+        description = 'SMTP server password.',
+        default = '',
+        tint = True),
+
+    ptah.form.BoolField(
+        'mail-smtp-tls',
+        title = 'SMTP STARTTLS',
+        description = 'Use STARTTLS.',
+        default = False),
+
+    ptah.form.IntegerField(
+        'mail-smtp-pool',
+        title = 'SMTP connections',
+        description = 'Maximum number of open SMTP connections.',
+        default = 2),
+
+    ptah.form.IntegerField(
+        'mail-smtp-timeout',
+        title = 'SMTP timeout',
+        description = 'SMTP connection timeout in seconds.',
+        default = 10),
+
     title = 'Ptah crowd settings',
     )
 
 
+ptah.register_settings(
+    CFG_ID_RATELIMIT,
+
+    ptah.form.BoolField(
+        'enabled',
+        title = 'Rate limiting',
+        description = ('Enable/Disable login, join, reset and verify limits, '
+                       'behind reverse proxy set trusted proxies.'),
+        default = False),
+
+    ptah.form.LinesField(
+        'trusted-proxies',
+        title = 'Trusted proxies',
+        description = ('Addresses of reverse proxies, client ip of their '
+                       'requests is taken from X-Forwarded-For header.'),
+        default = ()),
+
+    ptah.form.TextField(
+        'backend',
+        title = 'Backend',
+        description = ('Rate limit buckets backend: memory or file '
+                       '(shared by processes on same host).'),
+        default = 'memory'),
+
+    ptah.form.TextField(
+        'path',
+        title = 'File path',
+        description = 'File backend database path.',
+        default = ''),
+
+    ptah.form.TextField(
+        'login-ip',
+        title = 'Login attempts per ip',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '30/60'),
+
+    ptah.form.TextField(
+        'login-user',
+        title = 'Login attempts per login',
+        description = ('Limit per client ip and login as capacity/seconds, '
+                       'empty to disable.'),
+        default = '10/60'),
+
+    ptah.form.TextField(
+        'join-ip',
+        title = 'Registrations per ip',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '10/3600'),
+
+    ptah.form.TextField(
+        'join-email',
+        title = 'Registrations per email',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '5/3600'),
+
+    ptah.form.TextField(
+        'reset-ip',
+        title = 'Password resets per ip',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '10/3600'),
+
+    ptah.form.TextField(
+        'reset-user',
+        title = 'Password resets per login',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '3/3600'),
+
+    ptah.form.TextField(
+        'verify-ip',
+        title = 'Email verifications per ip',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '10/3600'),
+
+    ptah.form.TextField(
+        'verify-email',
+        title = 'Email verifications per email',
+        description = 'Limit as capacity/seconds, empty to disable.',
+        default = '5/3600'),
+
+    title = 'Ptah crowd rate limits',
+    )
+
+
 ptah.register_settings(
     CFG_ID_AUTH,
 
@@ -189,5 +484,45 @@ ptah.register_settings(
         default = '',
         tint = True),
 
+    ptah.form.FloatField(
+        'http-connect-timeout',
+        title = 'Connect timeout',
+        description = 'Provider http connect timeout in seconds.',
+        default = 5.0),
+
+    ptah.form.FloatField(
+        'http-read-timeout',
+        title = 'Read timeout',
+        description = 'Provider http read timeout in seconds.',
+        default = 10.0),
+
+    ptah.form.IntegerField(
+        'http-pool-size',
+        title = 'Connection pool size',
+        description = 'Kept alive connections per provider host.',
+        default = 10),
+
+    ptah.form.IntegerField(
+        'http-retries',
+        title = 'Retries',
+        description = ('Retries of failed connections and of idempotent '
+                       'requests with 502, 503 or 504 response.'),
+        default = 2),
+
+    ptah.form.IntegerField(
+        'storage-ttl',
+        title = 'Storage ttl',
+        description = ('Seconds to keep external access tokens and '
+                       'profiles, expired entries are removed by janitor, '
+                       'entries linked to users keep the link.'),
+        default = 2592000),
+
+    ptah.form.IntegerField(
+        'profile-ttl',
+        title = 'Profile ttl',
+        description = ('Seconds to reuse fetched provider profile of '
+                       'returning user, 0 disables profile cache.'),
+        default = 86400),
+
     title = 'Ptah external auth providers',
 )
@@ -0,0 +1,191 @@
+import time
+import ptah
+import ptahcrowd
+from ptah.testing import PtahTestCase
+
+
+class TestBloomFilter(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_bloom(self):
+        from ptahcrowd.bloom import BloomFilter
+
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user%s' % i)
+
+        for i in range(1000):
+            self.assertIn('user%s' % i, bloom)
+
+        false_positives = sum(
+            1 for i in range(10000) if 'unknown%s' % i in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_bloom_memory(self):
+        from ptahcrowd.bloom import BloomFilter
+
+        bloom = BloomFilter(1000000, 0.01, 1024)
+        self.assertEqual(len(bloom.bits), 1024)
+
+        bloom.add('user')
+        self.assertIn('user', bloom)
+
+
+class TestLoginFilter(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def setUp(self):
+        super(TestLoginFilter, self).setUp()
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['login-filter'] = True
+        self.registry.notify(ptah.events.SettingsInitialized(
+            self.config, self.registry))
+
+    def _make_user(self, username, email):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username=username, email=email)
+        return CrowdUser.__type__.add(user)
+
+    def test_disabled(self):
+        from ptahcrowd.bloom import LoginFilter
+
+        self.assertTrue(LoginFilter().might_exist('unknown'))
+
+    def _build(self):
+        from ptahcrowd.bloom import login_filter
+        self.assertTrue(login_filter.build(ptah.get_session().connection()))
+        return login_filter
+
+    def test_not_built(self):
+        from ptahcrowd.provider import CrowdAuthProvider
+
+        user = self._make_user('test', 'test@ptahproject.org')
+        self.assertIs(CrowdAuthProvider().get_principal_bylogin('test'), user)
+
+    def test_login_filter(self):
+        import sqlalchemy as sqla
+        from ptahcrowd.provider import CrowdAuthProvider
+
+        user = self._make_user('Test', 'Test@ptahproject.org')
+        login_filter = self._build()
+        provider = CrowdAuthProvider()
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = ptah.get_session().get_bind()
+        sqla.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            self.assertIs(provider.get_principal_bylogin('test'), user)
+            self.assertIsNotNone(login_filter.filter)
+
+            # unknown login does not touch database
+            del statements[:]
+            self.assertIsNone(provider.get_principal_bylogin('unknown'))
+            self.assertEqual(statements, [])
+        finally:
+            sqla.event.remove(engine, 'before_cursor_execute', count)
+
+        self.assertIs(
+            provider.get_principal_bylogin('test@ptahproject.org'), user)
+
+    def test_login_filter_updates(self):
+        from ptahcrowd.provider import CrowdAuthProvider
+
+        self._make_user('test', 'test@ptahproject.org')
+        login_filter = self._build()
+        provider = CrowdAuthProvider()
+        self.assertIsNone(provider.get_principal_bylogin('unknown'))
+
+        user = self._make_user('new', 'new@ptahproject.org')
+        self.assertIn('new', login_filter.filter)
+        self.assertIs(provider.get_principal_bylogin('new'), user)
+
+        user.username = 'renamed'
+        ptah.get_session().flush()
+        self.assertIs(provider.get_principal_bylogin('renamed'), user)
+
+    def test_login_filter_other_process(self):
+        from ptahcrowd.bloom import LoginFilter
+        from ptahcrowd.provider import CrowdUser, CrowdAuthProvider
+
+        user = self._make_user('test', 'test@ptahproject.org')
+        login_filter = self._build()
+        provider = CrowdAuthProvider()
+
+        # user added by other process
+        conn = ptah.get_session().connection()
+        conn.execute(CrowdUser.__table__.insert().values(
+            username='other', email='other@ptahproject.org'))
+        self.assertFalse(login_filter.might_exist('other'))
+
+        # background refresh adds users by primary key range
+        self.assertEqual(login_filter.refresh(conn), 2)
+        self.assertIn('other', login_filter.filter)
+        self.assertIn('other@ptahproject.org', login_filter.filter)
+        self.assertIsNotNone(provider.get_principal_bylogin('other'))
+        self.assertEqual(login_filter.refresh(conn), 0)
+
+        # user renamed by other process
+        conn.execute(CrowdUser.__table__.update()
+                     .where(CrowdUser.__table__.c.id == user.id)
+                     .values(username='renamed'))
+        LoginFilter(enabled=True).changed(conn, 'renamed')
+        self.assertFalse(login_filter.might_exist('renamed'))
+        self.assertEqual(login_filter.refresh(conn), 1)
+        self.assertTrue(login_filter.might_exist('renamed'))
+        self.assertFalse(login_filter.might_exist('unknown'))
+
+    def test_login_filter_stale(self):
+        from ptahcrowd.bloom import login_filter
+
+        now = [1000]
+        login_filter.timer = lambda: now[0]
+        try:
+            self._build()
+            self.assertFalse(login_filter.needs_rebuild())
+            self.assertFalse(login_filter.might_exist('unknown'))
+
+            now[0] += login_filter.ttl + 1
+            self.assertTrue(login_filter.needs_rebuild())
+            self.assertFalse(login_filter.might_exist('unknown'))
+
+            # filter is not used if it is not refreshed
+            now[0] += login_filter.ttl
+            self.assertTrue(login_filter.might_exist('unknown'))
+
+            login_filter.refresh(ptah.get_session().connection())
+            self.assertFalse(login_filter.might_exist('unknown'))
+            self.assertTrue(login_filter.needs_rebuild())
+
+            self._build()
+            self.assertFalse(login_filter.might_exist('unknown'))
+        finally:
+            login_filter.timer = time.time
+
+    def test_start_disabled(self):
+        from ptahcrowd.bloom import LoginFilter
+
+        self.assertFalse(LoginFilter().start())
+
+    def test_purge_login_changes(self):
+        from datetime import datetime, timedelta
+        from ptahcrowd.bloom import LoginChange, purge_login_changes_batch
+
+        session = ptah.get_session()
+        old = datetime.utcnow() - timedelta(days=1)
+        for idx in range(3):
+            session.add(LoginChange(login='user%s' % idx, changed=old))
+        session.add(LoginChange(login='new', changed=datetime.utcnow()))
+        session.flush()
+
+        conn = session.connection()
+        self.assertEqual(purge_login_changes_batch(conn, 2), 2)
+        self.assertEqual(purge_login_changes_batch(conn, 2), 1)
+        self.assertEqual(
+            [c.login for c in session.query(LoginChange)], ['new'])
@@ -0,0 +1,113 @@
+import io
+import ptah
+from ptah.testing import PtahTestCase
+
+CSV = '''username,email,fullname,password,validated
+User1,user1@ptahproject.org,User 1,12345,yes
+user2,user2@ptahproject.org,,12345,no
+,user3@ptahproject.org,,12345,
+user4,wrong-email,,12345,
+USER1,user5@ptahproject.org,,12345,
+existing,user6@ptahproject.org,,12345,
+user7,user7@ptahproject.org,,,
+'''
+
+
+class TestBulkImport(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def setUp(self):
+        super(TestBulkImport, self).setUp()
+
+        from ptahcrowd.provider import CrowdUser
+        CrowdUser.__type__.add(
+            CrowdUser(username='existing', email='existing@ptahproject.org'))
+
+    def test_import_csv(self):
+        from ptahcrowd.bulkimport import import_users
+        from ptahcrowd.provider import CrowdUser, CrowdAuthProvider
+
+        report = import_users(
+            io.BytesIO(CSV.encode('utf-8')), 'csv', chunk_size=3)
+
+        self.assertEqual(report.total, 7)
+        self.assertEqual(report.created, 3)
+        self.assertEqual(report.failed, 4)
+        self.assertEqual([line for line, msg in report.errors], [4, 5, 6, 7])
+
+        user = CrowdUser.get_byusername('user1')
+        self.assertEqual(user.email, 'user1@ptahproject.org')
+        self.assertEqual(user.fullname, 'User 1')
+        self.assertTrue(user.validated)
+        self.assertFalse(user.suspended)
+        self.assertIsNotNone(user.joined)
+        self.assertFalse(CrowdUser.get_byusername('user2').validated)
+
+        provider = CrowdAuthProvider()
+        self.assertIs(
+            provider.authenticate({'login': 'user1', 'password': '12345'}),
+            user)
+
+        # user without password can't login
+        self.assertIsNotNone(CrowdUser.get_byusername('user7'))
+        self.assertIsNone(
+            provider.authenticate({'login': 'user7', 'password': ''}))
+
+    def test_import_dry_run(self):
+        from ptahcrowd.bulkimport import import_users
+        from ptahcrowd.provider import CrowdUser
+
+        report = import_users(io.StringIO(CSV), 'csv', dry_run=True)
+
+        self.assertTrue(report.dry_run)
+        self.assertEqual(report.created, 3)
+        self.assertEqual(report.failed, 4)
+        self.assertIsNone(CrowdUser.get_byusername('user1'))
+
+    def test_import_jsonl(self):
+        from ptahcrowd.bulkimport import import_users
+        from ptahcrowd.provider import CrowdUser
+
+        data = io.StringIO(
+            '{"username": "user1", "email": "user1@ptahproject.org", '
+            '"suspended": true}\n'
+            '\n'
+            'broken\n'
+            '["user2"]\n')
+
+        report = import_users(data, 'jsonl')
+        self.assertEqual(report.created, 1)
+        self.assertEqual(report.errors, [(3, 'Wrong row format.'),
+                                         (4, 'Wrong row format.')])
+        self.assertTrue(CrowdUser.get_byusername('user1').suspended)
+
+    def test_import_chunk_queries(self):
+        import sqlalchemy as sqla
+        from ptahcrowd.bulkimport import UserImporter
+
+        rows = [(idx, {'username': 'user%s' % idx,
+                       'email': 'user%s@ptahproject.org' % idx})
+                for idx in range(10)]
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = ptah.get_session().get_bind()
+        sqla.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            report = UserImporter(chunk_size=5, dry_run=True)(rows)
+        finally:
+            sqla.event.remove(engine, 'before_cursor_execute', count)
+
+        self.assertEqual(report.created, 10)
+        self.assertEqual(len(statements), 2)
+
+    def test_import_search_index(self):
+        from ptahcrowd.bulkimport import import_users
+        from ptahcrowd.search import search_users
+
+        import_users(io.StringIO(CSV), 'csv')
+        self.assertEqual([u.username for u in search_users('user1')],
+                         ['user1'])
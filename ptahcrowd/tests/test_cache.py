@@ -0,0 +1,187 @@
+import ptah
+from zope.interface import implementer
+from ptah.testing import PtahTestCase
+
+
+class TestLRUCache(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_lru_cache(self):
+        from ptahcrowd.cache import LRUCache
+
+        cache = LRUCache(2, 10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_ttl(self):
+        from ptahcrowd.cache import LRUCache
+
+        now = [100]
+        cache = LRUCache(10, 10, timer=lambda: now[0])
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        now[0] = 111
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_update(self):
+        from ptahcrowd.cache import LRUCache
+
+        now = [100]
+        cache = LRUCache(10, 10, timer=lambda: now[0])
+        cache.set('a', 1)
+        cache.update('a', lambda value: value + 1)
+        cache.update('b', lambda value: value + 1)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertIsNone(cache.get('b'))
+
+        # expiration time is not changed
+        now[0] = 111
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_cache_disabled(self):
+        from ptahcrowd.cache import LRUCache
+
+        cache = LRUCache(10, 0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TestRolesCache(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_roles_cache(self):
+        from ptahcrowd.cache import RolesCache
+
+        data = (('Manager',), ('grp:1',))
+
+        cache = RolesCache()
+        version = cache.get_version('uid')
+        cache.set('uid', version, data)
+        self.assertEqual(cache.get('uid'), data)
+
+        cache.invalidate('uid')
+        self.assertIsNone(cache.get('uid'))
+
+        # result computed before invalidation is not stored
+        cache.set('uid', version, data)
+        self.assertIsNone(cache.get('uid'))
+
+        cache.set('uid', cache.get_version('uid'), data)
+        cache.invalidate()
+        self.assertIsNone(cache.get('uid'))
+
+    def test_roles_cache_principal_event(self):
+        from ptahcrowd.cache import roles_cache
+        from ptahcrowd.provider import CrowdUser, crowd_user_roles
+
+        user = CrowdUser(username='username', email='email')
+        user.properties['roles'] = ('Manager',)
+        CrowdUser.__type__.add(user)
+        uri = user.__uri__
+
+        crowd_user_roles(None, uri, self.registry)
+        self.assertEqual(roles_cache.get(uri), (('Manager',), ()))
+
+        self.registry.notify(ptah.events.PrincipalValidatedEvent(user))
+        self.assertIsNone(roles_cache.get(uri))
+
+    def test_roles_cache_local_roles(self):
+        from ptahcrowd.provider import CrowdUser, CrowdGroup
+        from ptahcrowd.provider import CrowdGroupMember, crowd_user_roles
+        from ptahcrowd.provider import reset_roles_memo
+
+        user = CrowdUser(username='username', email='email')
+        CrowdUser.__type__.add(user)
+        group = CrowdGroup(title='group')
+        CrowdGroup.__type__.add(group)
+        CrowdGroupMember.set_groups(user.id, (group.__uri__,))
+
+        @implementer(ptah.ILocalRolesAware)
+        class Context(object):
+            __uri__ = 'test:1'
+            __parent__ = None
+            __local_roles__ = {group.__uri__: ['Editor']}
+
+        context = Context()
+        self.assertEqual(
+            crowd_user_roles(context, user.__uri__, self.registry),
+            set(['Editor']))
+
+        # local roles change is not cached
+        context.__local_roles__ = {}
+        reset_roles_memo()
+        self.assertEqual(
+            crowd_user_roles(context, user.__uri__, self.registry), set())
+
+    def test_roles_cache_settings(self):
+        from ptahcrowd.cache import roles_cache
+
+        cfg = ptah.get_settings('ptahcrowd', self.registry)
+        self.assertEqual(roles_cache.data.size, cfg['roles-cache-size'])
+        self.assertEqual(roles_cache.data.ttl, cfg['roles-cache-ttl'])
+
+
+class TestRowCounter(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_row_counter(self):
+        from ptahcrowd.cache import RowCounter
+        from ptahcrowd.provider import CrowdUser
+
+        counter = RowCounter()
+        self.assertEqual(counter.count(CrowdUser), (0, True))
+
+        CrowdUser.__type__.add(CrowdUser(username='user', email='email'))
+        self.assertEqual(counter.count(CrowdUser), (0, True))
+
+        counter.bump(CrowdUser, 1)
+        self.assertEqual(counter.count(CrowdUser), (1, True))
+
+        counter.bump(CrowdUser, -5)
+        self.assertEqual(counter.count(CrowdUser), (0, True))
+
+        counter.invalidate(CrowdUser)
+        self.assertEqual(counter.count(CrowdUser), (1, True))
+
+    def test_row_counter_estimate(self):
+        from ptahcrowd.cache import RowCounter
+        from ptahcrowd.provider import CrowdUser
+
+        class Counter(RowCounter):
+            def estimate(self, session, table):
+                return 200000
+
+        counter = Counter()
+        self.assertEqual(counter.count(CrowdUser), (200000, False))
+
+        counter = Counter(approximate=0)
+        self.assertEqual(counter.count(CrowdUser), (0, True))
+
+    def test_row_counter_principal_added(self):
+        from ptahcrowd.cache import row_counter
+        from ptahcrowd.provider import CrowdUser
+
+        self.assertEqual(row_counter.count(CrowdUser), (0, True))
+
+        user = CrowdUser.__type__.add(
+            CrowdUser(username='user', email='email'))
+        self.registry.notify(ptah.events.PrincipalAddedEvent(user))
+        self.assertEqual(row_counter.count(CrowdUser), (1, True))
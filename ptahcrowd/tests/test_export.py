@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+import ptah
+from ptah.testing import PtahTestCase
+from webob.multidict import MultiDict
+
+
+class TestExport(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+
+        from ptahcrowd.module import CrowdModule
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.providers import Storage
+
+        self.mod = CrowdModule(None, self.make_request())
+
+        self.user1 = CrowdUser.__type__.add(CrowdUser(
+            username='user1', email='user1@ptahproject.org',
+            fullname='User 1', validated=True))
+        self.user2 = CrowdUser.__type__.add(CrowdUser(
+            username='user2', email='user2@ptahproject.org',
+            validated=False))
+
+        entry = Storage.create('token', 'github', uid='github-1')
+        entry.uri = self.user1.__uri__
+        ptah.get_session().flush()
+
+    def _export(self, name, params=None, term=None):
+        from pyramid.view import render_view_to_response
+
+        request = self.make_request(params=MultiDict(params or {}))
+        if term:
+            request.session['ptah-search-term'] = term
+
+        res = render_view_to_response(self.mod, request, name)
+        return res, b''.join(res.app_iter).decode('utf-8')
+
+    def test_export_csv(self):
+        res, body = self._export('export.csv')
+
+        self.assertEqual(res.content_type, 'text/csv')
+        self.assertIn('users.csv', res.content_disposition)
+
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual([r['username'] for r in rows], ['user1', 'user2'])
+        self.assertEqual(rows[0]['providers'], 'github')
+        self.assertEqual(rows[0]['fullname'], 'User 1')
+        self.assertEqual(rows[0]['validated'], 'True')
+        self.assertEqual(rows[1]['providers'], '')
+
+    def test_export_jsonl(self):
+        res, body = self._export('export.jsonl')
+
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([r['id'] for r in rows],
+                         [self.user1.id, self.user2.id])
+        self.assertEqual(rows[0]['providers'], ['github'])
+        self.assertIs(rows[1]['validated'], False)
+
+    def test_export_filter(self):
+        res, body = self._export('export.jsonl', {'validated': '0'})
+        self.assertEqual([json.loads(line)['username']
+                          for line in body.splitlines()], ['user2'])
+
+        res, body = self._export('export.jsonl', term='user1@')
+        self.assertEqual([json.loads(line)['username']
+                          for line in body.splitlines()], ['user1'])
+
+    def test_export_batches(self):
+        from ptahcrowd.export import iter_users
+        from ptahcrowd.search import users_clause
+
+        batches = list(iter_users(users_clause(), batch_size=1))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0][0]['providers'], ['github'])
@@ -0,0 +1,194 @@
+import threading
+import ptah
+import ptahcrowd
+from ptah.testing import PtahTestCase
+
+
+class TestHashingExecutor(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_inline(self):
+        from ptahcrowd.hashing import HashingExecutor
+
+        executor = HashingExecutor()
+        self.assertEqual(executor(lambda a, b: a + b, 1, 2), 3)
+        self.assertIsNone(executor.executor)
+
+    def test_thread(self):
+        from ptahcrowd.hashing import HashingExecutor
+
+        executor = HashingExecutor('thread', 2, 2, 5)
+        try:
+            self.assertEqual(executor(lambda a, b: a + b, 1, 2), 3)
+            self.assertIsNotNone(executor.executor)
+        finally:
+            executor.shutdown()
+
+    def test_process(self):
+        from ptah.password import SSHAPasswordManager
+        from ptahcrowd.hashing import HashingExecutor
+
+        manager = SSHAPasswordManager()
+        executor = HashingExecutor('process', 1, 1, 30)
+        try:
+            encoded = executor(manager.encode, '12345')
+            self.assertTrue(manager.check(encoded, '12345'))
+            self.assertTrue(executor(manager.check, encoded, '12345'))
+        finally:
+            executor.shutdown()
+
+    def test_busy(self):
+        from ptahcrowd.hashing import HashingExecutor, HashingBusy
+
+        executor = HashingExecutor('thread', 1, 0, 0.1)
+        event = threading.Event()
+        started = threading.Event()
+
+        def wait():
+            started.set()
+            event.wait(5)
+
+        thread = threading.Thread(target=lambda: self.assertRaises(
+            HashingBusy, executor, wait))
+        thread.start()
+        started.wait(5)
+        try:
+            self.assertRaises(HashingBusy, executor, lambda: None)
+        finally:
+            event.set()
+            thread.join()
+            executor.shutdown()
+
+
+class TestHashing(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_encode_check(self):
+        from ptahcrowd.hashing import encode_password, check_password
+
+        encoded = encode_password('12345')
+        self.assertTrue(ptah.pwd_tool.check(encoded, '12345'))
+        self.assertTrue(check_password(encoded, '12345'))
+        self.assertFalse(check_password(encoded, '56789'))
+        self.assertFalse(check_password('{unknown}12345', '12345'))
+        self.assertTrue(check_password('12345', '12345'))
+
+    def test_settings(self):
+        from ptahcrowd.hashing import executor
+
+        cfg = ptah.get_settings('ptahcrowd', self.registry)
+        self.assertEqual(executor.kind, cfg['hash-executor'])
+        self.assertEqual(executor.workers, cfg['hash-workers'])
+
+
+class TestPBKDF2(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_pbkdf2(self):
+        from ptahcrowd.hashing import PBKDF2PasswordManager
+
+        manager = PBKDF2PasswordManager(1000)
+        encoded = manager.encode('12345')
+        self.assertTrue(encoded.startswith('{pbkdf2}1000$'))
+        self.assertTrue(manager.check(encoded, '12345'))
+        self.assertFalse(manager.check(encoded, '56789'))
+        self.assertFalse(manager.check('{pbkdf2}broken', '12345'))
+        self.assertTrue(ptah.pwd_tool.check(encoded, '12345'))
+
+    def test_calibrate(self):
+        from ptahcrowd.calibrate import calibrate
+
+        # check time grows linearly, 1ms per 1000 iterations
+        iterations, elapsed = calibrate(
+            0.25, measure=lambda iterations, rounds: iterations / 1000000.0)
+        self.assertEqual(iterations, 250000)
+        self.assertEqual(elapsed, 0.25)
+
+
+class TestPasswordUpgrade(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_user(self, password):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username='test', email='test@ptahproject.org',
+                         password=password)
+        return CrowdUser.__type__.add(user)
+
+    def test_needs_rehash(self):
+        from ptahcrowd.hashing import needs_rehash, PBKDF2PasswordManager
+
+        self.assertFalse(needs_rehash('{plain}12345'))
+        self.assertTrue(needs_rehash('{ssha}12345'))
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['pwd-manager'] = 'pbkdf2'
+        cfg['pwd-iterations'] = 1000
+
+        self.assertTrue(needs_rehash('{plain}12345'))
+        self.assertTrue(
+            needs_rehash(PBKDF2PasswordManager(2000).encode('12345')))
+        self.assertFalse(
+            needs_rehash(PBKDF2PasswordManager(1000).encode('12345')))
+
+    def test_upgrade_inline(self):
+        from ptahcrowd.provider import CrowdAuthProvider
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['pwd-manager'] = 'pbkdf2'
+        cfg['pwd-iterations'] = 1000
+        cfg['pwd-upgrade'] = 'inline'
+
+        user = self._make_user('{plain}12345')
+
+        provider = CrowdAuthProvider()
+        self.assertIs(
+            provider.authenticate({'login': 'test', 'password': '12345'}),
+            user)
+        self.assertTrue(user.password.startswith('{pbkdf2}1000$'))
+        self.assertTrue(
+            provider.authenticate({'login': 'test', 'password': '12345'}))
+
+        # failed login does not upgrade
+        cfg['pwd-iterations'] = 2000
+        encoded = user.password
+        self.assertIsNone(
+            provider.authenticate({'login': 'test', 'password': '56789'}))
+        self.assertEqual(user.password, encoded)
+
+    def test_upgrade_disabled(self):
+        from ptahcrowd.provider import CrowdAuthProvider
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['pwd-manager'] = 'pbkdf2'
+        cfg['pwd-upgrade'] = ''
+
+        user = self._make_user('{plain}12345')
+        CrowdAuthProvider().authenticate(
+            {'login': 'test', 'password': '12345'})
+        self.assertEqual(user.password, '{plain}12345')
+
+    def test_upgrade_coalesced(self):
+        from ptahcrowd.hashing import PasswordUpgrader
+
+        user = self._make_user('{plain}12345')
+
+        jobs = []
+        class Worker(object):
+            def submit(self, *args):
+                jobs.append(args)
+
+        upgrader = PasswordUpgrader()
+        upgrader.get_worker = lambda: Worker()
+
+        self.assertTrue(upgrader(user, '12345'))
+        self.assertFalse(upgrader(user, '12345'))
+        self.assertEqual(len(jobs), 1)
+
+        upgrader.done(user.id)
+        self.assertTrue(upgrader(user, '12345'))
+        self.assertEqual(len(jobs), 2)
@@ -0,0 +1,127 @@
+import threading
+import socketserver
+import requests
+from requests.adapters import BaseAdapter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from ptah.testing import PtahTestCase
+
+
+class RecordingAdapter(BaseAdapter):
+
+    def __init__(self):
+        super(RecordingAdapter, self).__init__()
+        self.requests = []
+
+    def send(self, request, **kw):
+        self.requests.append((request.url, kw.get('timeout')))
+        response = requests.Response()
+        response.status_code = 200
+        response.url = request.url
+        response._content = b'{}'
+        return response
+
+    def close(self):
+        pass
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestHTTPSessions(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_session_per_provider(self):
+        from ptahcrowd.providers.httpclient import HTTPSessions
+
+        sessions = HTTPSessions()
+        github = sessions.get('github')
+
+        self.assertIs(sessions.get('github'), github)
+        self.assertIsNot(sessions.get('google'), github)
+
+    def test_pool(self):
+        from ptahcrowd.providers.httpclient import HTTPSessions
+
+        sessions = HTTPSessions(pool_size=3, retries=4)
+        adapter = sessions.get('github').get_adapter('https://github.com')
+
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.total, 4)
+
+    def test_timeout(self):
+        from ptahcrowd.providers.httpclient import HTTPSessions
+
+        sessions = HTTPSessions(timeout=(1, 2))
+        session = sessions.get('github')
+        adapter = RecordingAdapter()
+        session.mount('mock://', adapter)
+
+        self.assertEqual(session.get('mock://token').status_code, 200)
+        session.get('mock://profile', timeout=5)
+
+        self.assertEqual(adapter.requests,
+                         [('mock://token', (1, 2)), ('mock://profile', 5)])
+
+    def test_configure(self):
+        from ptahcrowd.providers.httpclient import HTTPSessions
+
+        sessions = HTTPSessions()
+        github = sessions.get('github')
+
+        sessions.configure((3, 4), 5, 0)
+        session = sessions.get('github')
+        self.assertIsNot(session, github)
+        self.assertEqual(session.timeout, (3, 4))
+
+    def test_keep_alive_two_hosts(self):
+        from ptahcrowd.providers.httpclient import HTTPSessions
+
+        # token and profile endpoints are on different hosts
+        token, profile = KeepAliveServer(), KeepAliveServer()
+        session = HTTPSessions().get('google')
+        try:
+            for idx in range(5):
+                self.assertEqual(session.get(token.url).status_code, 200)
+                self.assertEqual(session.get(profile.url).status_code, 200)
+        finally:
+            session.close()
+            token.stop()
+            profile.stop()
+
+        self.assertEqual((token.connections, profile.connections), (1, 1))
@@ -0,0 +1,227 @@
+import ptah
+import ptahcrowd
+from datetime import datetime, timedelta
+from ptah.testing import PtahTestCase
+
+
+class TestJanitor(PtahTestCase):
+
+    _init_ptah = False
+
+    def _make_janitor(self, now):
+        from ptahcrowd.janitor import Janitor
+
+        janitor = Janitor(timer=lambda: now[0])
+        janitor.batch_size = 10
+        janitor.pause = 0
+        return janitor
+
+    def test_run_job_batches(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+
+        rows = [25]
+        calls = []
+
+        def job(engine, batch_size):
+            count = min(rows[0], batch_size)
+            rows[0] -= count
+            calls.append(count)
+            return count
+
+        janitor.add_job('test', job)
+        self.assertEqual(janitor.run_pending(engine=object()), {'test': 25})
+        self.assertEqual(calls, [10, 10, 5])
+
+    def test_run_job_max_batches(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+        janitor.max_batches = 3
+
+        janitor.add_job('test', lambda engine, batch_size: batch_size)
+        self.assertEqual(janitor.run_pending(engine=object()), {'test': 30})
+
+    def test_run_job_error(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+
+        def job(engine, batch_size):
+            raise ValueError()
+
+        janitor.add_job('test', job)
+        self.assertEqual(janitor.run_pending(engine=object()), {'test': 0})
+
+    def test_run_pending_interval(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+        janitor.add_job('test', lambda engine, batch_size: 0, interval=60)
+
+        self.assertEqual(janitor.run_pending(engine=object()), {'test': 0})
+        self.assertEqual(janitor.run_pending(engine=object()), {})
+
+        now[0] = 160
+        self.assertEqual(janitor.run_pending(engine=object()), {'test': 0})
+
+    def test_start_disabled(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+        janitor.add_job('test', lambda engine, batch_size: 0)
+
+        self.assertFalse(janitor.start())
+
+    def test_start_stop(self):
+        now = [100]
+        janitor = self._make_janitor(now)
+        janitor.enabled = True
+        janitor.tick = 0.01
+
+        calls = []
+        janitor.add_job(
+            'test', lambda engine, batch_size: calls.append(1) or 0)
+        janitor.run_pending = lambda engine=None: calls.append(1)
+
+        self.assertTrue(janitor.start())
+        self.assertFalse(janitor.start())
+        janitor.stop()
+        self.assertIsNone(janitor.thread)
+        self.assertTrue(calls)
+
+
+class TestJanitorSettings(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def tearDown(self):
+        from ptahcrowd.providers import Storage
+        Storage.ttl = 2592000
+        super(TestJanitorSettings, self).tearDown()
+
+    def test_settings(self):
+        from ptahcrowd.janitor import janitor
+        from ptahcrowd.providers import Storage
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['janitor-interval'] = 60
+        cfg['janitor-batch'] = 20
+        ptah.get_settings(
+            ptahcrowd.CFG_ID_AUTH, self.registry)['storage-ttl'] = 3600
+        self.registry.notify(ptah.events.SettingsInitialized(
+            self.config, self.registry))
+
+        self.assertEqual(janitor.batch_size, 20)
+        self.assertIn('auth-storage-purge', janitor.jobs)
+        self.assertEqual(janitor.jobs['auth-storage-purge'].interval, 60)
+        self.assertEqual(Storage.ttl, 3600)
+
+
+class TestStoragePurge(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_entry(self, idx, expires):
+        from ptahcrowd.providers import Storage
+
+        entry = Storage.create('token-%s' % idx, 'github',
+                               uid='github-%s' % idx, expires=expires)
+        ptah.get_session().flush()
+        return entry
+
+    def test_create_expires(self):
+        from ptahcrowd.providers import Storage
+
+        entry = Storage.create('token', 'github', uid='github-1')
+        self.assertGreater(entry.expires, datetime.utcnow())
+        self.assertLessEqual(
+            entry.expires,
+            datetime.utcnow() + timedelta(seconds=Storage.ttl))
+
+    def test_delete(self):
+        from ptahcrowd.providers import Storage
+
+        self._make_entry(1, None)
+        Storage.delete('token-1')
+        self.assertIsNone(Storage.get_by_token('token-1'))
+
+    def test_purge_expired(self):
+        from ptahcrowd.providers import Storage
+
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        for idx in range(5):
+            self._make_entry(idx, past)
+        self._make_entry(10, future)
+
+        self.assertEqual(Storage.purge_expired(batch_size=2), 5)
+        self.assertEqual(
+            [e.access_token for e in ptah.get_session().query(Storage)],
+            ['token-10'])
+
+    def test_purge_expired_batch(self):
+        from ptahcrowd.providers import Storage, purge_expired_batch
+
+        past = datetime.utcnow() - timedelta(days=1)
+        for idx in range(3):
+            self._make_entry(idx, past - timedelta(minutes=idx))
+
+        conn = ptah.get_session().connection()
+        self.assertEqual(purge_expired_batch(conn, 2), 2)
+
+        # oldest entries are removed first
+        self.assertEqual(
+            [e.access_token for e in ptah.get_session().query(Storage)],
+            ['token-0'])
+
+    def test_purge_expired_linked(self):
+        from ptahcrowd.providers import Storage
+        from ptahcrowd.providers import purge_expired_batch, set_expires_batch
+
+        session = ptah.get_session()
+        past = datetime.utcnow() - timedelta(days=1)
+        entry = self._make_entry(1, past)
+        entry.uri = 'crowd-user:1'
+        entry.profile = {'id': 1}
+        self._make_entry(2, past)
+        session.flush()
+
+        conn = session.connection()
+        self.assertEqual(purge_expired_batch(conn, 10), 2)
+        self.assertEqual(purge_expired_batch(conn, 10), 0)
+
+        # link to user is kept, token and profile are cleared
+        session.expire_all()
+        entry = session.query(Storage).one()
+        self.assertEqual(entry.uid, 'github-1')
+        self.assertEqual(entry.uri, 'crowd-user:1')
+        self.assertEqual(entry.access_token, 'expired:github-1')
+        self.assertIsNone(entry.profile)
+        self.assertIsNone(entry.fetched)
+        self.assertIsNone(entry.expires)
+        self.assertIsNone(Storage.get_by_token('token-1'))
+
+        # cleared entry does not expire again
+        self.assertEqual(set_expires_batch(conn, 10), 0)
+
+        # returning user gets new token for the same link
+        entry = Storage.create('token-3', 'github', uid='github-1')
+        self.assertEqual(entry.uri, 'crowd-user:1')
+        self.assertIsNotNone(entry.expires)
+
+    def test_set_expires_batch(self):
+        from ptahcrowd.providers import Storage, set_expires_batch
+
+        session = ptah.get_session()
+        for idx in range(3):
+            self._make_entry(idx, None)
+        session.query(Storage).update(
+            {'expires': None}, synchronize_session=False)
+
+        conn = session.connection()
+        now = datetime.utcnow()
+        self.assertEqual(set_expires_batch(conn, 2, now), 2)
+        self.assertEqual(set_expires_batch(conn, 2, now), 1)
+        self.assertEqual(set_expires_batch(conn, 2, now), 0)
+
+        session.expire_all()
+        self.assertEqual(
+            set(e.expires for e in session.query(Storage)),
+            set([now + timedelta(seconds=Storage.ttl)]))
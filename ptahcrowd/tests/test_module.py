@@ -42,6 +42,23 @@ class TestModule(PtahTestCase):
         self.assertIsInstance(wu, CrowdUser)
         self.assertEqual(wu.__uri__, uri)
 
+    def test_groups_autocomplete(self):
+        from ptahcrowd.module import CrowdModule
+        from ptahcrowd.provider import CrowdGroup
+        from ptahcrowd.views import groups_autocomplete
+
+        for title in ('Editors', 'editors-2', 'Admins'):
+            CrowdGroup.__type__.add(CrowdGroup(title=title))
+
+        mod = CrowdModule(None, self.make_request())
+        self.assertRaises(KeyError, mod.__getitem__, 'groups.json')
+
+        request = self.make_request(params={'term': 'EDI'})
+        res = groups_autocomplete(mod, request)
+        self.assertEqual([item['label'] for item in res],
+                         ['Editors', 'editors-2'])
+        self.assertTrue(res[0]['value'].startswith('ptah-crowd-group:'))
+
 
 class TestModuleView(PtahTestCase):
 
@@ -130,6 +147,68 @@ class TestModuleView(PtahTestCase):
 
         self.assertIn('value="%s"'%user.id, res.text)
 
+    def test_module_list_keyset(self):
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        user = self._make_user()
+
+        request = self.make_request(
+            params = MultiDict({'sort': 'joined'}), POST = MultiDict())
+        res = render_view_to_response(mod, request, '')
+        self.assertIn('value="%s"'%user.id, res.text)
+
+        view = CrowdModuleView(mod, self.make_request(
+            params = MultiDict(), POST = MultiDict()))
+        view.csrf = False
+        view.keyset_threshold = 0
+        view.update_form()
+        self.assertTrue(view.keyset)
+        self.assertEqual(view.sort, 'id')
+        self.assertEqual([u.id for u in view.users], [user.id])
+
+    def test_module_list_rows(self):
+        from ptahcrowd.provider import UserRow
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        user = self._make_user()
+
+        for params, session in ((MultiDict(), {}),
+                                (MultiDict({'sort': 'id'}), {}),
+                                (MultiDict(), {'ptah-search-term': 'email'})):
+            view = CrowdModuleView(mod, self.make_request(
+                params=params, POST=MultiDict(), session=session))
+            view.csrf = False
+            view.update_form()
+
+            self.assertEqual(len(view.users), 1)
+            self.assertIsInstance(view.users[0], UserRow)
+            self.assertEqual(view.users[0].__uri__, user.__uri__)
+
+    def test_module_list_badges(self):
+        from ptahcrowd.providers import Storage
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        user = self._make_user()
+        for idx, domain in enumerate(('github', 'google', 'github')):
+            entry = Storage.create(
+                'token-%s' % idx, domain, uid='%s-%s' % (domain, idx))
+            entry.uri = user.__uri__
+        ptah.get_session().flush()
+
+        for session in ({}, {'ptah-search-term': 'email'}):
+            view = CrowdModuleView(mod, self.make_request(
+                params=MultiDict(), POST=MultiDict(), session=session))
+            view.csrf = False
+            view.update_form()
+
+            self.assertEqual(view.users[0].providers, ('github', 'google'))
+            self.assertEqual(sorted(view.badges), ['github', 'google'])
+            self.assertTrue(view.badges['github'].endswith(
+                'buttons/github_32.png'))
+
     def test_module_validate(self):
         from ptahcrowd.provider import CrowdUser
         from ptahcrowd.views import CrowdModuleView
@@ -214,6 +293,7 @@ class TestModuleView(PtahTestCase):
         form = CrowdModuleView(mod, self.make_request(
                 POST=MultiDict((('uid', user.id),
                                 ('remove', 'remove')))))
+        form.request.POST[form.csrf_name] = form.request.session.get_csrf_token()
         form.update_form()
 
         self.assertIn('The selected accounts have been removed.',
@@ -222,3 +302,198 @@ class TestModuleView(PtahTestCase):
 
         user = ptah.resolve(uri)
         self.assertIsNone(user)
+
+    def test_module_bulk_csrf(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        user = self._make_user()
+        uri = user.__uri__
+
+        form = CrowdModuleView(mod, self.make_request(
+                POST=MultiDict((('uid', user.id),
+                                ('remove', 'remove')))))
+        self.assertRaises(HTTPForbidden, form.update_form)
+        transaction.commit()
+
+        self.assertIsNotNone(ptah.resolve(uri))
+
+    def test_module_remove_related(self):
+        from ptahcrowd.provider import CrowdUser, CrowdGroupMember
+        from ptahcrowd.providers import Storage
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        user = self._make_user()
+        other = CrowdUser.__type__.add(
+            CrowdUser(username='other', email='other'))
+        uri, id = user.__uri__, user.id
+
+        CrowdGroupMember.set_groups(id, ('grp:1',))
+        CrowdGroupMember.set_groups(other.id, ('grp:1',))
+        entry = Storage.create('token', 'github', uid='github-1')
+        entry.uri = uri
+        ptah.get_session().flush()
+
+        form = CrowdModuleView(mod, self.make_request(
+                POST=MultiDict((('uid', id), ('remove', 'remove')))))
+        form.request.POST[form.csrf_name] = form.request.session.get_csrf_token()
+        form.update_form()
+        transaction.commit()
+
+        self.assertIsNone(ptah.resolve(uri))
+        self.assertEqual(CrowdGroupMember.get_groups(id), [])
+        self.assertEqual(CrowdGroupMember.get_groups(other.id), ['grp:1'])
+        self.assertEqual(ptah.get_session().query(Storage).count(), 0)
+
+    def test_module_remove_all(self):
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        for name in ('spam1', 'spam2', 'user'):
+            CrowdUser.__type__.add(
+                CrowdUser(username=name, email='%s@ptahproject.org' % name))
+
+        request = self.make_request(
+            POST=MultiDict((('scope', 'all'), ('remove', 'remove'))))
+        request.session['ptah-search-term'] = 'spam'
+
+        form = CrowdModuleView(mod, request)
+        form.request.POST[form.csrf_name] = form.request.session.get_csrf_token()
+        form.update_form()
+        self.assertIn('2 matching accounts have been removed.',
+                      request.render_messages())
+        transaction.commit()
+
+        self.assertEqual(
+            [u.username for u in ptah.get_session().query(CrowdUser)],
+            ['user'])
+
+        # empty term does not remove anything
+        form = CrowdModuleView(mod, self.make_request(
+            POST=MultiDict((('scope', 'all'), ('remove', 'remove')))))
+        form.request.POST[form.csrf_name] = form.request.session.get_csrf_token()
+        form.update_form()
+        self.assertEqual(ptah.get_session().query(CrowdUser).count(), 1)
+
+    def test_module_suspend_all(self):
+        from ptahcrowd.events import UsersChangedEvent
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        for name in ('spam1', 'spam2', 'spam3', 'user'):
+            CrowdUser.__type__.add(
+                CrowdUser(username=name, email='%s@ptahproject.org' % name,
+                          suspended=(name == 'spam3')))
+
+        events = []
+        self.config.add_subscriber(events.append, UsersChangedEvent)
+
+        request = self.make_request(POST=MultiDict())
+        request.session['ptah-search-term'] = 'spam'
+        form = CrowdModuleView(mod, request)
+        form.update_form()
+        self.assertEqual(form.matching, 3)
+
+        request = self.make_request(
+            POST=MultiDict((('scope', 'all'), ('suspend', 'suspend'))))
+        request.session['ptah-search-term'] = 'spam'
+        form = CrowdModuleView(mod, request)
+        form.request.POST[form.csrf_name] = form.request.session.get_csrf_token()
+        form.update_form()
+
+        # already suspended user is not changed
+        self.assertIn('2 matching accounts have been suspended.',
+                      request.render_messages())
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].action, 'suspend')
+        self.assertEqual(events[0].values, {'suspended': True})
+        self.assertEqual(
+            sorted(CrowdUser.get_byid(id).username for id in events[0].ids),
+            ['spam1', 'spam2'])
+
+        self.assertFalse(CrowdUser.get_byusername('user').suspended)
+        self.assertTrue(CrowdUser.get_byusername('spam1').suspended)
+
+    def test_module_list_flags(self):
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        for name in ('spam1', 'spam2', 'user'):
+            CrowdUser.__type__.add(
+                CrowdUser(username=name, email='%s@ptahproject.org' % name,
+                          suspended=(name != 'spam1')))
+
+        view = CrowdModuleView(mod, self.make_request(
+            params=MultiDict({'suspended': '1'}), POST=MultiDict()))
+        view.update_form()
+        self.assertEqual(view.matching, 2)
+        self.assertEqual((view.size, view.size_exact), (2, True))
+        self.assertEqual(view.filter_qs, '&suspended=1')
+        self.assertEqual(sorted(u.username for u in view.users),
+                         ['spam2', 'user'])
+
+        request = self.make_request(
+            params=MultiDict({'suspended': '1'}), POST=MultiDict())
+        request.session['ptah-search-term'] = 'spam'
+        view = CrowdModuleView(mod, request)
+        view.keyset_threshold = 0
+        view.update_form()
+        self.assertTrue(view.keyset)
+        self.assertEqual(view.matching, 1)
+        self.assertEqual([u.username for u in view.users], ['spam2'])
+
+    def test_module_export_links(self):
+        mod = self._make_mod()
+        self._make_user()
+
+        res = render_view_to_response(
+            mod, self.make_request(params=MultiDict(), POST=MultiDict()), '')
+        self.assertIn('/crowd/export.csv"', res.text)
+
+        request = self.make_request(
+            params=MultiDict({'validated': '1', 'suspended': '0'}),
+            POST=MultiDict())
+        res = render_view_to_response(mod, request, '')
+        self.assertIn('/crowd/export.csv?validated=1&amp;suspended=0"',
+                      res.text)
+        self.assertIn('/crowd/export.jsonl?validated=1&amp;suspended=0"',
+                      res.text)
+
+    def test_module_bulk_all_requires_filter(self):
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.views import CrowdModuleView
+
+        mod = self._make_mod()
+        for name in ('spam1', 'user'):
+            CrowdUser.__type__.add(
+                CrowdUser(username=name, email='%s@ptahproject.org' % name))
+
+        for action in ('activate', 'suspend', 'validate', 'remove'):
+            request = self.make_request(
+                POST=MultiDict((('scope', 'all'), (action, action))))
+            form = CrowdModuleView(mod, request)
+            form.request.POST[form.csrf_name] = \
+                form.request.session.get_csrf_token()
+            form.update_form()
+            self.assertIn('Please specify search term.',
+                          request.render_messages())
+
+        transaction.commit()
+        users = ptah.get_session().query(CrowdUser).all()
+        self.assertEqual(len(users), 2)
+        self.assertFalse([u for u in users if u.suspended or u.validated])
+
+    def test_module_bulk_events_batches(self):
+        from ptahcrowd.events import UsersChangedEvent
+        from ptahcrowd.provider import notify_users_changed
+
+        events = []
+        self.config.add_subscriber(events.append, UsersChangedEvent)
+
+        notify_users_changed('validate', list(range(5)), batch_size=2)
+        self.assertEqual([ev.ids for ev in events], [[0, 1], [2, 3], [4]])
@@ -0,0 +1,355 @@
+import time
+import socketserver
+import threading
+import transaction
+import ptah
+import ptahcrowd
+from datetime import timedelta
+from email.mime.text import MIMEText
+from ptah.testing import PtahTestCase
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """ minimal SMTP server conversation """
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply('220 localhost')
+
+        while True:
+            line = self.rfile.readline().decode('ascii')
+            if not line:
+                return
+
+            cmd = line[:4].upper()
+            if cmd in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif cmd == 'MAIL':
+                rcpts = []
+                self.reply('250 OK')
+            elif cmd == 'RCPT':
+                rcpts.append(line[8:].strip())
+                self.reply('250 OK')
+            elif cmd == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline().decode('ascii')
+                    if line in ('.\r\n', ''):
+                        break
+                    data.append(line)
+                server.messages.append((rcpts, ''.join(data)))
+                self.reply('250 OK')
+                if server.close_after_message:
+                    return
+            elif cmd == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.close_after_message = False
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestSMTPPool(PtahTestCase):
+
+    _init_ptah = False
+
+    def setUp(self):
+        super(TestSMTPPool, self).setUp()
+        self.server = SMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestSMTPPool, self).tearDown()
+
+    def _make_pool(self, **kw):
+        from ptahcrowd.outbox import SMTPPool
+        return SMTPPool('127.0.0.1', self.server.server_address[1], **kw)
+
+    def test_reuse_connection(self):
+        pool = self._make_pool()
+        for idx in range(3):
+            pool.send('from@ptahproject.org', ['to@ptahproject.org'],
+                      'Subject: %s\r\n\r\nbody' % idx)
+        pool.close_all()
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.messages[0][0],
+                         ['<to@ptahproject.org>'])
+
+    def test_reconnect(self):
+        self.server.close_after_message = True
+
+        pool = self._make_pool()
+        pool.send('from@ptahproject.org', ['to@ptahproject.org'], 'first')
+        pool.send('from@ptahproject.org', ['to@ptahproject.org'], 'second')
+        pool.close_all()
+
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_max_idle(self):
+        now = [100]
+        pool = self._make_pool(max_idle=60, timer=lambda: now[0])
+        pool.send('from@ptahproject.org', ['to@ptahproject.org'], 'first')
+
+        now[0] = 200
+        pool.send('from@ptahproject.org', ['to@ptahproject.org'], 'second')
+        pool.close_all()
+
+        self.assertEqual(self.server.connections, 2)
+
+
+class TestOutbox(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+
+        self.cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        self.cfg['mail-queue'] = True
+        self._notify()
+
+    def tearDown(self):
+        from ptahcrowd.outbox import outbox
+
+        self.cfg['mail-queue'] = False
+        self._notify()
+        outbox.timer = time.time
+        super(TestOutbox, self).tearDown()
+
+    def _notify(self):
+        self.registry.notify(ptah.events.SettingsInitialized(
+            self.config, self.registry))
+
+    def _message(self, to='to@ptahproject.org'):
+        msg = MIMEText('body')
+        msg['from'] = 'from@ptahproject.org'
+        msg['to'] = to
+        msg['subject'] = 'Test'
+        return msg
+
+    def _messages(self):
+        from ptahcrowd.outbox import OutboxMessage
+        return ptah.get_session().query(OutboxMessage)\
+            .order_by(OutboxMessage.id).all()
+
+    def _set_mailer(self, mailer):
+        ptah.get_settings(ptah.CFG_ID_PTAH, self.registry)['Mailer'] = mailer
+
+    def test_get_mailer(self):
+        from ptahcrowd.outbox import outbox, get_mailer
+
+        self.assertIs(get_mailer(), outbox)
+
+        self.cfg['mail-queue'] = False
+        self._notify()
+        self.assertIsNone(get_mailer())
+
+    def test_deliver(self):
+        from ptahcrowd.outbox import outbox
+
+        sent = []
+        class Mailer(object):
+            def send(self, from_, to_, message):
+                sent.append((from_, to_, message['subject']))
+        self._set_mailer(Mailer())
+
+        outbox.send('from@ptahproject.org', 'to@ptahproject.org',
+                    self._message())
+        self.assertEqual(sent, [])
+        transaction.commit()
+        self.assertTrue(outbox.wakeup.is_set())
+        self.assertEqual(len(self._messages()), 1)
+        transaction.commit()
+
+        self.assertEqual(outbox.deliver(ptah.get_base().metadata.bind), 1)
+        self.assertEqual(
+            sent, [('from@ptahproject.org', 'to@ptahproject.org', 'Test')])
+        self.assertEqual(self._messages(), [])
+
+    def test_deliver_smtp(self):
+        from ptahcrowd.outbox import outbox
+
+        server = SMTPServer()
+        try:
+            self.cfg['mail-smtp-host'] = '127.0.0.1'
+            self.cfg['mail-smtp-port'] = server.server_address[1]
+            self._notify()
+
+            for idx in range(3):
+                outbox.send('from@ptahproject.org', 'to@ptahproject.org',
+                            self._message())
+            transaction.commit()
+
+            self.assertEqual(
+                outbox.deliver(ptah.get_base().metadata.bind), 3)
+            outbox.transport.close_all()
+        finally:
+            self.cfg['mail-smtp-host'] = ''
+            server.stop()
+
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(self._messages(), [])
+
+    def test_retry(self):
+        from ptahcrowd.outbox import outbox
+
+        now = [1000000]
+        outbox.timer = lambda: now[0]
+        self.cfg['mail-retries'] = 3
+        self.cfg['mail-retry-delay'] = 10
+        self._notify()
+
+        class Mailer(object):
+            def send(self, from_, to_, message):
+                raise IOError('connection refused')
+        self._set_mailer(Mailer())
+
+        outbox.send('from@ptahproject.org', 'to@ptahproject.org',
+                    self._message())
+        transaction.commit()
+        engine = ptah.get_base().metadata.bind
+
+        self.assertEqual(outbox.deliver(engine), 0)
+        msg = self._messages()[0]
+        self.assertEqual(msg.attempts, 1)
+        self.assertEqual(msg.error, 'connection refused')
+        self.assertEqual(msg.next_attempt,
+                         outbox.now() + timedelta(seconds=10))
+        transaction.commit()
+
+        # not due yet
+        now[0] += 5
+        self.assertEqual(outbox.deliver(engine), 0)
+        self.assertEqual(self._messages()[0].attempts, 1)
+        transaction.commit()
+
+        # second attempt, delay doubles
+        now[0] += 5
+        outbox.deliver(engine)
+        self.assertEqual(self._messages()[0].attempts, 2)
+        self.assertEqual(outbox.backoff(2), 20)
+        transaction.commit()
+
+        # give up after mail-retries attempts
+        now[0] += 20
+        outbox.deliver(engine)
+        msg = self._messages()[0]
+        self.assertEqual(msg.attempts, 3)
+        self.assertIsNone(msg.next_attempt)
+
+    def test_queue_full(self):
+        from ptahcrowd.outbox import outbox
+
+        sent = []
+        class Mailer(object):
+            def send(self, from_, to_, message):
+                sent.append(to_)
+        self._set_mailer(Mailer())
+
+        self.cfg['mail-queue-limit'] = 1
+        self._notify()
+
+        outbox.send('from@ptahproject.org', 'to@ptahproject.org',
+                    self._message())
+        ptah.get_session().flush()
+        outbox.send('from@ptahproject.org', 'other@ptahproject.org',
+                    self._message('other@ptahproject.org'))
+
+        self.assertEqual(sent, ['other@ptahproject.org'])
+        self.assertEqual(len(self._messages()), 1)
+
+    def test_queue_full_dead(self):
+        from ptahcrowd.outbox import outbox
+
+        sent = []
+        class Mailer(object):
+            def send(self, from_, to_, message):
+                sent.append(to_)
+        self._set_mailer(Mailer())
+
+        self.cfg['mail-queue-limit'] = 1
+        self._notify()
+
+        outbox.send('from@ptahproject.org', 'to@ptahproject.org',
+                    self._message())
+        ptah.get_session().flush()
+        self._messages()[0].next_attempt = None
+        ptah.get_session().flush()
+
+        # dead message is not counted
+        outbox.send('from@ptahproject.org', 'other@ptahproject.org',
+                    self._message('other@ptahproject.org'))
+        self.assertEqual(sent, [])
+        self.assertEqual(len(self._messages()), 2)
+
+    def test_purge_dead(self):
+        from datetime import datetime
+        from ptahcrowd.outbox import OutboxMessage, purge_dead_batch
+
+        now = datetime.utcnow()
+        old = now - timedelta(days=8)
+        session = ptah.get_session()
+        for idx, (created, next_attempt) in enumerate((
+                (old, None), (old, None), (old, None),
+                (now, None), (old, old))):
+            session.add(OutboxMessage(
+                sender='from@ptahproject.org',
+                recipients='to%s@ptahproject.org' % idx, message='',
+                created=created, attempts=8, next_attempt=next_attempt))
+        session.flush()
+
+        conn = session.connection()
+        self.assertEqual(purge_dead_batch(conn, 2, now), 2)
+        self.assertEqual(purge_dead_batch(conn, 2, now), 1)
+        self.assertEqual(purge_dead_batch(conn, 2, now), 0)
+
+        # recent dead messages and pending messages are kept
+        self.assertEqual(
+            [msg.recipients for msg in self._messages()],
+            ['to3@ptahproject.org', 'to4@ptahproject.org'])
+
+    def test_validation_email_queued(self):
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.validation import initiate_email_validation
+
+        sent = []
+        class Mailer(object):
+            def send(self, from_, to_, message):
+                sent.append(to_)
+        self._set_mailer(Mailer())
+
+        user = CrowdUser(username='test', email='test@ptahproject.org')
+        CrowdUser.__type__.add(user)
+
+        initiate_email_validation(user, self.make_request())
+
+        self.assertEqual(sent, [])
+        self.assertEqual(len(self._messages()), 1)
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+import ptah
+from ptah.testing import PtahTestCase
+
+
+class TestKeysetPagination(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_users(self, count):
+        from ptahcrowd.provider import CrowdUser
+
+        now = datetime(2012, 1, 1)
+        for idx in range(count):
+            user = CrowdUser(username='user%02d' % (count - idx),
+                             email='email%s' % idx)
+            user.joined = now + timedelta(days=idx % 3)
+            CrowdUser.__type__.add(user)
+
+    def _page(self):
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.pagination import KeysetPagination
+
+        return KeysetPagination(
+            3, {'id': (CrowdUser.id,),
+                'joined': (CrowdUser.joined, CrowdUser.id)}, 'id')
+
+    def _query(self):
+        from ptahcrowd.provider import CrowdUser
+        return ptah.get_session().query(CrowdUser)
+
+    def test_token(self):
+        from ptahcrowd.pagination import encode_token, decode_token
+
+        dt = datetime(2012, 1, 1, 10, 11, 12, 13)
+        token = encode_token('joined', [dt, 1])
+        self.assertEqual(
+            decode_token(token), ('joined', [dt.strftime(
+                '%Y-%m-%dT%H:%M:%S.%f'), 1]))
+
+        self.assertRaises(ValueError, decode_token, 'broken')
+
+    def test_keyset(self):
+        self._make_users(7)
+        page = self._page()
+
+        items, sort, prev, next = page(self._query())
+        self.assertEqual(sort, 'id')
+        self.assertEqual([u.id for u in items], [1, 2, 3])
+        self.assertIsNone(prev)
+
+        items, sort, prev, next = page(self._query(), after=next)
+        self.assertEqual([u.id for u in items], [4, 5, 6])
+
+        items, sort, prev2, next = page(self._query(), after=next)
+        self.assertEqual([u.id for u in items], [7])
+        self.assertIsNone(next)
+
+        items, sort, prev, next = page(self._query(), before=prev2)
+        self.assertEqual([u.id for u in items], [4, 5, 6])
+
+        items, sort, prev, next = page(self._query(), before=prev)
+        self.assertEqual([u.id for u in items], [1, 2, 3])
+        self.assertIsNone(prev)
+        self.assertIsNotNone(next)
+
+    def test_keyset_composite(self):
+        self._make_users(7)
+        page = self._page()
+
+        ids = []
+        items, sort, prev, next = page(self._query(), 'joined')
+        ids.extend(u.id for u in items)
+        while next:
+            items, sort, prev, next = page(self._query(), after=next)
+            self.assertEqual(sort, 'joined')
+            ids.extend(u.id for u in items)
+
+        self.assertEqual(ids, [1, 4, 7, 2, 5, 3, 6])
+
+    def test_keyset_broken_token(self):
+        self._make_users(2)
+
+        items, sort, prev, next = self._page()(self._query(), after='broken')
+        self.assertEqual(sort, 'id')
+        self.assertEqual(len(items), 2)
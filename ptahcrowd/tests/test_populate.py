@@ -0,0 +1,66 @@
+import ptah
+from ptah.testing import PtahTestCase
+
+
+class TestMigrateGroupMembers(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_migrate_group_members(self):
+        from ptahcrowd.provider import CrowdUser, CrowdGroupMember
+        from ptahcrowd.populate import migrate_group_members
+
+        users = []
+        for idx in range(5):
+            user = CrowdUser(username='user%s' % idx, email='email%s' % idx)
+            if idx % 2:
+                user.properties['groups'] = ('grp:1', 'grp:%s' % idx)
+            users.append(CrowdUser.__type__.add(user))
+
+        CrowdGroupMember.set_groups(users[1].id, ('grp:1',))
+        ids = [user.id for user in users]
+
+        migrate_group_members(self.registry, batch_size=1)
+
+        session = ptah.get_session()
+        for idx, id in enumerate(ids):
+            user = session.query(CrowdUser).filter(CrowdUser.id == id).one()
+            self.assertNotIn('groups', user.properties)
+
+            groups = sorted(CrowdGroupMember.get_groups(id))
+            if idx % 2:
+                self.assertEqual(groups, ['grp:1', 'grp:%s' % idx])
+            else:
+                self.assertEqual(groups, [])
+
+    def test_migrate_group_members_once(self):
+        from ptahcrowd.provider import CrowdUser, CrowdGroupMember
+        from ptahcrowd.populate import migrate_group_members
+
+        migrate_group_members(self.registry)
+
+        # completed migration does not scan users again
+        user = CrowdUser(username='user', email='email')
+        user.properties['groups'] = ('grp:1',)
+        user = CrowdUser.__type__.add(user)
+        migrate_group_members(self.registry)
+
+        self.assertEqual(CrowdGroupMember.get_groups(user.id), [])
+        self.assertIn('groups', user.properties)
+
+
+class TestAddStorageColumns(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_add_storage_columns(self):
+        import sqlalchemy as sqla
+        from ptahcrowd.populate import add_storage_columns
+
+        add_storage_columns(self.registry)
+        add_storage_columns(self.registry)
+
+        columns = set(col['name'] for col in sqla.inspect(
+            ptah.get_session().connection()).get_columns(
+                'ptahcrowd_auth_storage'))
+        self.assertIn('fetched', columns)
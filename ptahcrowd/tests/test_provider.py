@@ -1,4 +1,5 @@
 import ptah
+import ptahcrowd
 from ptah.testing import PtahTestCase
 
 
@@ -65,6 +66,154 @@ class TestProvider(PtahTestCase):
         self.assertIsInstance(user, CrowdUser)
         self.assertEqual(user.username, 'test')
 
+    def test_get_bylogin_email(self):
+        from ptahcrowd.provider import CrowdAuthProvider, CrowdUser
+
+        user = CrowdUser(username='test', email='test@ptahproject.org')
+        CrowdUser.__type__.add(user)
+
+        provider = CrowdAuthProvider()
+        user = provider.get_principal_bylogin('test@ptahproject.org')
+        self.assertEqual(user.username, 'test')
+
+    def test_get_bylogin_precedence(self):
+        from ptahcrowd.provider import CrowdAuthProvider, CrowdUser
+
+        CrowdUser.__type__.add(
+            CrowdUser(username='user1', email='login@ptahproject.org'))
+        CrowdUser.__type__.add(
+            CrowdUser(username='login@ptahproject.org', email='user2'))
+
+        provider = CrowdAuthProvider()
+        user = provider.get_principal_bylogin('login@ptahproject.org')
+        self.assertEqual(user.username, 'login@ptahproject.org')
+
+    def test_get_bylogin_case_insensitive(self):
+        from ptahcrowd.provider import CrowdAuthProvider, CrowdUser
+
+        CrowdUser.__type__.add(
+            CrowdUser(username='Test', email='Test@PtahProject.org'))
+
+        provider = CrowdAuthProvider()
+        self.assertEqual(provider.get_principal_bylogin('TEST').username, 'Test')
+        self.assertEqual(
+            provider.get_principal_bylogin('test@ptahproject.org').username,
+            'Test')
+        self.assertEqual(
+            CrowdUser.get_byusername('test').username, 'Test')
+        self.assertEqual(
+            CrowdUser.get_byemail('TEST@ptahproject.org').username, 'Test')
+
+    def test_lower_indexes(self):
+        rows = ptah.get_session().execute(
+            "SELECT name FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='ptahcrowd_users'").fetchall()
+        names = [row[0] for row in rows]
+
+        self.assertIn('ix_ptahcrowd_users_username_lower_unique', names)
+        self.assertIn('ix_ptahcrowd_users_email_lower_unique', names)
+
+    def test_lower_indexes_unique(self):
+        import sqlalchemy as sqla
+        from ptahcrowd.provider import CrowdUser
+
+        CrowdUser.__type__.add(
+            CrowdUser(username='test', email='test@ptahproject.org'))
+
+        session = ptah.get_session()
+        session.begin_nested()
+        self.assertRaises(
+            sqla.exc.IntegrityError, CrowdUser.__type__.add,
+            CrowdUser(username='TEST', email='other@ptahproject.org'))
+        session.rollback()
+
+    def test_lower_indexes_duplicates(self):
+        from ptahcrowd.provider import CrowdUser, create_lower_indexes
+        from ptahcrowd.provider import get_lower_duplicates
+
+        conn = ptah.get_session().connection()
+        conn.execute('DROP INDEX ix_ptahcrowd_users_email_lower_unique')
+        CrowdUser.__type__.add(
+            CrowdUser(username='user1', email='test@ptahproject.org'))
+        CrowdUser.__type__.add(
+            CrowdUser(username='user2', email='Test@ptahproject.org'))
+
+        self.assertEqual(get_lower_duplicates(conn, 'email'),
+                         ['test@ptahproject.org'])
+        self.assertEqual(get_lower_duplicates(conn, 'username'), [])
+
+        create_lower_indexes(None, conn)
+        names = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='ptahcrowd_users'")]
+        self.assertIn('ix_ptahcrowd_users_email_lower', names)
+        self.assertNotIn('ix_ptahcrowd_users_email_lower_unique', names)
+
+    def test_joined_index(self):
+        from ptahcrowd.provider import create_joined_index
+
+        conn = ptah.get_session().connection()
+        conn.execute('DROP INDEX ix_ptahcrowd_users_joined')
+        create_joined_index(conn)
+        create_joined_index(conn)
+
+        names = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='ptahcrowd_users'")]
+        self.assertIn('ix_ptahcrowd_users_joined', names)
+
+    def test_get_bylogin_precedence_duplicates(self):
+        from ptahcrowd.provider import CrowdAuthProvider, CrowdUser
+
+        conn = ptah.get_session().connection()
+        conn.execute('DROP INDEX ix_ptahcrowd_users_email_lower_unique')
+        # case variants of same email
+        for idx, email in enumerate(('login@ptahproject.org',
+                                     'Login@ptahproject.org',
+                                     'LOGIN@ptahproject.org')):
+            CrowdUser.__type__.add(CrowdUser(
+                username='user%s' % idx, email=email))
+
+        # first matching user by id
+        provider = CrowdAuthProvider()
+        user = provider.get_principal_bylogin('login@ptahproject.org')
+        self.assertEqual(user.username, 'user0')
+
+        CrowdUser.__type__.add(
+            CrowdUser(username='login@ptahproject.org', email='user'))
+        user = provider.get_principal_bylogin('login@ptahproject.org')
+        self.assertEqual(user.username, 'login@ptahproject.org')
+
+    def test_group_title_index(self):
+        rows = ptah.get_session().execute(
+            "SELECT name FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='ptahcrowd_groups'").fetchall()
+
+        self.assertIn('ix_ptahcrowd_groups_title_lower',
+                      [row[0] for row in rows])
+
+    def test_get_bylogin_queries(self):
+        import sqlalchemy as sqla
+        from ptahcrowd.provider import CrowdAuthProvider, CrowdUser
+
+        CrowdUser.__type__.add(
+            CrowdUser(username='test', email='test@ptahproject.org'))
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = ptah.get_session().get_bind()
+        sqla.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            provider = CrowdAuthProvider()
+            for login in ('test', 'test@ptahproject.org', 'unknown'):
+                del statements[:]
+                provider.get_principal_bylogin(login)
+                self.assertEqual(len(statements), 1, login)
+        finally:
+            sqla.event.remove(engine, 'before_cursor_execute', count)
+
     def test_crowd_user_ctor(self):
         from ptahcrowd.provider import CrowdUser
 
@@ -105,6 +254,89 @@ class TestProvider(PtahTestCase):
         self.assertEqual(len(users), 1)
         self.assertEqual(users[0].__uri__, uri)
 
+    def test_crowd_user_search_limit(self):
+        import itertools
+        from ptahcrowd.provider import CrowdUser, CrowdAuthProvider
+
+        for idx in range(30):
+            CrowdUser.__type__.add(CrowdUser(
+                username='user%02d' % idx, email='user%02d@ptahproject.org'%idx))
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['search-limit'] = 25
+
+        users = list(CrowdAuthProvider.search('user'))
+        self.assertEqual(len(users), 25)
+        self.assertEqual(len(set(u.id for u in users)), 25)
+
+        users = list(CrowdAuthProvider.search('user', limit=10, offset=25))
+        self.assertEqual(len(users), 5)
+
+        # taking first users queries only first page
+        queries = []
+        from ptahcrowd import search
+        orig = search.search_users
+        def search_users(term, limit=None, offset=0):
+            queries.append((limit, offset))
+            return orig(term, limit, offset)
+
+        search.search_users = search_users
+        try:
+            users = list(itertools.islice(CrowdAuthProvider.search('user'), 3))
+        finally:
+            search.search_users = orig
+
+        self.assertEqual(len(users), 3)
+        self.assertEqual(queries, [(20, 0)])
+
+    def test_user_row(self):
+        from ptahcrowd.provider import CrowdUser, UserRow
+
+        user = CrowdUser.__type__.add(
+            CrowdUser(username='test', email='test@ptahproject.org'))
+
+        rows = UserRow.from_rows(UserRow.query())
+        self.assertEqual(len(rows), 1)
+
+        row = rows[0]
+        self.assertEqual(row.id, user.id)
+        self.assertEqual(row.name, 'test')
+        self.assertEqual(row.email, 'test@ptahproject.org')
+        self.assertEqual(row.__uri__, user.__uri__)
+        self.assertFalse(hasattr(row, 'password'))
+        self.assertFalse(hasattr(row, '__dict__'))
+
+    def test_group_row(self):
+        from ptahcrowd.provider import CrowdGroup, GroupRow
+
+        grp = CrowdGroup.__type__.add(
+            CrowdGroup(title='group', description='d' * 300))
+
+        row = GroupRow.from_rows(GroupRow.query())[0]
+        self.assertEqual(row.id, grp.id)
+        self.assertEqual(row.title, 'group')
+        self.assertEqual(row.description, 'd' * GroupRow.description_length)
+        self.assertEqual(row.__uri__, grp.__uri__)
+
+    def test_group_searcher(self):
+        from ptahcrowd.provider import CrowdGroup, group_searcher
+
+        for idx in range(30):
+            CrowdGroup.__type__.add(
+                CrowdGroup(title='Group %02d' % idx))
+
+        groups = list(group_searcher('Group', limit=25))
+        self.assertEqual(len(groups), 25)
+        self.assertEqual(groups[0].title, 'Group 00')
+        self.assertEqual(groups[-1].title, 'Group 24')
+
+        groups = list(group_searcher('Group', limit=10, offset=25))
+        self.assertEqual([g.title for g in groups],
+                         ['Group 25', 'Group 26', 'Group 27',
+                          'Group 28', 'Group 29'])
+
+        self.assertEqual(list(group_searcher('unknown')), [])
+
 
 class TestPasswordChanger(PtahTestCase):
 
@@ -117,3 +349,114 @@ class TestPasswordChanger(PtahTestCase):
                          password='passwd')
 
         self.assertTrue(ptah.pwd_tool.can_change_password(user))
+
+
+class TestCrowdRoles(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_user(self, **props):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username='username', email='email')
+        user.properties.update(props)
+        return CrowdUser.__type__.add(user)
+
+    def test_crowd_roles(self):
+        from ptahcrowd.provider import crowd_user_roles
+
+        user = self._make_user(roles=('Manager',))
+
+        roles = crowd_user_roles(None, user.__uri__, self.registry)
+        self.assertEqual(roles, set(('Manager',)))
+
+    def test_crowd_roles_not_crowd_uri(self):
+        from ptahcrowd.provider import crowd_user_roles, get_roles_memo
+
+        self.assertEqual(
+            crowd_user_roles(None, 'ptah-crowd-group:1', self.registry), set())
+        self.assertEqual(
+            crowd_user_roles(None, 'unknown', self.registry), set())
+        self.assertEqual(get_roles_memo(self.request).principals, {})
+
+    def test_crowd_roles_memo(self):
+        from ptahcrowd.provider import crowd_user_roles
+        from ptahcrowd.provider import get_roles_memo, invalidate_roles
+
+        user = self._make_user(roles=('Manager',))
+        uri = user.__uri__
+
+        crowd_user_roles(None, uri, self.registry)
+
+        memo = get_roles_memo(self.request)
+        self.assertIn(uri, memo.principals)
+        self.assertIs(memo, get_roles_memo(self.request))
+
+        user.properties['roles'] = ('Editor',)
+        self.assertEqual(
+            crowd_user_roles(None, uri, self.registry), set(('Manager',)))
+
+        invalidate_roles(uri, self.request)
+        self.assertEqual(
+            crowd_user_roles(None, uri, self.registry), set(('Editor',)))
+
+    def test_crowd_roles_memo_local_roles(self):
+        from ptahcrowd.provider import RolesMemo
+
+        class Context(object):
+            __local_roles__ = {}
+
+        memo = RolesMemo()
+        ctx = Context()
+
+        roles = memo.get_local_roles('ptah-crowd-group:1', ctx)
+        self.assertIs(
+            memo.local_roles[('ptah-crowd-group:1', id(ctx))][0], ctx)
+        self.assertEqual(memo.get_local_roles('ptah-crowd-group:1', ctx), roles)
+
+
+class TestGroupMembers(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_user(self, username='username'):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username=username, email=username)
+        return CrowdUser.__type__.add(user)
+
+    def test_group_members(self):
+        from ptahcrowd.provider import CrowdGroupMember
+
+        user1 = self._make_user('user1')
+        user2 = self._make_user('user2')
+
+        CrowdGroupMember.set_groups(user1.id, ('grp:1', 'grp:2'))
+        CrowdGroupMember.set_groups(user2.id, ('grp:2',))
+
+        self.assertEqual(
+            sorted(CrowdGroupMember.get_groups(user1.id)), ['grp:1', 'grp:2'])
+        self.assertEqual(
+            sorted(uid for uid, in CrowdGroupMember.get_members('grp:2')),
+            sorted([user1.id, user2.id]))
+
+        CrowdGroupMember.set_groups(user1.id, ('grp:1',))
+        self.assertEqual(CrowdGroupMember.get_groups(user1.id), ['grp:1'])
+
+        CrowdGroupMember.remove_groups(('grp:2',))
+        self.assertEqual(CrowdGroupMember.get_groups(user2.id), [])
+
+        CrowdGroupMember.remove_users((user1.id,))
+        self.assertEqual(CrowdGroupMember.get_groups(user1.id), [])
+
+    def test_group_members_roles(self):
+        from ptahcrowd.provider import CrowdGroupMember, get_roles_memo
+
+        user = self._make_user()
+        CrowdGroupMember.set_groups(user.id, ('ptah-crowd-group:1',))
+        user.properties['groups'] = ('ptah-crowd-group:2',)
+
+        memo = get_roles_memo(self.request)
+        roles, groups = memo.get_principal(user.__uri__)
+        self.assertEqual(
+            sorted(groups), ['ptah-crowd-group:1', 'ptah-crowd-group:2'])
@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import threading
+import sqlalchemy as sqla
+import ptah
+import ptahcrowd
+from datetime import datetime, timedelta
+from ptah.testing import PtahTestCase
+
+
+class TestProfileCache(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def tearDown(self):
+        from ptahcrowd.providers import Storage
+        Storage.profile_ttl = 86400
+        super(TestProfileCache, self).tearDown()
+
+    def _make_entry(self, fetched=None):
+        from ptahcrowd.providers import Storage
+
+        entry = Storage.create('token-1', 'github', uid='github:1',
+                               name='Test', profile={'id': 1})
+        entry.uri = 'ptah-crowd-user:1'
+        if fetched is not None:
+            entry.fetched = fetched
+        ptah.get_session().flush()
+        return entry
+
+    def test_create_fetched(self):
+        entry = self._make_entry()
+        self.assertLessEqual(entry.fetched, datetime.utcnow())
+
+    def test_get_cached(self):
+        from ptahcrowd.providers import Storage
+
+        self._make_entry()
+
+        entry = Storage.get_cached('token-2', 'github:1')
+        self.assertEqual(entry.access_token, 'token-2')
+        self.assertEqual(entry.uri, 'ptah-crowd-user:1')
+        self.assertEqual(entry.profile, {'id': 1})
+        ptah.get_session().flush()
+
+        self.assertIsNone(Storage.get_by_token('token-1'))
+        self.assertIs(Storage.get_by_token('token-2'), entry)
+
+    def test_get_cached_stale(self):
+        from ptahcrowd.providers import Storage
+
+        self._make_entry(datetime.utcnow() - timedelta(days=2))
+
+        self.assertIsNone(Storage.get_cached('token-2', 'github:1'))
+        self.assertIsNotNone(Storage.get_by_token('token-1'))
+
+    def test_get_cached_disabled(self):
+        from ptahcrowd.providers import Storage
+
+        self._make_entry()
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_AUTH, self.registry)
+        cfg['profile-ttl'] = 0
+        self.registry.notify(ptah.events.SettingsInitialized(
+            self.config, self.registry))
+
+        self.assertEqual(Storage.profile_ttl, 0)
+        self.assertIsNone(Storage.get_cached('token-2', 'github:1'))
+        self.assertIsNone(Storage.get_cached('token-2', None))
+
+    def test_create_storage_columns(self):
+        from ptahcrowd.providers import create_storage_columns
+
+        conn = ptah.get_session().connection()
+        create_storage_columns(conn)
+        create_storage_columns(conn)
+
+
+class TestGoogleIdToken(PtahTestCase):
+
+    _init_ptah = False
+
+    def _token(self, claims):
+        import json, base64
+        payload = base64.urlsafe_b64encode(
+            json.dumps(claims).encode('utf-8')).decode('ascii').rstrip('=')
+        return 'header.%s.signature' % payload
+
+    def test_id_token_uid(self):
+        from ptahcrowd.providers.google import id_token_uid
+
+        self.assertEqual(
+            id_token_uid({'id_token': self._token({'sub': '12345'})}),
+            'google:12345')
+        self.assertEqual(
+            id_token_uid({'id_token': self._token({'id': '1'})}),
+            'google:1')
+
+    def test_id_token_uid_invalid(self):
+        from ptahcrowd.providers.google import id_token_uid
+
+        self.assertIsNone(id_token_uid({}))
+        self.assertIsNone(id_token_uid({'id_token': 'invalid'}))
+
+
+class TestStorageUpsert(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def test_create_keeps_uri(self):
+        from ptahcrowd.providers import Storage
+
+        entry = Storage.create('token-1', 'github', uid='github:1')
+        entry.uri = 'ptah-crowd-user:1'
+        ptah.get_session().flush()
+
+        entry = Storage.create('token-2', 'github', uid='github:1',
+                               name='Test', email='Test@ptahproject.org')
+        self.assertEqual(entry.access_token, 'token-2')
+        self.assertEqual(entry.uri, 'ptah-crowd-user:1')
+        self.assertEqual(entry.email, 'test@ptahproject.org')
+        self.assertEqual(ptah.get_session().query(Storage).count(), 1)
+
+    def _params(self, token):
+        return {'access_token': token, 'domain': 'github',
+                'uid': 'github:1', 'name': 'Test', 'email': '',
+                'verified': False, 'profile': None,
+                'expires': datetime.utcnow(), 'fetched': datetime.utcnow()}
+
+    def test_upsert_fallback(self):
+        from ptahcrowd.providers import Storage, upsert_storage
+
+        conn = ptah.get_session().connection()
+        conn.dialect.server_version_info, version = \
+            (3, 0), conn.dialect.server_version_info
+        try:
+            upsert_storage(conn, self._params('token-1'))
+            conn.execute(Storage.__table__.update().values(uri='user:1'))
+            upsert_storage(conn, self._params('token-2'))
+        finally:
+            conn.dialect.server_version_info = version
+
+        self.assertEqual(
+            conn.execute(sqla.select([Storage.__table__.c.access_token,
+                                      Storage.__table__.c.uri])).fetchall(),
+            [('token-2', 'user:1')])
+
+    def test_create_returning(self):
+        from ptahcrowd.providers import Storage, supports_returning
+
+        session = ptah.get_session()
+        entry = Storage.create('token-1', 'github', uid='github:1')
+        entry.uri = 'ptah-crowd-user:1'
+        session.flush()
+
+        statements = []
+        def before_execute(conn, clauseelement, *args):
+            statements.append(clauseelement)
+        engine = session.connection().engine
+        sqla.event.listen(engine, 'before_execute', before_execute)
+        try:
+            entry = Storage.create('token-2', 'github', uid='github:1')
+        finally:
+            sqla.event.remove(engine, 'before_execute', before_execute)
+
+        self.assertEqual(entry.access_token, 'token-2')
+        self.assertEqual(entry.uri, 'ptah-crowd-user:1')
+        if supports_returning(engine.dialect):
+            self.assertEqual(len(statements), 1)
+
+    def _concurrent_upsert(self, version=None):
+        from ptahcrowd.providers import Storage, upsert_storage
+
+        tmpdir = tempfile.mkdtemp()
+        engine = sqla.create_engine(
+            'sqlite:///%s' % os.path.join(tmpdir, 'storage.db'),
+            connect_args={'timeout': 30, 'check_same_thread': False})
+        try:
+            Storage.__table__.create(engine)
+            if version is not None:
+                engine.connect().close()
+                engine.dialect.server_version_info = version
+
+            errors = []
+            start = threading.Event()
+
+            def login(idx):
+                start.wait()
+                try:
+                    for attempt in range(20):
+                        with engine.begin() as conn:
+                            upsert_storage(conn, self._params(
+                                'token-%s-%s' % (idx, attempt)))
+                except Exception as e:
+                    errors.append(e)
+
+            # threads race to insert first entry into empty table
+            threads = [threading.Thread(target=login, args=(idx,))
+                       for idx in range(8)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            rows = engine.execute(sqla.select(
+                [Storage.__table__.c.uid])).fetchall()
+            self.assertEqual(rows, [('github:1',)])
+        finally:
+            engine.dispose()
+            shutil.rmtree(tmpdir)
+
+    def test_concurrent_upsert(self):
+        self._concurrent_upsert()
+
+    def test_concurrent_upsert_fallback(self):
+        # update, then insert or update again on IntegrityError
+        self._concurrent_upsert((3, 0))
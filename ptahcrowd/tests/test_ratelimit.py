@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import ptah
+import ptahcrowd
+from ptah.testing import PtahTestCase
+
+
+class TestRateLimitBackends(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_parse_limit(self):
+        from ptahcrowd.ratelimit import parse_limit
+
+        self.assertEqual(parse_limit('10/60'), (10, 60.0))
+        self.assertIsNone(parse_limit(''))
+        self.assertIsNone(parse_limit('10'))
+        self.assertIsNone(parse_limit('0/60'))
+
+    def test_memory_backend(self):
+        from ptahcrowd.ratelimit import MemoryBackend
+
+        backend = MemoryBackend()
+        self.assertEqual(backend.take('key', 2, 10, 100), 0)
+        self.assertEqual(backend.take('key', 2, 10, 100), 0)
+        self.assertEqual(backend.take('key', 2, 10, 100), 5.0)
+        self.assertEqual(backend.take('other', 2, 10, 100), 0)
+
+        # one token refilled in 5 seconds
+        self.assertEqual(backend.take('key', 2, 10, 105), 0)
+        self.assertTrue(backend.take('key', 2, 10, 105))
+
+    def test_memory_backend_size(self):
+        from ptahcrowd.ratelimit import MemoryBackend
+
+        backend = MemoryBackend()
+        backend.size = 2
+        for key in ('key1', 'key2', 'key3'):
+            backend.take(key, 2, 10, 100)
+
+        self.assertEqual(list(backend.data.keys()), ['key2', 'key3'])
+
+    def test_file_backend(self):
+        from ptahcrowd.ratelimit import FileBackend
+
+        path = tempfile.mkdtemp()
+        try:
+            db = os.path.join(path, 'ratelimit.db')
+            backend1 = FileBackend(db)
+            backend2 = FileBackend(db)
+
+            self.assertEqual(backend1.take('key', 2, 10, 100), 0)
+            self.assertEqual(backend2.take('key', 2, 10, 100), 0)
+            self.assertTrue(backend1.take('key', 2, 10, 100))
+            self.assertTrue(backend2.take('key', 2, 10, 100))
+        finally:
+            shutil.rmtree(path)
+
+
+class TestRateLimit(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _configure(self, **limits):
+        from ptahcrowd.ratelimit import limiter
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_RATELIMIT, self.registry)
+        cfg['enabled'] = True
+        cfg.update(limits)
+        limiter.configure(cfg)
+
+    def test_disabled(self):
+        from ptahcrowd.ratelimit import check_rate_limit
+
+        self._configure(enabled=False, **{'login-ip': '1/60'})
+
+        request = self.make_request()
+        self.assertIsNone(check_rate_limit(request, 'login'))
+        self.assertIsNone(check_rate_limit(request, 'login'))
+
+    def test_keys(self):
+        from ptahcrowd.ratelimit import check_rate_limit
+
+        self._configure(**{'login-ip': '3/60', 'login-user': '1/60'})
+
+        request = self.make_request()
+        request.environ['REMOTE_ADDR'] = '10.0.0.1'
+
+        self.assertIsNone(check_rate_limit(request, 'login', user='test'))
+        res = check_rate_limit(request, 'login', user='TEST')
+        self.assertEqual(res.status_int, 429)
+        self.assertEqual(res.headers['Retry-After'], '61')
+
+        self.assertIsNone(check_rate_limit(request, 'login', user='other'))
+
+        # ip bucket is empty
+        res = check_rate_limit(request, 'login', user='another')
+        self.assertEqual(res.status_int, 429)
+
+        request.environ['REMOTE_ADDR'] = '10.0.0.2'
+        self.assertIsNone(check_rate_limit(request, 'login', user='another'))
+
+        # login bucket is per client ip
+        self.assertIsNone(check_rate_limit(request, 'login', user='test'))
+
+    def test_disabled_by_default(self):
+        from ptahcrowd.ratelimit import limiter
+
+        self.registry.notify(ptah.events.SettingsInitialized(
+            self.config, self.registry))
+        self.assertFalse(limiter.enabled)
+
+    def test_trusted_proxies(self):
+        from ptahcrowd.ratelimit import limiter
+
+        self._configure(**{'trusted-proxies': ('10.0.0.1', '10.0.0.2')})
+
+        request = self.make_request()
+        request.environ['REMOTE_ADDR'] = '10.0.0.1'
+        request.headers['X-Forwarded-For'] = '1.1.1.1, 2.2.2.2, 10.0.0.2'
+        self.assertEqual(limiter.client_ip(request), '2.2.2.2')
+
+        request.headers['X-Forwarded-For'] = '10.0.0.2'
+        self.assertEqual(limiter.client_ip(request), '10.0.0.2')
+
+        del request.headers['X-Forwarded-For']
+        self.assertEqual(limiter.client_ip(request), '10.0.0.1')
+
+        # header of untrusted client is ignored
+        request.environ['REMOTE_ADDR'] = '3.3.3.3'
+        request.headers['X-Forwarded-For'] = '1.1.1.1'
+        self.assertEqual(limiter.client_ip(request), '3.3.3.3')
+
+    def test_keys_not_ip_keyed(self):
+        from ptahcrowd.ratelimit import check_rate_limit
+
+        self._configure(**{'reset-user': '1/60'})
+
+        request = self.make_request()
+        request.environ['REMOTE_ADDR'] = '10.0.0.1'
+        self.assertIsNone(check_rate_limit(request, 'reset', user='test'))
+
+        request.environ['REMOTE_ADDR'] = '10.0.0.2'
+        res = check_rate_limit(request, 'reset', user='test')
+        self.assertEqual(res.status_int, 429)
+
+    def test_base_backend(self):
+        from ptahcrowd.ratelimit import RateLimitBackend
+
+        backend = RateLimitBackend()
+        for i in range(3):
+            self.assertEqual(backend.take('key', 1, 60, 100), 0)
+
+    def test_login_limited(self):
+        from ptahcrowd import login
+
+        self._configure(**{'login-user': '2/60'})
+
+        for i in range(2):
+            request = self.make_request(
+                POST={'login': 'username', 'password': '12345'})
+            form = login.LoginForm(None, request)
+            form.update_form()
+            self.assertIsNone(form.login_handler())
+
+        form = login.LoginForm(None, request)
+        form.update_form()
+        self.assertEqual(form.login_handler().status_int, 429)
+
+    def test_reset_limited(self):
+        from ptahcrowd import resetpassword
+
+        self._configure(**{'reset-user': '1/60'})
+
+        request = self.make_request(POST={'login': 'username'})
+        form = resetpassword.ResetPassword(None, request)
+        form.update_form()
+        self.assertIsNone(form.reset())
+        self.assertEqual(form.reset().status_int, 429)
@@ -143,6 +143,31 @@ class TestResetPassword(ptah.PtahTestCase):
         self.assertEqual(res.headers['location'], 'http://example.com')
         self.assertTrue(ptah.pwd_tool.check(user.password, '123456'))
 
+    def test_resetpassword_form_change_pwd_manager(self):
+        import ptahcrowd
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.resetpassword import ResetPasswordForm
+
+        cfg = ptah.get_settings(ptahcrowd.CFG_ID_CROWD, self.registry)
+        cfg['pwd-manager'] = 'pbkdf2'
+
+        user = CrowdUser(username='username', email='email')
+        CrowdUser.__type__.add(user)
+
+        passcode = ptah.pwd_tool.generate_passcode(user)
+
+        request = self.make_request(
+            subpath=(passcode,),
+            POST = {'password': '123456', 'confirm_password': '123456',
+                    'form.buttons.change': 'Change'})
+        request.environ['HTTP_HOST'] = 'example.com'
+
+        ResetPasswordForm(None, request)()
+
+        self.assertTrue(user.password.startswith('{pbkdf2}'))
+        self.assertTrue(ptah.pwd_tool.check(user.password, '123456'))
+        self.assertIsNone(ptah.pwd_tool.get_principal(passcode))
+
     def test_resetpassword_template(self):
         from ptahcrowd.provider import CrowdUser
         from ptahcrowd.resetpassword import ResetPasswordTemplate
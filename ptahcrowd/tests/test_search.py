@@ -0,0 +1,212 @@
+import ptah
+from ptah.testing import PtahTestCase
+
+
+class TestNgrams(PtahTestCase):
+
+    _init_ptah = False
+
+    def test_ngrams(self):
+        from ptahcrowd.search import ngrams
+
+        self.assertEqual(ngrams(None), set())
+        self.assertEqual(
+            ngrams('ABcd'), set(('abc', 'bcd', 'cd\x1f', 'd\x1f\x1f')))
+
+
+class TestSearch(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    backend = 'auto'
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+
+        cfg = ptah.get_settings('ptahcrowd', self.registry)
+        cfg['search-backend'] = self.backend
+
+    def _make_user(self, username, email, fullname=''):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username=username, email=email, fullname=fullname)
+        return CrowdUser.__type__.add(user)
+
+    def _search(self, term, limit=10, offset=0):
+        from ptahcrowd.search import search_users
+        return [u.username for u in search_users(term, limit, offset)]
+
+    def test_search_backend(self):
+        from ptahcrowd.search import get_search_backend
+
+        self.assertEqual(get_search_backend().name, 'sqlite-fts')
+
+    def test_search(self):
+        self._make_user('bob', 'bob@ptahproject.org', 'Bob Smith')
+        self._make_user('alice', 'alice@example.com', 'Alice Doe')
+        self._make_user('smithy', 'smithy@ptahproject.org')
+
+        self.assertEqual(self._search(''), [])
+        self.assertEqual(sorted(self._search('smith')), ['bob', 'smithy'])
+        self.assertEqual(
+            sorted(self._search('PTAHPROJECT')), ['bob', 'smithy'])
+        self.assertEqual(self._search('ali'), ['alice'])
+        self.assertEqual(self._search('ce'), ['alice'])
+        self.assertEqual(self._search('unknown'), [])
+        self.assertEqual(len(self._search('o', limit=2)), 2)
+        self.assertEqual(len(self._search('o', limit=2, offset=2)), 1)
+
+    def test_search_sync(self):
+        user = self._make_user('bob', 'bob@ptahproject.org')
+        self.assertEqual(self._search('bob'), ['bob'])
+
+        user.username = 'robert'
+        ptah.get_session().flush()
+        self.assertEqual(self._search('robert'), ['robert'])
+        self.assertEqual(self._search('bob'), ['robert'])
+
+        user.email = 'robert@ptahproject.org'
+        ptah.get_session().flush()
+        self.assertEqual(self._search('bob'), [])
+
+        ptah.get_session().delete(user)
+        ptah.get_session().flush()
+        self.assertEqual(self._search('robert'), [])
+
+    def test_fts_update_trigger(self):
+        from ptahcrowd.search import BACKENDS
+
+        conn = ptah.get_session().connection()
+
+        def trigger():
+            return conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type='trigger' "
+                "AND name='ptahcrowd_users_fts_au'").scalar()
+
+        # fires only on update of indexed columns
+        self.assertIn('AFTER UPDATE OF username, email, fullname', trigger())
+
+        # trigger of older versions is replaced
+        conn.execute('DROP TRIGGER ptahcrowd_users_fts_au')
+        conn.execute(
+            "CREATE TRIGGER ptahcrowd_users_fts_au AFTER UPDATE ON "
+            "ptahcrowd_users BEGIN SELECT 1; END")
+        BACKENDS['sqlite-fts'].install(conn)
+        self.assertIn('AFTER UPDATE OF', trigger())
+
+        user = self._make_user('bob', 'bob@ptahproject.org')
+        user.suspended = True
+        ptah.get_session().flush()
+        self.assertEqual(self._search('bob'), ['bob'])
+
+    def test_remove_all_matching(self):
+        from webob.multidict import MultiDict
+        from ptahcrowd.module import CrowdModule
+        from ptahcrowd.provider import CrowdUser
+        from ptahcrowd.views import CrowdModuleView
+
+        self._make_user('spam1', 'spam1@ptahproject.org')
+        self._make_user('spam2', 'spam2@ptahproject.org')
+        self._make_user('user', 'user@ptahproject.org')
+
+        request = self.make_request(
+            POST=MultiDict((('scope', 'all'), ('remove', 'remove'))))
+        request.session['ptah-search-term'] = 'spam'
+        form = CrowdModuleView(CrowdModule(None, request), request)
+        form.request.POST[form.csrf_name] = \
+            form.request.session.get_csrf_token()
+        form.update_form()
+
+        self.assertIn('2 matching accounts have been removed.',
+                      request.render_messages())
+        self.assertEqual(
+            [u.username for u in ptah.get_session().query(CrowdUser)],
+            ['user'])
+        self.assertEqual(self._search('spam'), [])
+
+
+class TestNgramSearch(TestSearch):
+
+    backend = 'ngram'
+
+    def test_search_backend(self):
+        from ptahcrowd.search import get_search_backend
+
+        self.assertEqual(get_search_backend().name, 'ngram')
+
+    def test_search_rank(self):
+        self._make_user('ptahuser', 'user@example.com')
+        self._make_user('ptah', 'ptah@ptahproject.org', 'Ptah Admin')
+
+        self.assertEqual(self._search('ptah'), ['ptah', 'ptahuser'])
+
+    def test_rebuild(self):
+        from ptahcrowd.search import CrowdUserNgram, rebuild_index
+
+        self._make_user('bob', 'bob@ptahproject.org')
+
+        ptah.get_session().query(CrowdUserNgram).delete()
+        self.assertEqual(self._search('bob'), [])
+
+        rebuild_index(self.registry)
+        self.assertEqual(self._search('bob'), ['bob'])
+
+
+    def test_install_backends_existing_users(self):
+        from ptahcrowd.search import CrowdUserNgram, install_backends
+
+        self._make_user('bob', 'bob@ptahproject.org')
+
+        conn = ptah.get_session().connection()
+        CrowdUserNgram.__table__.drop(conn)
+        CrowdUserNgram.__table__.create(conn)
+        self.assertEqual(self._search('bob'), ['bob'])
+
+        conn.execute(CrowdUserNgram.__table__.delete())
+        install_backends(None, conn)
+        self.assertEqual(self._search('bob'), [])
+
+    def test_base_backend_search(self):
+        from ptahcrowd.search import SearchBackend
+
+        self._make_user('bob', 'bob@ptahproject.org')
+        self._make_user('alice', 'alice@ptahproject.org')
+
+        ids = SearchBackend().search(ptah.get_session(), 'ALI', 10)
+        self.assertEqual(len(ids), 1)
+
+
+class TestCompleteGroups(PtahTestCase):
+
+    _includes = ('ptahcrowd',)
+
+    def _make_groups(self, *titles):
+        from ptahcrowd.provider import CrowdGroup
+        return [CrowdGroup.__type__.add(CrowdGroup(title=title))
+                for title in titles]
+
+    def test_complete_groups(self):
+        from ptahcrowd.search import complete_groups
+
+        grps = self._make_groups('Staff', 'staff_b', 'Stage', 'st%', 'Admins')
+
+        self.assertEqual([title for uri, title in complete_groups('STA')],
+                         ['Staff', 'staff_b', 'Stage'])
+        self.assertEqual(complete_groups('staff_'),
+                         [(grps[1].__uri__, 'staff_b')])
+        self.assertEqual([title for uri, title in complete_groups('st%')],
+                         ['st%'])
+        self.assertEqual(len(complete_groups('', limit=2)), 2)
+        self.assertEqual(complete_groups('unknown'), [])
+
+    def test_get_groups(self):
+        from ptahcrowd.search import get_groups
+
+        grps = self._make_groups('b', 'a')
+
+        self.assertEqual(
+            get_groups([grps[0].__uri__, grps[1].__uri__,
+                        'ptah-crowd-group:999', 'ptah-crowd-group:x',
+                        'ptah-crowd-user:1']),
+            [(grps[1].__uri__, 'a'), (grps[0].__uri__, 'b')])
+        self.assertEqual(get_groups([]), [])
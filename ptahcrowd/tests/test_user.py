@@ -1,6 +1,7 @@
 import transaction
 import ptah
 from ptah.testing import PtahTestCase
+from webob.multidict import MultiDict
 from pyramid.httpexceptions import HTTPFound, HTTPForbidden
 
 
@@ -151,6 +152,66 @@ class TestModifyUser(PtahTestCase):
         self.assertEqual(user.username, 'NKim')
         self.assertEqual(user.email, 'ptah@ptahproject.org')
 
+    def test_modify_user_groups(self):
+        from ptahcrowd.provider import CrowdGroup, CrowdGroupMember
+        from ptahcrowd.user import ModifyUserForm
+
+        grp = CrowdGroup(title='group')
+        CrowdGroup.__type__.add(grp)
+
+        user = self._user()
+        user.properties['groups'] = ('ptah-crowd-group:0',)
+
+        request = self.make_request(
+            POST = {'form.buttons.modify': 'Modify',
+                    'username': 'NKim',
+                    'email': 'ptah@ptahproject.org',
+                    'password': '12345',
+                    'validated': 'false',
+                    'suspended': 'true',
+                    'groups': grp.__uri__})
+
+        view = ModifyUserForm(user, request)
+        view.csrf = False
+        view.update_form()
+
+        self.assertEqual(CrowdGroupMember.get_groups(user.id), [grp.__uri__])
+        self.assertNotIn('groups', user.properties)
+        self.assertEqual(view.form_content()['groups'], [grp.__uri__])
+
+    def test_modify_user_groups_vocabulary(self):
+        from ptahcrowd.provider import CrowdGroup, CrowdGroupMember
+        from ptahcrowd.user import ModifyUserForm
+
+        grps = [CrowdGroup.__type__.add(CrowdGroup(title='group%s' % idx))
+                for idx in range(3)]
+
+        user = self._user()
+        CrowdGroupMember.set_groups(user.id, [grps[0].__uri__])
+
+        view = ModifyUserForm(user, self.make_request())
+        view.update_form()
+        self.assertEqual(
+            [term.token for term in view.widgets['groups'].vocabulary],
+            [grps[0].__uri__])
+
+        # groups from autocomplete are submitted
+        request = self.make_request(
+            POST = MultiDict([('form.buttons.modify', 'Modify'),
+                              ('username', 'NKim'),
+                              ('email', 'ptah@ptahproject.org'),
+                              ('validated', 'false'),
+                              ('suspended', 'false'),
+                              ('groups', grps[1].__uri__),
+                              ('groups', grps[2].__uri__)]))
+
+        view = ModifyUserForm(user, request)
+        view.csrf = False
+        view.update_form()
+
+        self.assertEqual(sorted(CrowdGroupMember.get_groups(user.id)),
+                         sorted([grps[1].__uri__, grps[2].__uri__]))
+
     def test_modify_user_remove(self):
         from ptahcrowd.user import ModifyUserForm
 
@@ -27,6 +27,18 @@ class TestCheckLogin(PtahTestCase):
         self.assertRaises(
             ptah.form.Invalid, ptahcrowd.checkUsernameValidator, field, 'username')
 
+    def test_check_login_case_insensitive(self):
+        from ptahcrowd.provider import CrowdUser
+
+        user = CrowdUser(username='UserName', email='Email@ptahproject.org')
+        CrowdUser.__type__.add(user)
+
+        self.assertRaises(
+            ptah.form.Invalid, ptahcrowd.checkUsernameValidator, None, 'username')
+        self.assertRaises(
+            ptah.form.Invalid, ptahcrowd.checkEmailValidator,
+            None, 'email@ptahproject.org')
+
     def test_lower(self):
         from ptahcrowd.schemas import lower
 
@@ -1,4 +1,5 @@
 """ add/edit user """
+from pyramid.i18n import get_localizer
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPFound
 
@@ -8,9 +9,14 @@ from ptah.password import passwordValidator
 import ptahcrowd
 from ptahcrowd import const
 from ptahcrowd.settings import _
+from ptahcrowd.bulkimport import import_users
+from ptahcrowd.cache import row_counter
+from ptahcrowd.hashing import encode_password
 from ptahcrowd.module import CrowdModule
-from ptahcrowd.provider import CrowdUser, CrowdGroup
+from ptahcrowd.provider import CrowdUser, CrowdGroupMember
+from ptahcrowd.provider import invalidate_roles
 from ptahcrowd.schemas import UserSchema
+from ptahcrowd.search import get_groups
 
 
 def get_roles_vocabulary(context):
@@ -25,15 +31,35 @@ def get_roles_vocabulary(context):
     return ptah.form.Vocabulary(*[term for _t, term in sorted(roles)])
 
 
-def get_groups_vocabulary(context):
-    groups = []
-    for grp in ptah.get_session().query(CrowdGroup).all():
-        groups.append(
-            (grp.title,
-             ptah.form.Term(grp.__uri__, grp.__uri__, grp.title)))
+def get_groups_vocabulary(uris):
+    """ vocabulary of existing groups from ``uris`` """
+    return ptah.form.Vocabulary(
+        *[ptah.form.Term(uri, uri, title) for uri, title in get_groups(uris)])
 
-    groups.sort()
-    return ptah.form.Vocabulary(*[term for _t, term in sorted(groups)])
+
+class GroupsField(ptah.form.fields.MultiChoiceField):
+    """ Groups checkboxes with autocomplete input. Vocabulary contains
+    only selected and submitted groups, other groups are loaded
+    from `groups.json` view of crowd module. """
+
+    tmpl_input = 'ptahcrowd:groups-autocomplete'
+
+    def update(self):
+        uris = set()
+        if self.value is not ptah.form.null and self.value:
+            uris.update(self.value)
+
+        params = self.params
+        if hasattr(params, 'getall'):
+            uris.update(params.getall(self.name))
+        elif self.name in params:
+            value = params[self.name]
+            uris.update((value,) if isinstance(value, str) else value)
+
+        self.vocabulary = get_groups_vocabulary(uris)
+        self.autocomplete_url = '%s/crowd/groups.json' % (
+            ptah.manage.get_manage_url(self.request))
+        super(GroupsField, self).update()
 
 
 @view_config(name='create.html',
@@ -69,7 +95,7 @@ class CreateUserForm(ptah.form.Form):
         user = tinfo.create(
             fullname=data['fullname'], username=data['username'], email=data['email'],
             validated=data['validated'], suspended=data['suspended'])
-        user.password = ptah.pwd_tool.encode(data['password'])
+        user.password = encode_password(data['password'])
 
         tinfo.add(user)
 
@@ -80,6 +106,83 @@ class CreateUserForm(ptah.form.Form):
         return HTTPFound(location='.')
 
 
+@view_config(name='import.html',
+             context=CrowdModule,
+             layout='ptah-manage'
+)
+class ImportUsersForm(ptah.form.Form):
+
+    csrf = True
+    label = _('Import users')
+    description = _('CSV file with header row or JSON lines file, '
+                    'fields: username, email, fullname, password, '
+                    'validated, suspended.')
+
+    fields = ptah.form.Fieldset(
+        ptah.form.FileField(
+            'file',
+            title=_('File')),
+
+        ptah.form.ChoiceField(
+            'format',
+            title=_('Format'),
+            vocabulary=ptah.form.Vocabulary(
+                ptah.form.Term('csv', 'csv', 'CSV'),
+                ptah.form.Term('jsonl', 'jsonl', 'JSON lines')),
+            default='csv'),
+
+        ptah.form.BoolField(
+            'dry_run',
+            title=_('Dry run'),
+            description=_('Validate file without creating users.'),
+            default=False),
+        )
+
+    max_messages = 20
+
+    @ptah.form.button(_('Back'))
+    def back(self):
+        return HTTPFound(location='.')
+
+    @ptah.form.button(_('Import'), actype=ptah.form.AC_PRIMARY)
+    def import_handler(self):
+        data, errors = self.extract()
+
+        if errors:
+            self.add_error_message(errors)
+            return
+
+        report = import_users(
+            data['file']['fp'], data['format'], data['dry_run'])
+
+        translate = get_localizer(self.request).translate
+
+        if report.dry_run:
+            msg = _('${count} of ${total} users can be imported.',
+                    mapping={'count': report.created, 'total': report.total})
+        else:
+            msg = _('${count} of ${total} users have been imported.',
+                    mapping={'count': report.created, 'total': report.total})
+        self.request.add_message(
+            translate(msg), 'success' if report.created else 'info')
+
+        for line, error in report.errors[:self.max_messages]:
+            self.request.add_message(
+                translate(_('Line ${line}: ${error}',
+                            mapping={'line': line, 'error': error})),
+                'warning')
+
+        if report.failed > self.max_messages:
+            self.request.add_message(
+                translate(_('${count} more errors.',
+                            mapping={'count':
+                                     report.failed - self.max_messages})),
+                'warning')
+
+        if not report.dry_run and not report.failed:
+            return HTTPFound(location='.')
+
+
 @view_config(context=CrowdUser,
              layout='ptah-manage',
              route_name=ptahcrowd.CROWD_APP_ID)
@@ -98,13 +201,12 @@ class ModifyUserForm(ptah.form.Form):
             required=False,
             voc_factory=get_roles_vocabulary),
 
-        ptah.form.fields.MultiChoiceField(
+        GroupsField(
             'groups',
             title=_("Groups"),
             description=_("Choose user groups."),
             missing=(),
-            required=False,
-            voc_factory=get_groups_vocabulary)
+            required=False)
         )
 
     def form_content(self):
@@ -117,7 +219,7 @@ class ModifyUserForm(ptah.form.Form):
                 'validated': user.validated,
                 'suspended': user.suspended,
                 'roles': user.properties.get('roles', ()),
-                'groups': user.properties.get('groups', ())}
+                'groups': CrowdGroupMember.get_groups(user.id)}
 
     @ptah.form.button(_('Modify'), actype=ptah.form.AC_PRIMARY)
     def modify(self):
@@ -136,10 +238,13 @@ class ModifyUserForm(ptah.form.Form):
         user.validated = data['validated']
         user.suspended = data['suspended']
         user.properties['roles'] = data['roles']
-        user.properties['groups'] = data['groups']
+        CrowdGroupMember.set_groups(user.id, data['groups'])
+        if 'groups' in user.properties:
+            del user.properties['groups']
+        invalidate_roles(user.__uri__, self.request)
 
         if data['password'] is not ptah.form.null:
-            user.password = ptah.pwd_tool.encode(data['password'])
+            user.password = encode_password(data['password'])
 
         self.request.add_message(_("User properties have been updated."), 'info')
 
@@ -149,8 +254,11 @@ class ModifyUserForm(ptah.form.Form):
 
         user = self.context
         Session = ptah.get_session()
+        CrowdGroupMember.remove_users((user.id,))
         Session.delete(user)
         Session.flush()
+        invalidate_roles(user.__uri__, self.request)
+        row_counter.bump(CrowdUser, -1)
 
         self.request.add_message(_("User has been removed."), 'info')
         return HTTPFound(location='..')
@@ -5,6 +5,7 @@ from pyramid.security import remember
 from pyramid.httpexceptions import HTTPFound
 
 import ptah
+from ptahcrowd.outbox import get_mailer
 from ptahcrowd.settings import CFG_ID_CROWD
 from ptahcrowd.settings import _
 
@@ -21,7 +22,7 @@ def initiate_email_validation(principal, request):
     """
     t = ptah.token.service.generate(TOKEN_TYPE, principal.__uri__)
     template = ValidationTemplate(request, principal=principal, token=t)
-    template.send()
+    template.send(mailer=get_mailer())
 
 
 @ptah.auth_checker
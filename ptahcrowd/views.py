@@ -1,13 +1,33 @@
 import sqlalchemy as sqla
+from pyramid.i18n import get_localizer
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPFound
 
 import ptah
 import ptahcrowd
 from ptahcrowd.settings import _
+from ptahcrowd.cache import row_counter
+from ptahcrowd.export import get_flag
 from ptahcrowd.module import CrowdModule
-from ptahcrowd.provider import CrowdUser, CrowdGroup
-from ptahcrowd.providers import Storage
+from ptahcrowd.pagination import KeysetPagination
+from ptahcrowd.provider import CrowdUser, CrowdGroup, CrowdGroupMember
+from ptahcrowd.provider import UserRow, GroupRow
+from ptahcrowd.provider import delete_users, update_users, invalidate_roles
+from ptahcrowd.search import search_user_rows, users_clause, complete_groups
+
+
+BADGES = {}
+
+
+def badge_url(request, domain):
+    """ static path of external provider badge, computed once
+    per domain """
+    key = (request.script_name, domain)
+    url = BADGES.get(key)
+    if url is None:
+        url = BADGES[key] = request.static_path(
+            'ptahcrowd:static/buttons/%s_32.png' % domain)
+    return url
 
 
 @view_config(
@@ -29,10 +49,37 @@ class CrowdModuleView(ptah.form.Form, ptah.View):
         )
 
     users = None
-    external = {}
+    term = ''
+    matching = None
+    filter_qs = ''
+    export_qs = ''
+    badges = {}
     pages = ()
+    size = None
+    size_exact = True
     page = ptah.Pagination(15)
 
+    # keyset pagination is used for crowds larger than threshold
+    keyset = False
+    keyset_threshold = 1000
+    keyset_page = KeysetPagination(
+        15, {'id': (CrowdUser.id,),
+             'joined': (CrowdUser.joined, CrowdUser.id),
+             'username': (CrowdUser.username, CrowdUser.id)}, 'id')
+
+    # action, values, selected users message, matching users message
+    bulk_actions = (
+        ('activate', {'suspended': False},
+         _("The selected accounts have been activated."),
+         _("${count} matching accounts have been activated.")),
+        ('suspend', {'suspended': True},
+         _("The selected accounts have been suspended."),
+         _("${count} matching accounts have been suspended.")),
+        ('validate', {'validated': True},
+         _("The selected accounts have been validated."),
+         _("${count} matching accounts have been validated.")),
+    )
+
     def form_content(self):
         return {'term': self.request.session.get('ptah-search-term', '')}
 
@@ -48,70 +95,123 @@ class CrowdModuleView(ptah.form.Form, ptah.View):
         if 'create' in request.POST:
             return HTTPFound('create.html')
 
-        if 'activate' in request.POST and uids:
-            Session.query(CrowdUser).filter(CrowdUser.id.in_(uids))\
-                .update({'suspended': False}, False)
-            self.request.add_message(
-                _("The selected accounts have been activated."),'info')
-
-        if 'suspend' in request.POST and uids:
-            Session.query(CrowdUser).filter(
-                CrowdUser.id.in_(uids)).update({'suspended': True}, False)
-            self.request.add_message(
-                _("The selected accounts have been suspended."),'info')
+        if 'import' in request.POST:
+            return HTTPFound('import.html')
+
+        term = self.term = request.session.get('ptah-search-term', '')
+        flags = (get_flag(request.params, 'validated'),
+                 get_flag(request.params, 'suspended'))
+        filtered = bool(term) or flags != (None, None)
+        self.filter_qs = ''.join(
+            '&%s=%s' % (name, int(flag))
+            for name, flag in zip(('validated', 'suspended'), flags)
+            if flag is not None)
+        if self.filter_qs:
+            self.export_qs = '?' + self.filter_qs[1:]
+
+        # bulk actions apply to selected users or to all users
+        # matching current search term and flags
+        scope_all = request.POST.get('scope') == 'all'
+        if scope_all and filtered:
+            clause = users_clause(term, *flags)
+        elif uids and not scope_all:
+            clause = CrowdUser.id.in_(uids)
+        else:
+            clause = None
 
-        if 'validate' in request.POST and uids:
-            Session.query(CrowdUser).filter(CrowdUser.id.in_(uids))\
-                .update({'validated': True}, False)
-            self.request.add_message(
-                _("The selected accounts have been validated."),'info')
+        actions = [action for action in
+                   ('activate', 'suspend', 'validate', 'remove')
+                   if action in request.POST]
 
-        if 'remove' in request.POST and uids:
-            for user in Session.query(CrowdUser).filter(CrowdUser.id.in_(uids)):
-                Session.delete(user)
+        # bulk actions over whole table are not allowed
+        if actions and scope_all and not filtered:
             self.request.add_message(
-                _("The selected accounts have been removed."), 'info')
-
-        term = request.session.get('ptah-search-term', '')
-        if term:
-            self.users = Session.query(CrowdUser) \
-                .filter(sqla.sql.or_(
-                    CrowdUser.email.contains('%%%s%%' % term),
-                    CrowdUser.username.contains('%%%s%%' % term)))\
-                .order_by(sqla.sql.asc('fullname')).all()
+                _("Please specify search term."), 'warning')
+
+        # bulk actions change data, require valid csrf token
+        if actions and clause is not None:
+            self.validate_csrf_token()
+
+        translate = get_localizer(request).translate
+
+        for action, values, msg, all_msg in self.bulk_actions:
+            if action in actions and clause is not None:
+                count = update_users(clause, values, action)
+                if scope_all:
+                    msg = translate(all_msg, mapping={'count': count})
+                self.request.add_message(msg, 'info')
+
+        if 'remove' in actions and clause is not None:
+            count = delete_users(clause)
+            invalidate_roles(request=request)
+            row_counter.invalidate(CrowdUser)
+            if scope_all:
+                self.request.add_message(translate(
+                    _("${count} matching accounts have been removed."),
+                    mapping={'count': count}), 'info')
+            else:
+                self.request.add_message(
+                    _("The selected accounts have been removed."), 'info')
+
+        # preview count for bulk actions
+        if filtered:
+            self.matching = Session.query(sqla.func.count(CrowdUser.id))\
+                .filter(users_clause(term, *flags)).scalar()
+
+        if term and flags == (None, None):
+            self.users = search_user_rows(term)
         else:
-            self.size = Session.query(CrowdUser).count()
-
-            try:
-                current = int(request.params.get('batch', None))
-                if not current:
-                    current = 1
-
-                request.session['crowd-current-batch'] = current
-            except:
-                current = request.session.get('crowd-current-batch')
-                if not current:
-                    current = 1
+            # listing shows same users as bulk actions
+            query = UserRow.query()
+            if filtered:
+                query = query.filter(users_clause(term, *flags))
+                self.size, self.size_exact = self.matching, True
+            else:
+                self.size, self.size_exact = row_counter.count(CrowdUser)
+
+            params = request.params
+            if 'after' in params or 'before' in params or \
+                    'sort' in params or self.is_large_crowd():
+                self.keyset = True
+                rows, self.sort, self.prev_token, self.next_token = \
+                    self.keyset_page(
+                        query, params.get('sort'),
+                        params.get('after'), params.get('before'))
+                self.users = UserRow.from_rows(rows)
+            else:
+                self.update_pages(query)
+
+        self.badges = dict(
+            (domain, badge_url(request, domain))
+            for user in self.users for domain in user.providers)
+
+    def is_large_crowd(self):
+        return self.size > self.keyset_threshold
+
+    def update_pages(self, query=None):
+        request = self.request
+        if query is None:
+            query = UserRow.query()
 
-            self.current = current
+        try:
+            current = int(request.params.get('batch', None))
+            if not current:
+                current = 1
 
-            self.pages, self.prev, self.next = \
-                self.page(self.size, self.current)
+            request.session['crowd-current-batch'] = current
+        except:
+            current = request.session.get('crowd-current-batch')
+            if not current:
+                current = 1
 
-            offset, limit = self.page.offset(current)
-            self.users = Session.query(CrowdUser) \
-                    .offset(offset).limit(limit).all()
+        self.current = current
 
-            auths = Session.query(Storage).filter(
-                Storage.uri.in_([u.__uri__ for u in self.users])).all()
+        self.pages, self.prev, self.next = \
+            self.page(self.size, self.current)
 
-            self.external = extr = {}
-            for entry in auths:
-                data = extr.get(entry.uri)
-                if data is None:
-                    data = []
-                data.append(entry.domain)
-                extr[entry.uri] = data
+        offset, limit = self.page.offset(current)
+        self.users = UserRow.from_rows(
+            query.order_by(CrowdUser.id).offset(offset).limit(limit))
 
     @ptah.form.button(_('Search'), actype=ptah.form.AC_PRIMARY)
     def search(self):
@@ -149,13 +249,17 @@ class CrowdGroupsView(ptah.View):
         uids = request.POST.getall('uid')
 
         if 'remove' in request.POST and uids:
-            for grp in Session.query(CrowdGroup).\
-                    filter(CrowdGroup.__uri__.in_(uids)):
-                grp.delete()
+            grps = Session.query(CrowdGroup).\
+                filter(CrowdGroup.id.in_(uids)).all()
+            CrowdGroupMember.remove_groups([grp.__uri__ for grp in grps])
+            for grp in grps:
+                Session.delete(grp)
+            invalidate_roles(request=request)
+            row_counter.invalidate(CrowdGroup)
             self.request.add_message(
                 _("The selected groups have been removed."), 'info')
 
-        self.size = Session.query(CrowdGroup).count()
+        self.size, self.size_exact = row_counter.count(CrowdGroup)
 
         try:
             current = int(request.params.get('batch', None))
@@ -172,8 +276,17 @@ class CrowdGroupsView(ptah.View):
         self.pages, self.prev, self.next = self.page(self.size, self.current)
 
         offset, limit = self.page.offset(current)
-        self.groups = Session.query(CrowdGroup)\
-                      .offset(offset).limit(limit).all()
+        self.groups = GroupRow.from_rows(
+            GroupRow.query().order_by(CrowdGroup.id)
+            .offset(offset).limit(limit))
+
+
+@view_config(name='groups.json', context=CrowdModule, renderer='json')
+def groups_autocomplete(context, request):
+    """ groups with title starting with `term` parameter,
+    for groups field autocomplete """
+    return [{'value': uri, 'label': title} for uri, title in
+            complete_groups(request.params.get('term', ''))]
 
 
 @view_config(name='create-grp.html',
@@ -205,6 +318,7 @@ class CreateGroupForm(ptah.form.Form):
         grp = CrowdGroup.__type__.create(
             title=data['title'], description=data['description'])
         CrowdGroup.__type__.add(grp)
+        row_counter.bump(CrowdGroup, 1)
 
         self.request.add_message(
             _('The group has been created.'), 'success')
@@ -243,6 +357,7 @@ class ModifyGroupView(ptah.form.Form):
         # update attrs
         grp.name = data['name']
         grp.description = data['description']
+        invalidate_roles(request=self.request)
 
         self.request.add_message(
             _('The group has been updated.'), 'success')
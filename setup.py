@@ -5,7 +5,7 @@ version = '0.2'
 
 install_requires = ['setuptools',
                     'ptah >= 0.8.0',
-                    'requests >= 0.6.6',
+                    'requests >= 2.10',
                     ]
 tests_require = install_requires + ['nose']
 
@@ -37,6 +37,11 @@ setup(name='ptahcrowd',
       test_suite='nose.collector',
       include_package_data=True,
       zip_safe=False,
+      entry_points={
+          'console_scripts': [
+              'ptahcrowd-calibrate = ptahcrowd.calibrate:main',
+              ],
+          },
       message_extractors={'ptahcrowd': [
         ('static/**', 'ignore', None),
         ('tests/**.py', 'ignore', None),